@@ -0,0 +1,83 @@
+import os
+import random
+from src.repo import Repository
+
+WORDS = (
+    "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho "
+    "sigma tau upsilon phi chi psi omega config value timeout retries host port enabled"
+).split()
+
+
+def _line(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 10)))
+
+
+def _content(rng, size):
+    lines = []
+    total = 0
+    while total < size:
+        line = _line(rng)
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def _write(repo, path, lines):
+    full_path = os.path.join(repo.name, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def edit_files(rng, repo, tracked, edit_rate):
+    """Change about `edit_rate` of the tracked files, a few lines each; returns the paths."""
+    changed = [path for path in tracked if rng.random() < edit_rate] or [rng.choice(sorted(tracked))]
+    for path in changed:
+        lines = tracked[path]
+        for _ in range(rng.randint(1, 3)):
+            position = rng.randrange(len(lines) + 1)
+            if lines and rng.random() < 0.5:
+                lines[min(position, len(lines) - 1)] = _line(rng)
+            else:
+                lines.insert(position, _line(rng))
+        _write(repo, path, lines)
+    return changed
+
+
+def generate_repo(path, files=100, file_size=2048, commits=20, branches=2, edit_rate=0.1, seed=0):
+    """Create a repository with synthetic history and return it.
+
+    The first commit adds `files` text files of about `file_size` bytes spread
+    over nested directories. Each later commit edits about `edit_rate` of the
+    files on main. `branches` branches start at evenly spaced points of that
+    history and get a few commits of their own, named branch-0, branch-1 and
+    so on. The same arguments always produce the same content.
+    """
+    rng = random.Random(seed)
+    repo = Repository(path)
+    repo.create_repo()
+
+    tracked = {}
+    for i in range(files):
+        file_path = f"dir{i % 10}/sub{i % 7}/file{i}.txt"
+        tracked[file_path] = _content(rng, file_size)
+        _write(repo, file_path, tracked[file_path])
+    repo.add(".")
+    repo.commit("Initial commit")
+
+    branch_points = {commits * (b + 1) // (branches + 1): b for b in range(branches)}
+    for i in range(1, commits):
+        if i in branch_points:
+            name = f"branch-{branch_points[i]}"
+            repo.create_branch(name)
+            repo.switch_branch(name)
+            # Switching back to main restores its files, so restore its copy too.
+            saved = {path: list(lines) for path, lines in tracked.items()}
+            for j in range(3):
+                repo.add(*edit_files(rng, repo, tracked, edit_rate))
+                repo.commit(f"{name} commit {j}")
+            tracked = saved
+            repo.switch_branch("main")
+        repo.add(*edit_files(rng, repo, tracked, edit_rate))
+        repo.commit(f"Commit {i}")
+    return repo
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks.generate import generate_repo, edit_files
+
+# Timings below this many seconds are too noisy to call a regression.
+NOISE_FLOOR = 0.005
+
+
+class Context:
+    """The generated repository and scratch state shared by the operations of one run."""
+
+    def __init__(self, repo, work_dir, edit_rate, seed):
+        self.repo = repo
+        self.work_dir = work_dir
+        self.edit_rate = edit_rate
+        self.rng = random.Random(seed)
+        self.counter = 0
+        self.paths = []
+
+    def tracked(self):
+        """Return the committed files of the active branch as path -> lines."""
+        tree = self.repo._read_commit_tree(self.repo._head_commit())
+        return {path: self.repo._read_lines(blob) for path, blob in tree.items()}
+
+    def edit(self, half=None):
+        """Edit some tracked files, or only some of the first (0) or second (1) half of them."""
+        tracked = self.tracked()
+        if half is not None:
+            paths = sorted(tracked)
+            middle = len(paths) // 2
+            tracked = {path: tracked[path] for path in (paths[:middle] if half == 0 else paths[middle:])}
+        self.paths = edit_files(self.rng, self.repo, tracked, self.edit_rate)
+
+    def stage_edit(self, half=None):
+        self.edit(half)
+        self.repo.add(*self.paths)
+
+    def diverge(self):
+        """Commit different files on a new branch and on main, so merging needs a real, clean merge."""
+        self.counter += 1
+        self.branch = f"bench-merge-{self.counter}"
+        self.repo.create_branch(self.branch)
+        self.repo.switch_branch(self.branch)
+        self.stage_edit(0)
+        self.repo.commit(f"Benchmark branch commit {self.counter}")
+        self.repo.switch_branch("main")
+        self.stage_edit(1)
+        self.repo.commit(f"Benchmark main commit {self.counter}")
+
+    def clone_target(self):
+        self.counter += 1
+        self.target = os.path.join(self.work_dir, f"clone-{self.counter}")
+
+    def next_branch_name(self):
+        self.counter += 1
+        self.branch = f"bench-branch-{self.counter}"
+
+    def other_branch(self):
+        return "branch-0" if self.repo.refs.exists("branch-0") else "main"
+
+    def pick_file(self):
+        tree = self.repo._read_commit_tree(self.repo._head_commit())
+        self.file = self.rng.choice(sorted(tree))
+
+
+def _nothing(ctx):
+    pass
+
+
+# name -> (prepare, operation, clean up), each called with the Context; only the operation is timed.
+OPERATIONS = {
+    "status": (_nothing, lambda ctx: ctx.repo.status(), _nothing),
+    "add": (lambda ctx: ctx.edit(), lambda ctx: ctx.repo.add(*ctx.paths), lambda ctx: ctx.repo.commit("Benchmark add")),
+    "commit": (lambda ctx: ctx.stage_edit(), lambda ctx: ctx.repo.commit("Benchmark commit"), _nothing),
+    "create_branch": (lambda ctx: ctx.next_branch_name(), lambda ctx: ctx.repo.create_branch(ctx.branch), _nothing),
+    "diff": (_nothing, lambda ctx: ctx.repo.diff(ctx.other_branch()), _nothing),
+    "merge": (lambda ctx: ctx.diverge(), lambda ctx: ctx.repo.merge(ctx.branch), _nothing),
+    "clone": (lambda ctx: ctx.clone_target(), lambda ctx: ctx.repo.clone(ctx.target), lambda ctx: shutil.rmtree(ctx.target)),
+    "log": (_nothing, lambda ctx: list(ctx.repo.iter_history()), _nothing),
+    "log_path": (lambda ctx: ctx.pick_file(), lambda ctx: list(ctx.repo.iter_history(path=ctx.file)), _nothing),
+    "blame": (lambda ctx: ctx.pick_file(), lambda ctx: ctx.repo.blame(ctx.file), _nothing),
+    "grep": (_nothing, lambda ctx: list(ctx.repo.grep("timeout retries", all_history=True)), _nothing),
+}
+
+
+def measure(operation, ctx):
+    """Run `operation` once; returns the seconds it took."""
+    start = time.perf_counter()
+    operation(ctx)
+    return time.perf_counter() - start
+
+
+def measure_memory(operation, ctx):
+    """Run `operation` once with allocation tracing on; returns the peak bytes allocated by Python.
+
+    Tracing slows Python code down several times over, so this run is never timed.
+    """
+    tracemalloc.start()
+    try:
+        operation(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmarks(params, operations=None, repeat=3, work_dir=None):
+    """Generate a repository with `params` (generate_repo arguments) and time each operation.
+
+    Every operation runs `repeat` times, each after its own untimed setup, and
+    the fastest time is reported along with the mean. One more run measures
+    peak memory. Returns a dict of the parameters, the generation time and the
+    results per operation.
+    """
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="vcs-bench-")
+    try:
+        start = time.perf_counter()
+        repo = generate_repo(os.path.join(work_dir, "repo"), **params)
+        generate_seconds = time.perf_counter() - start
+        ctx = Context(repo, work_dir, params.get("edit_rate", 0.1), params.get("seed", 0))
+        results = {}
+        for name in operations or OPERATIONS:
+            prepare, operation, clean_up = OPERATIONS[name]
+            times = []
+            for _ in range(repeat):
+                prepare(ctx)
+                times.append(measure(operation, ctx))
+                clean_up(ctx)
+            prepare(ctx)
+            peak = measure_memory(operation, ctx)
+            clean_up(ctx)
+            results[name] = {
+                "seconds": min(times),
+                "mean_seconds": sum(times) / len(times),
+                "peak_bytes": peak,
+            }
+        return {"params": params, "generate_seconds": generate_seconds, "results": results}
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(baseline, current, threshold=1.25):
+    """Return a message for every operation at least `threshold` times slower than in `baseline`.
+
+    Both arguments are saved result files; runs are matched by their parameters.
+    """
+    regressions = []
+    baseline_runs = {json.dumps(run["params"], sort_keys=True): run for run in baseline["runs"]}
+    for run in current["runs"]:
+        old = baseline_runs.get(json.dumps(run["params"], sort_keys=True))
+        if old is None:
+            continue
+        for name, result in run["results"].items():
+            if name not in old["results"]:
+                continue
+            before, after = old["results"][name]["seconds"], result["seconds"]
+            if after > NOISE_FLOOR and after > before * threshold:
+                regressions.append(
+                    f"{name} {run['params']}: {before:.4f}s -> {after:.4f}s ({after / max(before, 1e-9):.2f}x)"
+                )
+    return regressions
+
+
+def scaling(runs, key):
+    """Return operation -> growth exponent as `key` varies between the smallest and largest run.
+
+    An exponent near 1 means time grows linearly with `key`, near 2 quadratically.
+    """
+    varying = sorted((run for run in runs if run["params"][key]), key=lambda run: run["params"][key])
+    if len(varying) < 2 or varying[0]["params"][key] == varying[-1]["params"][key]:
+        return {}
+    small, large = varying[0], varying[-1]
+    ratio = math.log(large["params"][key] / small["params"][key])
+    exponents = {}
+    for name, result in large["results"].items():
+        before = small["results"].get(name, {}).get("seconds")
+        if before and result["seconds"] > NOISE_FLOOR:
+            exponents[name] = math.log(result["seconds"] / before) / ratio
+    return exponents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time core repository operations on synthetic repositories")
+    parser.add_argument("--files", type=int, nargs="+", default=[100], help="File counts to benchmark")
+    parser.add_argument("--file-size", type=int, default=2048, help="Approximate bytes per file")
+    parser.add_argument("--commits", type=int, nargs="+", default=[20], help="Commit counts to benchmark")
+    parser.add_argument("--branches", type=int, default=2, help="Branches in each generated repository")
+    parser.add_argument("--edit-rate", type=float, default=0.1, help="Fraction of files each commit changes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated content")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each operation; the fastest is reported")
+    parser.add_argument("--only", nargs="+", choices=sorted(OPERATIONS), help="Operations to run")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Report operations slower than in this earlier results file")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "runs": [],
+    }
+    for files in args.files:
+        for commits in args.commits:
+            params = {
+                "files": files, "file_size": args.file_size, "commits": commits,
+                "branches": args.branches, "edit_rate": args.edit_rate, "seed": args.seed,
+            }
+            run = run_benchmarks(params, args.only, args.repeat)
+            report["runs"].append(run)
+            print(f"files={files} commits={commits} (generated in {run['generate_seconds']:.2f}s)")
+            for name, result in run["results"].items():
+                print(f"  {name:<14} {result['seconds'] * 1000:10.2f} ms  {result['peak_bytes'] / 1024:10.1f} KiB peak")
+
+    for key, sizes in (("files", args.files), ("commits", args.commits)):
+        if len(sizes) > 1 and len(args.files if key == "commits" else args.commits) == 1:
+            print(f"Growth with {key} (1 = linear, 2 = quadratic):")
+            for name, exponent in scaling(report["runs"], key).items():
+                print(f"  {name:<14} {exponent:6.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import os
+import json
+import zlib
+import hashlib
+from src.diff import get_opcodes
+from src.merge import is_ancestor
+
+# One path-log record: the commit id, then the path's blob id after that commit.
+_RECORD_SIZE = 81
+# Written as the blob id when a commit deletes the path.
+DELETED = "0" * 40
+
+
+def _key(*parts):
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+class BlameCache:
+    """Which commits changed each path, and which commit wrote each line, under .vcs/blame.
+
+    For every path, paths/<hash> lists the commits that changed it as
+    fixed-width records in the order they were logged, so it can be read
+    newest first without parsing the commit log. For every version of a text
+    file, lines/<hash> holds its line attribution as (commit, count) runs; no
+    runs stand for a version that no parent had, whose lines are all its
+    commit's own, so new files are indexed without being read. update() extends both for the commits logged since the last call: a new
+    version's attribution is derived from its parents' attributions with one
+    diff each, so history is never replayed and blame only reads the path-log
+    tail and one attribution file. Versions that are chunked, binary or above
+    the size limit given to update() get no attribution.
+    """
+
+    def __init__(self, repo_dir, objects, commit_graph):
+        self.root = os.path.join(repo_dir, "blame")
+        self.position_file = os.path.join(self.root, "position")
+        self.objects = objects
+        self.commit_graph = commit_graph
+
+    def position(self):
+        """Return how many commit log entries have been indexed."""
+        try:
+            with open(self.position_file, 'r') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _path_log(self, path):
+        return os.path.join(self.root, "paths", _key(path))
+
+    def _lines_path(self, commit_id, path):
+        key = _key(commit_id, path)
+        return os.path.join(self.root, "lines", key[:2], key[2:])
+
+    def has_path(self, path):
+        """Check whether any indexed commit changed exactly this path."""
+        return os.path.exists(self._path_log(path))
+
+    def changes(self, path):
+        """Yield (commit, blob) for each commit that changed `path`, newest first.
+
+        The blob is DELETED when the commit removed the path.
+        """
+        try:
+            f = open(self._path_log(path), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            end = f.seek(0, os.SEEK_END) // _RECORD_SIZE
+            for row in range(end - 1, -1, -1):
+                f.seek(row * _RECORD_SIZE)
+                record = f.read(_RECORD_SIZE).decode()
+                yield record[:40], record[40:80]
+
+    def attribution(self, path, blob, commit_id, line_count):
+        """Return the commit id of each line of `blob`, the version of `path` at `commit_id`.
+
+        The newest commit that left `path` with exactly this content and is
+        `commit_id` or one of its ancestors is used; a later commit that went
+        back to the same content is not. Ancestry is only walked when several
+        commits left the same content, as a revert does; otherwise the one
+        that did must be where `commit_id` got it. Returns None if there is no
+        such commit or its version was not indexed.
+        """
+        changes = [
+            change for change, changed_blob in self.changes(path)
+            if changed_blob == blob and self.objects.exists(change)
+        ]
+        if len(changes) > 1:
+            changes = [change for change in changes if is_ancestor(self.commit_graph, change, commit_id)]
+        if not changes:
+            return None
+        try:
+            with open(self._lines_path(changes[0], path), 'rb') as f:
+                runs = json.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        if not runs:
+            return [changes[0]] * line_count
+        return [line_commit for line_commit, count in runs for _ in range(count)]
+
+    def update(self, entries, position, max_blob_size):
+        """Index the commit log `entries` that follow `position`, oldest first.
+
+        File versions over `max_blob_size` bytes are not read.
+        """
+        for entry in entries:
+            position += 1
+            oid = entry.get("commit")
+            if oid and self.objects.exists(oid):
+                self._index_commit(oid, max_blob_size)
+            # Recording progress after each commit means a crash repeats at
+            # most one commit, whose records are then simply written twice.
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = f"{self.position_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(str(position))
+            os.replace(tmp_path, self.position_file)
+
+    def _read_lines(self, oid, max_blob_size):
+        data = self.objects.read_text_blob(oid, max_blob_size)
+        if data is None:
+            return None
+        return data.decode(errors="replace").splitlines()
+
+    def _index_commit(self, oid, max_blob_size):
+        parents = self.commit_graph.parents(oid)
+        tree = self.objects.read_tree(self.objects.read_commit(oid)["tree"])
+        parent_trees = [self.objects.read_tree(self.objects.read_commit(parent)["tree"]) for parent in parents]
+        first_tree = parent_trees[0] if parent_trees else {}
+
+        for path in sorted(set(tree) | set(first_tree)):
+            blob = tree.get(path)
+            if blob == first_tree.get(path):
+                continue
+            runs = None
+            if blob is not None and all(path not in parent_tree for parent_tree in parent_trees):
+                runs = []
+            elif blob is not None:
+                lines = self._read_lines(blob, max_blob_size)
+                if lines is not None:
+                    runs = self._attribute(oid, path, lines, parents, parent_trees, max_blob_size)
+            if runs is not None:
+                lines_path = self._lines_path(oid, path)
+                os.makedirs(os.path.dirname(lines_path), exist_ok=True)
+                with open(lines_path, 'wb') as f:
+                    f.write(zlib.compress(json.dumps(runs, separators=(",", ":")).encode()))
+            os.makedirs(os.path.dirname(self._path_log(path)), exist_ok=True)
+            with open(self._path_log(path), 'ab') as f:
+                f.write(f"{oid}{blob or DELETED}\n".encode())
+
+    def _attribute(self, oid, path, lines, parents, parent_trees, max_blob_size):
+        """Return the (commit, count) runs for a new version of a file.
+
+        Lines kept from a parent's version keep that version's attribution; the
+        first parent wins where several parents have the same line, and all
+        other lines belong to this commit.
+        """
+        owners = [oid] * len(lines)
+        for parent, parent_tree in reversed(list(zip(parents, parent_trees))):
+            parent_blob = parent_tree.get(path)
+            if parent_blob is None:
+                continue
+            parent_lines = self._read_lines(parent_blob, max_blob_size)
+            if parent_lines is None:
+                continue
+            parent_owners = self.attribution(path, parent_blob, parent, len(parent_lines))
+            if parent_owners is None or len(parent_owners) != len(parent_lines):
+                # The parent's history is not here, as at a shallow clone's boundary.
+                parent_owners = [parent] * len(parent_lines)
+            for tag, i1, i2, j1, j2 in get_opcodes(parent_lines, lines):
+                if tag == "equal":
+                    owners[j1:j2] = parent_owners[i1:i2]
+
+        runs = []
+        for owner in owners:
+            if runs and runs[-1][0] == owner:
+                runs[-1][1] += 1
+            else:
+                runs.append([owner, 1])
+        return runs
@@ -0,0 +1,71 @@
+import zlib
+import hashlib
+
+# Bytes mixed into the one-byte filter hash at every position; odd, so runs of one byte never pass.
+WINDOW = 9
+# Bytes hashed to confirm a position the filter let through.
+CONFIRM_WINDOW = 64
+# Most bytes filtered at once; smaller chunk sizes use blocks of about one chunk.
+BLOCK_SIZE = 1 << 18
+
+# Fixed pseudo-random byte substitution without zeros. It is derived from SHA-1 so
+# boundaries, and therefore chunk ids, are stable across runs and platforms.
+FILTER_TABLE = bytes(hashlib.sha1(bytes([i])).digest()[0] or 1 for i in range(256))
+
+
+def _find_cut(buf, low, high, confirm_mask, block_size):
+    """Return the offset just after the first cut point among buf[low:high], or None.
+
+    A position is a cut point when the filter hash, the XOR of FILTER_TABLE over
+    the WINDOW bytes ending there, is zero, which holds for about 1 in 256
+    positions, and the CRC-32 of the CONFIRM_WINDOW bytes ending there has no
+    bit of `confirm_mask` set. The filter is computed for a whole block at a time
+    with bytes.translate and shifts and XORs of the block as one big integer,
+    which all run in C; only the few positions it lets through are looked at
+    from Python.
+    """
+    for block_start in range(low, high, block_size):
+        block_end = min(block_start + block_size, high)
+        context = max(block_start - (WINDOW - 1), 0)
+        data = buf[context:block_end]
+        # Byte i of the integer is FILTER_TABLE[data[i]]; shifting by 8 * k bits
+        # lines it up with byte i + k, so each XOR doubles the bytes combined.
+        single = int.from_bytes(data.translate(FILTER_TABLE), "little")
+        pairs = single ^ (single << 8)
+        quads = pairs ^ (pairs << 16)
+        mixed = quads ^ (quads << 32) ^ (single << 64)
+        filtered = mixed.to_bytes(len(data) + WINDOW, "little")[:len(data)]
+        position = filtered.find(b"\0", block_start - context)
+        while position != -1:
+            cut = context + position + 1
+            if not zlib.crc32(buf[max(cut - CONFIRM_WINDOW, 0):cut]) & confirm_mask:
+                return cut
+            position = filtered.find(b"\0", position + 1)
+    return None
+
+
+def chunk_boundaries(buf, avg_size):
+    """Yield (start, end) offsets of content-defined chunks of a buffer or mmap.
+
+    A cut is made where a hash of the bytes just before a position matches a
+    pattern, so boundaries depend only on local content: an edit only changes
+    the chunks it touches. Chunks are kept between avg_size / 4 and avg_size * 4.
+    """
+    bits = max(avg_size.bit_length() - 1, 1)
+    # The filter accepts 1 position in 2 ** 8; the confirmation hash supplies the other bits.
+    confirm_mask = (1 << max(bits - 8, 0)) - 1
+    min_size = max(avg_size // 4, 1)
+    max_size = avg_size * 4
+    block_size = min(max(avg_size, 4096), BLOCK_SIZE)
+    length = len(buf)
+
+    start = 0
+    while start < length:
+        end = min(start + max_size, length)
+        cut = None
+        if end - start > min_size:
+            # Bytes before min_size can never hold a cut, so they are not hashed.
+            cut = _find_cut(buf, start + min_size, end, confirm_mask, block_size)
+        cut = cut or end
+        yield start, cut
+        start = cut
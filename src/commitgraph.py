@@ -0,0 +1,300 @@
+import os
+import heapq
+import struct
+from src.merge import Newest
+
+GRAPH_SIGNATURE = b"VCGR"
+GRAPH_VERSION = 1
+# Generation of commits that are not in the commit-graph file yet.
+GENERATION_INFINITY = 0xFFFFFFFF
+# Generation number, start of the commit's parents in the parent list, date.
+_RECORD = struct.Struct(">II19s")
+
+
+class CommitGraph:
+    """Parent links, generation numbers and dates of commits, from .vcs/commit-graph.
+
+    A commit's generation is one more than the highest generation among its
+    parents, so no commit can reach another with a higher generation and
+    ancestry walks can stop early. The file is rewritten by write(), which gc
+    calls; commits made since are read from the object store and treated as
+    having an infinite generation, which keeps every cut-off correct because
+    the file always contains all ancestors of the commits in it.
+
+    Layout: header, a 256-entry fan-out table, sorted commit ids, one fixed-size
+    record per commit, and the parent list as indices into the sorted ids.
+    """
+
+    def __init__(self, repo_dir, objects):
+        self.path = os.path.join(repo_dir, "commit-graph")
+        self.objects = objects
+        self._loaded = False
+        self._data = None
+        self._count = 0
+        # Commits that are not in the file: oid -> (parents, date).
+        self._extra = {}
+
+    def _load(self):
+        # Commits never change, so a file loaded earlier stays correct even if
+        # another process rewrites it; it may only lack newer commits.
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        magic, version, count = struct.unpack(">4sII", data[:12])
+        if magic != GRAPH_SIGNATURE or version != GRAPH_VERSION:
+            raise Exception("The commit-graph file is corrupt or from a newer version; run gc to rewrite it.")
+        self._data, self._count = data, count
+        self._fan_out = struct.unpack(">256I", data[12:12 + 1024])
+        self._ids_start = 12 + 1024
+        self._records_start = self._ids_start + 20 * count
+        self._parents_start = self._records_start + _RECORD.size * (count + 1)
+
+    def remove(self):
+        """Delete the file and forget every commit read so far.
+
+        Needed when commits gain parents, as the boundary commits of a shallow
+        clone do when the history it left out is fetched.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._loaded = False
+        self._data = None
+        self._extra.clear()
+
+    def __len__(self):
+        self._load()
+        return self._count
+
+    def _position(self, oid):
+        """Binary search for a commit in the file; returns its row or None."""
+        self._load()
+        if self._data is None:
+            return None
+        raw_oid = bytes.fromhex(oid)
+        lo = self._fan_out[raw_oid[0] - 1] if raw_oid[0] else 0
+        hi = self._fan_out[raw_oid[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._ids_start + 20 * mid
+            current = self._data[start:start + 20]
+            if current < raw_oid:
+                lo = mid + 1
+            elif current > raw_oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _oid_at(self, row):
+        start = self._ids_start + 20 * row
+        return self._data[start:start + 20].hex()
+
+    def _record(self, row):
+        return _RECORD.unpack_from(self._data, self._records_start + _RECORD.size * row)
+
+    def __contains__(self, oid):
+        return self._position(oid) is not None
+
+    def _from_objects(self, oid):
+        info = self._extra.get(oid)
+        if info is None:
+            commit = self.objects.read_commit(oid)
+            # Parents beyond the boundary of a shallow clone are simply not there.
+            parents = [parent for parent in commit["parents"] if self.objects.exists(parent)]
+            info = self._extra[oid] = (parents, commit["date"])
+        return info
+
+    def parents(self, oid):
+        """Return the ids of a commit's parents that exist in this repository."""
+        row = self._position(oid)
+        if row is None:
+            return self._from_objects(oid)[0]
+        _, start, _ = self._record(row)
+        _, end, _ = self._record(row + 1)
+        rows = struct.unpack_from(f">{end - start}I", self._data, self._parents_start + 4 * start)
+        return [self._oid_at(parent_row) for parent_row in rows]
+
+    def generation(self, oid):
+        """Return a commit's generation number, or GENERATION_INFINITY if it is not in the file."""
+        row = self._position(oid)
+        return GENERATION_INFINITY if row is None else self._record(row)[0]
+
+    def date(self, oid):
+        """Return a commit's date string."""
+        row = self._position(oid)
+        if row is None:
+            return self._from_objects(oid)[1]
+        return self._record(row)[2].rstrip(b"\0").decode()
+
+    def walk(self, include, exclude=()):
+        """Yield commits reachable from `include` but not from `exclude`, children first.
+
+        Commits are visited highest generation first, so a commit's flags are
+        final when it is reached, and the walk ends as soon as everything left
+        in the queue is reachable from `exclude`. Commits newer than the file
+        get their exact generation computed here, as dates alone do not order
+        commits made within the same second.
+        """
+        INCLUDE, EXCLUDE = 1, 2
+        flags = {}
+        queue = []
+        generations = {}
+
+        def generation(oid):
+            stack = [oid]
+            while stack:
+                current = stack[-1]
+                if current in generations:
+                    stack.pop()
+                    continue
+                stored = self.generation(current)
+                if stored != GENERATION_INFINITY:
+                    generations[stack.pop()] = stored
+                    continue
+                parents = self.parents(current)
+                pending = [parent for parent in parents if parent not in generations]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                generations[stack.pop()] = 1 + max((generations[parent] for parent in parents), default=0)
+            return generations[oid]
+
+        def push(oid, flag):
+            if flags.get(oid, 0) & flag == flag:
+                return
+            flags[oid] = flags.get(oid, 0) | flag
+            heapq.heappush(queue, (-generation(oid), Newest(self.date(oid)), oid))
+
+        for oid in exclude:
+            push(oid, EXCLUDE)
+        for oid in include:
+            push(oid, INCLUDE)
+        shown = set()
+        while queue and any(not flags[oid] & EXCLUDE for _, _, oid in queue):
+            _, _, oid = heapq.heappop(queue)
+            flag = flags[oid]
+            if not flag & EXCLUDE and oid not in shown:
+                shown.add(oid)
+                yield oid
+            for parent in self.parents(oid):
+                push(parent, EXCLUDE if flag & EXCLUDE else INCLUDE)
+
+    def write(self, tips):
+        """Rewrite the file with every commit reachable from `tips`; returns the commit count.
+
+        Commits already in the old file are taken from it, so only newer commits
+        are read from the object store.
+        """
+        parents = {}
+        dates = {}
+        stack = [oid for oid in tips if oid]
+        while stack:
+            oid = stack.pop()
+            if oid in parents:
+                continue
+            parents[oid] = self.parents(oid)
+            dates[oid] = self.date(oid)
+            stack.extend(parent for parent in parents[oid] if parent not in parents)
+
+        generations = {}
+        for start in parents:
+            stack = [start]
+            while stack:
+                oid = stack[-1]
+                if oid in generations:
+                    stack.pop()
+                    continue
+                pending = [parent for parent in parents[oid] if parent not in generations]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                generations[oid] = 1 + max((generations[parent] for parent in parents[oid]), default=0)
+
+        ordered = sorted(parents)
+        rows = {oid: row for row, oid in enumerate(ordered)}
+        fan_out = [0] * 256
+        for oid in ordered:
+            fan_out[int(oid[:2], 16)] += 1
+        total = 0
+        for i in range(256):
+            total += fan_out[i]
+            fan_out[i] = total
+
+        records = []
+        parent_rows = []
+        for oid in ordered:
+            records.append(_RECORD.pack(generations[oid], len(parent_rows), dates[oid].encode()))
+            parent_rows.extend(rows[parent] for parent in parents[oid])
+        # A sentinel record marks where the last commit's parents end.
+        records.append(_RECORD.pack(0, len(parent_rows), b""))
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(GRAPH_SIGNATURE + struct.pack(">II", GRAPH_VERSION, len(ordered)))
+            f.write(struct.pack(">256I", *fan_out))
+            f.write(b"".join(bytes.fromhex(oid) for oid in ordered))
+            f.write(b"".join(records))
+            f.write(struct.pack(f">{len(parent_rows)}I", *parent_rows))
+        os.replace(tmp_path, self.path)
+        self._loaded = False
+        self._data = None
+        self._extra.clear()
+        return len(ordered)
+
+
+def _edge_rows(edges):
+    """Yield rows of "/", "|" and "\\" that move (from column, to column) edges one column per row.
+
+    Rows are yielded until every edge has reached its column; none when all
+    edges are already straight.
+    """
+    while any(start != end for start, end in edges):
+        cells = {}
+        moved = []
+        for start, end in edges:
+            if end > start:
+                cells[2 * start + 1] = "\\"
+                start += 1
+            elif end < start:
+                cells[2 * start - 1] = "/"
+                start -= 1
+            else:
+                cells[2 * start] = "|"
+            moved.append((start, end))
+        edges = moved
+        yield "".join(cells.get(i, " ") for i in range(max(cells) + 1))
+
+
+def draw_graph(commits):
+    """Yield (lanes, commit) pairs that draw history as ASCII lanes, like `git log --graph`.
+
+    `commits` are dicts with "commit" and "parents", children before parents.
+    Every lane follows one commit still to be drawn. Extra lines that only
+    join, split or shift lanes are yielded with commit None; each edge in them
+    leads to the column of the lane that will hold its commit.
+    """
+    lanes = []
+    for commit in commits:
+        oid = commit["commit"]
+        if oid not in lanes:
+            lanes.append(oid)
+        column = lanes.index(oid)
+        yield " ".join("*" if i == column else "|" for i in range(len(lanes))), commit
+
+        parents = list(dict.fromkeys(commit["parents"]))
+        others = lanes[:column] + lanes[column + 1:]
+        # Parents already followed by another lane are joined there; the rest
+        # take this lane and open new ones to its right.
+        new_parents = [parent for parent in parents if parent not in others]
+        next_lanes = lanes[:column] + new_parents + lanes[column + 1:]
+        edges = [(i, next_lanes.index(lane)) for i, lane in enumerate(lanes) if i != column]
+        edges += [(column, next_lanes.index(parent)) for parent in parents]
+        for row in _edge_rows(sorted(edges)):
+            yield row, None
+        lanes = next_lanes
@@ -0,0 +1,132 @@
+import os
+import json
+import shlex
+import socket
+import threading
+import socketserver
+from contextlib import contextmanager
+from src.repo import Repository
+
+
+def parse_request(line):
+    """Turn one line of a batch script into a request dict, or None for blank lines and comments.
+
+    A line is a JSON array of arguments, a JSON object with "args" and an
+    optional "id" echoed in the result, or a command line split like a shell
+    would. Arguments never include the program name.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line[0] in "[{":
+        request = json.loads(line)
+        if isinstance(request, list):
+            request = {"args": request}
+        if not isinstance(request.get("args"), list):
+            raise Exception(f"Batch request without an argument list: {line}")
+        return request
+    return {"args": shlex.split(line)}
+
+
+class RepositoryPool:
+    """Repository objects kept open by name, so their caches stay warm between commands.
+
+    A Repository is not safe to use from several threads at once, so each one
+    has a lock and threads take turns; commands for different repositories
+    run in parallel.
+    """
+
+    def __init__(self):
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, name):
+        """Yield the Repository for `name`, holding its lock."""
+        key = os.path.abspath(name)
+        with self._lock:
+            entry = self._repos.get(key)
+            if entry is None:
+                entry = self._repos[key] = (Repository(name), threading.Lock())
+        repo, lock = entry
+        with lock:
+            yield repo
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """Answers each JSON request line of a connection with one JSON result line."""
+
+    handle_request = None
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                result = self.handle_request(request["args"], request.get("cwd"))
+            except Exception as e:
+                request, result = {}, {"ok": False, "output": "", "error": str(e)}
+            if "id" in request:
+                result = dict(result, id=request["id"])
+            self.wfile.write(json.dumps(result).encode() + b"\n")
+            self.wfile.flush()
+
+
+def make_daemon(socket_path, handle_request):
+    """Create a server answering requests on a Unix socket, one thread per connection.
+
+    handle_request(args, cwd) runs one command and returns a result dict with
+    "ok", "output" and, on failure, "error"; `cwd` is the client's working
+    directory, which relative paths in `args` refer to. Call serve_forever() on the result to
+    start answering; a stale socket file left by a daemon that died is replaced.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise Exception("The daemon needs Unix domain sockets, which this platform does not have.")
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise Exception(f"A daemon is already listening on '{socket_path}'.")
+        finally:
+            probe.close()
+    handler = type("DaemonHandler", (_DaemonHandler,), {"handle_request": staticmethod(handle_request)})
+    server = socketserver.ThreadingUnixStreamServer(socket_path, handler)
+    server.daemon_threads = True
+    return server
+
+
+class DaemonClient:
+    """Sends commands to a daemon over its Unix socket, on one connection."""
+
+    def __init__(self, socket_path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise Exception("The daemon needs Unix domain sockets, which this platform does not have.")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(socket_path)
+        except OSError as e:
+            self._socket.close()
+            raise Exception(f"Could not reach a daemon on '{socket_path}': {e}")
+        self._reader = self._socket.makefile('rb')
+        self._writer = self._socket.makefile('wb')
+
+    def run(self, request):
+        """Send one request dict ({"args": [...]}) and return its result dict.
+
+        The request carries this process's working directory, so the daemon
+        finds repositories and paths where this process would.
+        """
+        request = dict(request, cwd=os.getcwd())
+        self._writer.write(json.dumps(request).encode() + b"\n")
+        self._writer.flush()
+        line = self._reader.readline()
+        if not line:
+            raise Exception("The daemon closed the connection.")
+        return json.loads(line)
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+        self._socket.close()
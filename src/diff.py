@@ -0,0 +1,260 @@
+from collections import Counter
+
+
+def _intern(a, b):
+    """Map lines to small integers so the diff compares ints instead of strings."""
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def _bisect(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Find the middle snake of Myers' algorithm in linear space.
+
+    Walks forward from the start and backward from the end at the same time and
+    returns the point where the two paths overlap, or None when the ranges share
+    no lines at all.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    size = 2 * max_d + 2
+    forward = [-1] * size
+    backward = [-1] * size
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = n - m
+    # With an odd delta the paths meet on a forward step, otherwise on a backward step.
+    check_forward = delta % 2 != 0
+    k1_start = k1_end = k2_start = k2_end = 0
+
+    for d in range(max_d):
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a_lo + x1] == b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif check_forward:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < size and backward[k2_offset] != -1:
+                    if x1 >= n - backward[k2_offset]:
+                        return x1, y1
+
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[a_hi - 1 - x2] == b[b_hi - 1 - y2]:
+                x2 += 1
+                y2 += 1
+            backward[k2_offset] = x2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not check_forward:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < size and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    if x1 >= n - x2:
+                        return x1, offset + x1 - k1_offset
+    return None
+
+
+def matching_blocks(a, b):
+    """Return (a_start, b_start, length) runs of equal lines, like SequenceMatcher.
+
+    Uses Myers' O(ND) algorithm with the linear-space middle-snake refinement, so
+    memory stays proportional to the input and similar files diff quickly. The
+    list ends with the same (len(a), len(b), 0) sentinel SequenceMatcher uses.
+    """
+    a, b = _intern(a, b)
+    blocks = []
+    # An explicit stack avoids hitting the recursion limit on long, very different inputs.
+    tasks = [("range", 0, len(a), 0, len(b))]
+    while tasks:
+        task = tasks.pop()
+        if task[0] == "block":
+            if task[3]:
+                blocks.append(task[1:])
+            continue
+        _, a_lo, a_hi, b_lo, b_hi = task
+        prefix = 0
+        while a_lo + prefix < a_hi and b_lo + prefix < b_hi and a[a_lo + prefix] == b[b_lo + prefix]:
+            prefix += 1
+        if prefix:
+            blocks.append((a_lo, b_lo, prefix))
+            a_lo += prefix
+            b_lo += prefix
+        suffix = 0
+        while a_lo < a_hi - suffix and b_lo < b_hi - suffix and a[a_hi - 1 - suffix] == b[b_hi - 1 - suffix]:
+            suffix += 1
+        a_hi -= suffix
+        b_hi -= suffix
+        tasks.append(("block", a_hi, b_hi, suffix))
+        if a_lo < a_hi and b_lo < b_hi:
+            split = _bisect(a, b, a_lo, a_hi, b_lo, b_hi)
+            if split:
+                x, y = split
+                tasks.append(("range", a_lo + x, a_hi, b_lo + y, b_hi))
+                tasks.append(("range", a_lo, a_lo + x, b_lo, b_lo + y))
+
+    merged = []
+    for a_start, b_start, length in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == a_start and merged[-1][1] + merged[-1][2] == b_start:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + length)
+        else:
+            merged.append((a_start, b_start, length))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+def get_opcodes(a, b):
+    """Return SequenceMatcher-style (tag, i1, i2, j1, j2) edit operations."""
+    opcodes = []
+    i = j = 0
+    for a_start, b_start, length in matching_blocks(a, b):
+        if i < a_start and j < b_start:
+            opcodes.append(("replace", i, a_start, j, b_start))
+        elif i < a_start:
+            opcodes.append(("delete", i, a_start, j, b_start))
+        elif j < b_start:
+            opcodes.append(("insert", i, a_start, j, b_start))
+        if length:
+            opcodes.append(("equal", a_start, a_start + length, b_start, b_start + length))
+        i, j = a_start + length, b_start + length
+    return opcodes
+
+
+def count_changes(a, b):
+    """Return the number of (inserted, deleted) lines between two line lists."""
+    inserted = deleted = 0
+    for tag, i1, i2, j1, j2 in get_opcodes(a, b):
+        if tag != "equal":
+            deleted += i2 - i1
+            inserted += j2 - j1
+    return inserted, deleted
+
+
+def _grouped_opcodes(opcodes, context):
+    """Split opcodes into hunks with `context` lines around each change, as difflib does."""
+    if not opcodes:
+        opcodes = [("equal", 0, 1, 0, 1)]
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _hunk_range(start, stop):
+    length = stop - start
+    beginning = start + 1
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(a, b, fromfile, tofile, context=3):
+    """Yield unified diff lines (without line terminators) for two lists of lines."""
+    started = False
+    for group in _grouped_opcodes(get_opcodes(a, b), context):
+        if not started:
+            started = True
+            yield f"--- {fromfile}"
+            yield f"+++ {tofile}"
+        first, last = group[0], group[-1]
+        yield f"@@ -{_hunk_range(first[1], last[2])} +{_hunk_range(first[3], last[4])} @@"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield f" {line}"
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield f"-{line}"
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield f"+{line}"
+
+
+def similarity(a, b):
+    """Share of lines two files have in common, from 0.0 to 1.0, ignoring order."""
+    if not a and not b:
+        return 1.0
+    common = sum((Counter(a) & Counter(b)).values())
+    return 2.0 * common / (len(a) + len(b))
+
+
+def detect_renames(removed, added, read_lines, threshold=0.5, max_candidates=100):
+    """Pair removed paths with added paths that look like the same file.
+
+    `removed` and `added` map paths to blob ids. Identical ids are paired first
+    without reading anything; remaining paths are compared by line similarity,
+    which is skipped when either side has more than `max_candidates` paths.
+    Returns a list of (old_path, new_path, score) tuples.
+    """
+    renames = []
+    by_oid = {}
+    for path, oid in sorted(removed.items()):
+        by_oid.setdefault(oid, []).append(path)
+    unmatched_added = []
+    for path, oid in sorted(added.items()):
+        if by_oid.get(oid):
+            renames.append((by_oid[oid].pop(0), path, 1.0))
+        else:
+            unmatched_added.append(path)
+    unmatched_removed = [path for paths in by_oid.values() for path in paths]
+
+    if not unmatched_added or not unmatched_removed:
+        return renames
+    if len(unmatched_added) > max_candidates or len(unmatched_removed) > max_candidates:
+        return renames
+
+    removed_lines = {path: read_lines(removed[path]) for path in unmatched_removed}
+    added_lines = {path: read_lines(added[path]) for path in unmatched_added}
+    scored = []
+    for old in unmatched_removed:
+        for new in unmatched_added:
+            a, b = removed_lines[old], added_lines[new]
+            # Counts of lines bound the achievable score, so hopeless pairs are skipped cheaply.
+            if 2.0 * min(len(a), len(b)) / max(len(a) + len(b), 1) < threshold:
+                continue
+            score = similarity(a, b)
+            if score >= threshold:
+                scored.append((score, old, new))
+    used = set()
+    for score, old, new in sorted(scored, key=lambda item: (-item[0], item[1], item[2])):
+        if old not in used and new not in used:
+            used.update((old, new))
+            renames.append((old, new, score))
+    return renames
@@ -0,0 +1,172 @@
+import os
+import re
+
+IGNORE_FILE = ".vcsignore"
+
+
+def _translate(pattern):
+    """Turn one gitignore-style glob into a regular expression matching whole paths."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            at_segment_start = i == 0 or pattern[i - 1] == "/"
+            if pattern.startswith("**/", i) and at_segment_start:
+                # "**/" matches zero or more whole directories.
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i) and i + 2 == n and at_segment_start:
+                # A trailing "/**" matches everything inside.
+                out.append(".*")
+                i += 2
+                continue
+            while i < n and pattern[i] == "*":
+                i += 1
+            out.append("[^/]*")
+            continue
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                out.append(f"(?!/)[{body}]")
+                i = j + 1
+                continue
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class RuleSet:
+    """The patterns of one ignore file, compiled into a single regular expression.
+
+    Patterns are joined into one alternation in reverse order, so the first
+    alternative that matches is the last matching line of the file, which is
+    the one that decides, as in .gitignore. Directory-only patterns ("build/")
+    are left out of the expression used for files.
+    """
+
+    def __init__(self, lines):
+        file_parts, dir_parts = [], []
+        file_negated, dir_negated = [], []
+        for line in reversed(list(lines)):
+            line = line.rstrip("\r\n")
+            while line.endswith(" ") and not line.endswith("\\ "):
+                line = line[:-1]
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            elif line.startswith(("\\!", "\\#")):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            # A slash anywhere but at the end ties the pattern to this directory;
+            # otherwise it matches a name at any depth.
+            regex = _translate(line.lstrip("/"))
+            if "/" not in line:
+                regex = "(?:.*/)?" + regex
+            dir_parts.append(f"({regex})")
+            dir_negated.append(negated)
+            if not dir_only:
+                file_parts.append(f"({regex})")
+                file_negated.append(negated)
+        self.empty = not dir_parts
+        self._files = re.compile("|".join(file_parts)) if file_parts else None
+        self._dirs = re.compile("|".join(dir_parts)) if dir_parts else None
+        self._file_negated = file_negated
+        self._dir_negated = dir_negated
+
+    def match(self, rel_path, is_dir):
+        """Return True if ignored, False if re-included with "!", or None if no pattern matches."""
+        pattern, negated = (self._dirs, self._dir_negated) if is_dir else (self._files, self._file_negated)
+        if pattern is None:
+            return None
+        m = pattern.fullmatch(rel_path)
+        if m is None:
+            return None
+        return not negated[m.lastindex - 1]
+
+
+class IgnoreMatcher:
+    """Decides which working-tree paths are ignored, following .gitignore rules.
+
+    Rules come from .vcsignore files anywhere in the working tree, each applying
+    below its own directory with deeper files taking precedence, and from the
+    repository-wide list in .vcs/.vcsignore, which comes last. Each file is read
+    and compiled once, the first time its directory is visited, and decisions
+    about directories are memoised, so a walk can skip an ignored subtree after
+    a single lookup and never reads anything inside it.
+    """
+
+    def __init__(self, root, repo_rules=()):
+        self.root = root
+        self._repo_rules = RuleSet(repo_rules)
+        # Directory -> ((directory, RuleSet), ...) that apply inside it, deepest first.
+        self._chains = {}
+        self._dirs = {}
+
+    def _load(self, rel_dir):
+        try:
+            with open(os.path.join(self.root, rel_dir, IGNORE_FILE), 'r') as f:
+                rules = RuleSet(f.read().splitlines())
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return None if rules.empty else rules
+
+    def _chain(self, rel_dir):
+        chain = self._chains.get(rel_dir)
+        if chain is None:
+            if rel_dir:
+                chain = self._chain(rel_dir.rpartition("/")[0])
+            else:
+                chain = (("", self._repo_rules),)
+            rules = self._load(rel_dir)
+            if rules is not None:
+                chain = ((rel_dir, rules),) + chain
+            self._chains[rel_dir] = chain
+        return chain
+
+    def _match(self, rel_path, is_dir):
+        for rel_dir, rules in self._chain(rel_path.rpartition("/")[0]):
+            decision = rules.match(rel_path[len(rel_dir) + 1:] if rel_dir else rel_path, is_dir)
+            if decision is not None:
+                return decision
+        return False
+
+    def is_dir_ignored(self, rel_dir):
+        """Check whether a directory, and so everything below it, is ignored."""
+        ignored = self._dirs.get(rel_dir)
+        if ignored is None:
+            parent = rel_dir.rpartition("/")[0]
+            ignored = (bool(parent) and self.is_dir_ignored(parent)) or self._match(rel_dir, True)
+            self._dirs[rel_dir] = ignored
+        return ignored
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """Check a repository-relative path, including whether a parent directory is ignored."""
+        if is_dir:
+            return self.is_dir_ignored(rel_path)
+        parent = rel_path.rpartition("/")[0]
+        return (bool(parent) and self.is_dir_ignored(parent)) or self._match(rel_path, False)
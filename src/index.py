@@ -0,0 +1,93 @@
+import os
+import time
+from src import trace
+
+# Files modified this close to the moment their stat data was recorded may have
+# changed again within the filesystem's timestamp granularity, so they are rehashed.
+RACY_WINDOW_NS = 1_000_000_000
+
+
+class Index:
+    """Stat cache of tracked files plus the set of paths staged for the next commit.
+
+    Each entry maps a path to [mtime_ns, size, inode, blob id]. A file whose stat
+    data still matches its entry is assumed unchanged and is not read again.
+    """
+
+    def __init__(self, repo_dir):
+        self.index_file = os.path.join(repo_dir, "index")
+        self.entries = {}
+        self.staged = {}
+        self.timestamp = 0
+        self.dirty = False
+
+    def exists(self):
+        """Check whether an index has been written."""
+        return os.path.exists(self.index_file)
+
+    def load(self):
+        """Read the index from disk."""
+        with open(self.index_file, 'r') as f:
+            text = f.read()
+        trace.count("io.files_opened")
+        trace.count("io.bytes_read", len(text))
+        data = trace.json_loads(text)
+        self.entries = data["entries"]
+        self.staged = dict.fromkeys(data["staged"])
+        self.timestamp = data["timestamp"]
+        self.dirty = False
+        return self
+
+    def serialize(self):
+        """Return the on-disk JSON form of the index, stamped with the current time."""
+        self.timestamp = time.time_ns()
+        self.dirty = False
+        data = {"version": 1, "timestamp": self.timestamp, "entries": self.entries, "staged": list(self.staged)}
+        return trace.json_dumps(data, separators=(",", ":"))
+
+    def save(self):
+        """Atomically replace the index on disk."""
+        tmp_path = f"{self.index_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.serialize())
+        os.replace(tmp_path, self.index_file)
+
+    @staticmethod
+    def _stat_key(st):
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def is_fresh(self, path, st):
+        """True when the cached entry for `path` can be trusted without rehashing."""
+        entry = self.entries.get(path)
+        if entry is None or entry[:3] != self._stat_key(st):
+            return False
+        return st.st_mtime_ns < self.timestamp - RACY_WINDOW_NS
+
+    def update(self, path, st, oid):
+        """Record the stat data and blob id of a file."""
+        self.entries[path] = self._stat_key(st) + [oid]
+        self.dirty = True
+
+    def seed(self, tree):
+        """Track the files of a tree with empty stat data, forcing a rehash on first use."""
+        for path, oid in tree.items():
+            self.entries[path] = [0, 0, 0, oid]
+        self.dirty = True
+
+    def stage(self, path):
+        """Mark a path to be included in the next commit."""
+        if path not in self.staged:
+            self.staged[path] = None
+            self.dirty = True
+
+    def unstage(self, path):
+        """Leave a path out of the next commit again."""
+        if path in self.staged:
+            del self.staged[path]
+            self.dirty = True
+
+    def clear_staged(self):
+        """Forget all staged paths."""
+        if self.staged:
+            self.staged = {}
+            self.dirty = True
@@ -0,0 +1,132 @@
+import os
+import json
+import struct
+from src import trace
+
+OFFSET_FORMAT = ">Q"
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+
+class CommitLog:
+    """Append-only JSON-lines commit journal with a fixed-width offset index.
+
+    Each entry is one line of log.jsonl. log.idx holds the byte offset of every
+    line as an 8-byte big-endian integer, so entry i can be read with two seeks.
+    """
+
+    def __init__(self, repo_dir):
+        self.log_file = os.path.join(repo_dir, "log.jsonl")
+        self.index_file = os.path.join(repo_dir, "log.idx")
+
+    def exists(self):
+        """Check whether the journal has been created."""
+        return os.path.exists(self.log_file)
+
+    def create(self):
+        """Create an empty journal and index."""
+        open(self.log_file, 'wb').close()
+        open(self.index_file, 'wb').close()
+
+    def __len__(self):
+        if not os.path.exists(self.index_file):
+            return 0
+        return os.path.getsize(self.index_file) // OFFSET_SIZE
+
+    def _recover(self):
+        """Drop a torn trailing line and index any lines written after the last indexed one."""
+        count = len(self)
+        log_size = os.path.getsize(self.log_file)
+        with open(self.log_file, 'rb+') as log:
+            if count:
+                log.seek(self._offset(count - 1))
+                log.readline()
+            position = log.tell()
+            if position == log_size:
+                return
+            offsets = []
+            while True:
+                line = log.readline()
+                if not line.endswith(b"\n"):
+                    break
+                offsets.append(position)
+                position = log.tell()
+            log.truncate(position)
+        with open(self.index_file, 'rb+') as idx:
+            idx.truncate(count * OFFSET_SIZE)
+            idx.seek(0, os.SEEK_END)
+            idx.write(b"".join(struct.pack(OFFSET_FORMAT, o) for o in offsets))
+
+    def append(self, entry):
+        """Append one entry in O(1), regardless of the journal's length."""
+        self._recover()
+        line = trace.json_dumps(entry, separators=(",", ":")).encode() + b"\n"
+        with open(self.log_file, 'ab') as log:
+            offset = log.seek(0, os.SEEK_END)
+            log.write(line)
+        with open(self.index_file, 'ab') as idx:
+            idx.write(struct.pack(OFFSET_FORMAT, offset))
+        trace.count("io.files_opened", 2)
+        trace.count("io.bytes_written", len(line) + OFFSET_SIZE)
+
+    def extend(self, entries):
+        """Append many entries through a single pair of buffered writes."""
+        self._recover()
+        with open(self.log_file, 'ab') as log, open(self.index_file, 'ab') as idx:
+            offset = log.seek(0, os.SEEK_END)
+            for entry in entries:
+                line = trace.json_dumps(entry, separators=(",", ":")).encode() + b"\n"
+                idx.write(struct.pack(OFFSET_FORMAT, offset))
+                log.write(line)
+                offset += len(line)
+                trace.count("io.bytes_written", len(line) + OFFSET_SIZE)
+
+    def _offset(self, position):
+        with open(self.index_file, 'rb') as idx:
+            idx.seek(position * OFFSET_SIZE)
+            return struct.unpack(OFFSET_FORMAT, idx.read(OFFSET_SIZE))[0]
+
+    def tail(self, count):
+        """Return the last `count` entries, oldest first, without reading earlier ones."""
+        total = len(self)
+        start = max(total - count, 0)
+        if start == total:
+            return []
+        with open(self.log_file, 'rb') as log:
+            log.seek(self._offset(start))
+            return [trace.json_loads(log.readline()) for _ in range(total - start)]
+
+    def __iter__(self):
+        """Yield every entry, oldest first."""
+        total = len(self)
+        with open(self.log_file, 'rb') as log:
+            for _ in range(total):
+                yield trace.json_loads(log.readline())
+
+    def iter_reverse(self, block_size=1024):
+        """Yield entries newest first, reading the index backwards in blocks."""
+        end = len(self)
+        with open(self.index_file, 'rb') as idx, open(self.log_file, 'rb') as log:
+            while end > 0:
+                start = max(end - block_size, 0)
+                idx.seek(start * OFFSET_SIZE)
+                block = idx.read((end - start) * OFFSET_SIZE)
+                offsets = [o for (o,) in struct.iter_unpack(OFFSET_FORMAT, block)]
+                for offset in reversed(offsets):
+                    log.seek(offset)
+                    yield trace.json_loads(log.readline())
+                end = start
+
+    def migrate_from(self, history_file):
+        """Convert a legacy history.json array into the journal format, then remove it."""
+        with open(history_file, 'r') as f:
+            history = json.load(f)
+
+        log_tmp = f"{self.log_file}.tmp"
+        index_tmp = f"{self.index_file}.tmp"
+        with open(log_tmp, 'wb') as log, open(index_tmp, 'wb') as idx:
+            for entry in history:
+                idx.write(struct.pack(OFFSET_FORMAT, log.tell()))
+                log.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+        os.replace(log_tmp, self.log_file)
+        os.replace(index_tmp, self.index_file)
+        os.remove(history_file)
@@ -0,0 +1,79 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class RepositoryLock:
+    """Exclusive advisory lock on .vcs/lock for operations that modify the repository.
+
+    The lock is tied to an open file handle, so the operating system releases it
+    if the holding process dies; there are no stale lock files to clean up.
+    Readers never wait for it.
+    """
+
+    def __init__(self, repo_dir, timeout=10.0):
+        self.lock_file = os.path.join(repo_dir, "lock")
+        self.timeout = timeout
+        self._handle = None
+
+    def _try_lock(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def acquire(self):
+        """Block until the lock is held, or raise once the timeout expires."""
+        self._handle = open(self.lock_file, 'a+b')
+        deadline = time.monotonic() + self.timeout
+        delay = 0.001
+        while not self._try_lock():
+            if time.monotonic() >= deadline:
+                self._handle.close()
+                self._handle = None
+                raise Exception(
+                    f"Timed out after {self.timeout:g}s waiting for the repository lock; "
+                    "another vcs process is modifying this repository."
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def try_acquire(self):
+        """Take the lock only if it is free right now; returns whether it was taken."""
+        self._handle = open(self.lock_file, 'a+b')
+        if self._try_lock():
+            return True
+        self._handle.close()
+        self._handle = None
+        return False
+
+    def release(self):
+        """Release the lock."""
+        if self._handle is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+            else:
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
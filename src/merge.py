@@ -0,0 +1,150 @@
+import heapq
+from src.diff import matching_blocks
+
+OURS, THEIRS, STALE = 1, 2, 4
+
+
+def merge_base(graph, ours, theirs):
+    """Return the best common ancestor of two commits, or None if they share no history.
+
+    `graph` is the repository's CommitGraph. Commits are painted from both tips,
+    highest generation number first, so every commit is handled after all of
+    its descendants in the queue. Every commit reached from both sides is a
+    candidate and its ancestors are marked stale, so the walk stops as soon as
+    only stale commits remain. Candidates that are ancestors of other
+    candidates are then discarded.
+    """
+    if ours == theirs:
+        return ours
+    flags = {ours: OURS, theirs: THEIRS}
+
+    def push(queue, oid):
+        # heapq is a min-heap: negated generations and Newest pop the latest commit first.
+        heapq.heappush(queue, (-graph.generation(oid), Newest(graph.date(oid)), oid))
+
+    queue = []
+    push(queue, ours)
+    push(queue, theirs)
+    candidates = []
+    while queue and any(not flags[oid] & STALE for _, _, oid in queue):
+        _, _, oid = heapq.heappop(queue)
+        flag = flags[oid]
+        if flag & (OURS | THEIRS) == OURS | THEIRS and not flag & STALE:
+            if oid not in candidates:
+                candidates.append(oid)
+            flag |= STALE
+        for parent in graph.parents(oid):
+            if flags.get(parent, 0) & flag == flag:
+                continue
+            flags[parent] = flags.get(parent, 0) | flag
+            push(queue, parent)
+
+    # Commits newer than the commit-graph file share one generation and are
+    # ordered by date, so a candidate may still be an ancestor of another one.
+    for candidate in candidates:
+        if not any(other != candidate and is_ancestor(graph, candidate, other) for other in candidates):
+            return candidate
+    return None
+
+
+def is_ancestor(graph, ancestor, descendant):
+    """Check whether `ancestor` is reachable from `descendant` through parent links.
+
+    A commit's generation number is higher than that of all its ancestors, so
+    the search never follows a commit whose generation is below `ancestor`'s.
+    """
+    floor = graph.generation(ancestor)
+    seen = {descendant}
+    stack = [descendant]
+    while stack:
+        oid = stack.pop()
+        if oid == ancestor:
+            return True
+        for parent in graph.parents(oid):
+            if parent not in seen and graph.generation(parent) >= floor:
+                seen.add(parent)
+                stack.append(parent)
+    return False
+
+
+class Newest:
+    """Sort key that orders date strings newest first."""
+
+    __slots__ = ("date",)
+
+    def __init__(self, date):
+        self.date = date
+
+    def __lt__(self, other):
+        return self.date > other.date
+
+    def __eq__(self, other):
+        return self.date == other.date
+
+
+def _sync_regions(base, ours, theirs):
+    """Find runs of base lines that are unchanged on both sides."""
+    regions = []
+    ours_blocks = matching_blocks(base, ours)
+    theirs_blocks = matching_blocks(base, theirs)
+    i = j = 0
+    while i < len(ours_blocks) and j < len(theirs_blocks):
+        o_base, o_start, o_len = ours_blocks[i]
+        t_base, t_start, t_len = theirs_blocks[j]
+        start = max(o_base, t_base)
+        end = min(o_base + o_len, t_base + t_len)
+        if start < end:
+            o_sub = o_start + (start - o_base)
+            t_sub = t_start + (start - t_base)
+            regions.append((start, end, o_sub, o_sub + end - start, t_sub, t_sub + end - start))
+        if o_base + o_len < t_base + t_len:
+            i += 1
+        else:
+            j += 1
+    regions.append((len(base), len(base), len(ours), len(ours), len(theirs), len(theirs)))
+    return regions
+
+
+def merge_lines(base, ours, theirs, ours_label, theirs_label):
+    """Three-way merge of byte strings line by line.
+
+    Returns the merged content and whether any region conflicted. Conflicting
+    regions are wrapped in conflict markers.
+    """
+    base_lines = base.splitlines(keepends=True)
+    ours_lines = ours.splitlines(keepends=True)
+    theirs_lines = theirs.splitlines(keepends=True)
+
+    merged = []
+    conflict = False
+    b = o = t = 0
+    for b_match, b_end, o_match, o_end, t_match, t_end in _sync_regions(base_lines, ours_lines, theirs_lines):
+        base_part = base_lines[b:b_match]
+        ours_part = ours_lines[o:o_match]
+        theirs_part = theirs_lines[t:t_match]
+        if ours_part == theirs_part or theirs_part == base_part:
+            merged.extend(ours_part)
+        elif ours_part == base_part:
+            merged.extend(theirs_part)
+        else:
+            conflict = True
+            merged.append(f"<<<<<<< {ours_label}\n".encode())
+            merged.extend(_terminated(ours_part))
+            merged.append(b"=======\n")
+            merged.extend(_terminated(theirs_part))
+            merged.append(f">>>>>>> {theirs_label}\n".encode())
+        merged.extend(base_lines[b_match:b_end])
+        b, o, t = b_end, o_end, t_end
+    return b"".join(merged), conflict
+
+
+def _terminated(lines):
+    """Make sure the last line of a conflict side ends before the next marker."""
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
+
+
+def is_binary(data):
+    """Heuristic used by git: a NUL byte near the start means binary content."""
+    return b"\0" in data[:8000]
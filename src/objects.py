@@ -0,0 +1,515 @@
+import os
+import sys
+import mmap
+import zlib
+import shutil
+import hashlib
+import threading
+from collections import deque
+from src.chunking import chunk_boundaries
+from src.pack import PackFile, apply_delta
+from src.merge import is_binary
+from src import trace
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl request that asks Linux filesystems such as btrfs and XFS for a copy-on-write clone.
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst):
+    """Make `dst` a copy of the immutable file `src` as cheaply as the platform allows.
+
+    Tries a hard link first, then a copy-on-write clone, then an in-kernel
+    copy_file_range, and only then a plain copy through user space.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def check_tree_path(path):
+    """Raise unless a tree path is relative, has no empty, "." or ".." parts, and stays out of .vcs.
+
+    Trees can come from any remote, so their paths are checked before they
+    are stored or written to the working tree.
+    """
+    parts = path.replace("\\", "/").split("/")
+    if (os.path.isabs(path) or os.path.splitdrive(path)[0]
+            or any(part in ("", ".", "..") for part in parts) or parts[0].lower() == ".vcs"):
+        raise Exception(f"Refusing unsafe path '{path}' in tree.")
+
+
+class ObjectStore:
+    """Content-addressed store for blobs, trees and commits under .vcs/objects.
+
+    New objects are written loose, one compressed file each. `vcs gc` moves them
+    into packs under objects/pack, where similar versions are stored as deltas;
+    every read looks in the loose files first and then in the packs.
+    """
+
+    def __init__(self, repo_dir):
+        self.objects_dir = os.path.join(repo_dir, "objects")
+        self.pack_dir = os.path.join(self.objects_dir, "pack")
+        self._packs = {}
+        self._packs_mtime = None
+        self._packs_lock = threading.Lock()
+
+    def _object_path(self, oid):
+        """Objects are fanned out by the first two hex digits of their id."""
+        return os.path.join(self.objects_dir, oid[:2], oid[2:])
+
+    @staticmethod
+    def hash_object(obj_type, data):
+        """Return the id an object of the given type and payload would be stored under."""
+        header = f"{obj_type} {len(data)}\0".encode()
+        return hashlib.sha1(header + data).hexdigest()
+
+    @staticmethod
+    def hash_file(path, chunk_size=1 << 20):
+        """Return the blob id of a file's content, reading it in chunks."""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.sha1(f"blob {size}\0".encode())
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        trace.count("io.files_opened")
+        trace.count("io.bytes_read", size)
+        return digest.hexdigest()
+
+    def packs(self, refresh=False):
+        """Return the packs in the store, rescanning objects/pack when it has changed."""
+        with self._packs_lock:
+            try:
+                mtime = os.stat(self.pack_dir).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if refresh or mtime != self._packs_mtime:
+                names = set()
+                if mtime is not None:
+                    names = {name[:-4] for name in os.listdir(self.pack_dir) if name.endswith(".idx")}
+                for name in set(self._packs) - names:
+                    self._packs.pop(name).close()
+                for name in names - set(self._packs):
+                    base = os.path.join(self.pack_dir, name)
+                    self._packs[name] = PackFile(f"{base}.pack", f"{base}.idx")
+                self._packs_mtime = mtime
+            return list(self._packs.values())
+
+    def close(self):
+        """Release the packs this store has open."""
+        with self._packs_lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs.clear()
+            self._packs_mtime = None
+
+    def loose_ids(self):
+        """Yield the id of every loose object in the store."""
+        if not os.path.isdir(self.objects_dir):
+            return
+        for fan_out in os.listdir(self.objects_dir):
+            fan_dir = os.path.join(self.objects_dir, fan_out)
+            if len(fan_out) != 2 or not os.path.isdir(fan_dir):
+                continue
+            for name in os.listdir(fan_dir):
+                if ".tmp" not in name:
+                    yield fan_out + name
+
+    def object_ids(self):
+        """Yield the id of every object in the store, loose or packed, once."""
+        seen = set()
+        for oid in self.loose_ids():
+            seen.add(oid)
+            yield oid
+        for pack in self.packs():
+            for oid in pack:
+                if oid not in seen:
+                    seen.add(oid)
+                    yield oid
+
+    def remove_loose(self, oids):
+        """Delete the loose files of objects, e.g. once they are packed."""
+        for oid in oids:
+            path = self._object_path(oid)
+            os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def disk_usage(self):
+        """Return the number of bytes used by loose objects and packs."""
+        total = 0
+        for dir_path, _, files in os.walk(self.objects_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(dir_path, name))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def _find_packed(self, oid, expected=False):
+        """Return the pack holding an object, or None.
+
+        When the object is `expected` to exist, a miss rescans objects/pack in
+        case a gc in another process has just packed it.
+        """
+        for refresh in ((False, True) if expected else (False,)):
+            for pack in self.packs(refresh):
+                if oid in pack:
+                    return pack
+        return None
+
+    def object_type(self, oid):
+        """Return an object's type by decompressing only its header."""
+        path = self._object_path(oid)
+        if not os.path.exists(path):
+            pack = self._find_packed(oid, expected=True)
+            if pack is None:
+                raise Exception(f"Object '{oid}' not found.")
+            return pack.entry_type(oid)
+        with open(path, 'rb') as f:
+            decompressor = zlib.decompressobj()
+            head = b""
+            while b"\0" not in head:
+                more = f.read(64)
+                if not more:
+                    raise Exception(f"Object '{oid}' is corrupt.")
+                head += decompressor.decompress(more)
+        return head.partition(b" ")[0].decode()
+
+    def copy_object_to(self, other, oid):
+        """Share one object with another store, hard-linking it where possible."""
+        target = other._object_path(oid)
+        if os.path.exists(target):
+            return
+        if not os.path.exists(self._object_path(oid)):
+            other._write_loose(oid, *self.read_raw(oid))
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_or_copy(self._object_path(oid), target)
+
+    def copy_packs_to(self, other):
+        """Share every pack with another store, hard-linking where possible."""
+        packs = self.packs()
+        if packs:
+            os.makedirs(other.pack_dir, exist_ok=True)
+        for pack in packs:
+            # The index goes last, so the other store never sees a pack without its data.
+            for path in (pack.pack_path, pack.index_path):
+                link_or_copy(path, os.path.join(other.pack_dir, os.path.basename(path)))
+
+    def reachable_objects(self, commits, depth=None):
+        """Return every object needed by `commits` and, with `depth`, the shallow boundary.
+
+        With a depth only that many generations of history are followed from each
+        commit; commits whose parents are cut off are returned as the boundary.
+        """
+        objects = set()
+        boundary = set()
+        # Breadth-first, so every commit is first reached at its lowest generation.
+        queue = deque((oid, 1) for oid in commits if oid)
+        while queue:
+            oid, generation = queue.popleft()
+            if oid in objects or not self.exists(oid):
+                continue
+            objects.add(oid)
+            commit = self.read_commit(oid)
+            if depth is not None and generation >= depth:
+                if commit["parents"]:
+                    boundary.add(oid)
+            else:
+                queue.extend((parent, generation + 1) for parent in commit["parents"])
+            tree_id = commit["tree"]
+            if tree_id in objects:
+                continue
+            objects.add(tree_id)
+            for blob_id in self.read_tree(tree_id).values():
+                if blob_id in objects:
+                    continue
+                objects.add(blob_id)
+                if self.object_type(blob_id) == "chunks":
+                    objects.update(self.chunk_ids(blob_id))
+        return objects, boundary
+
+    def exists(self, oid):
+        """Check whether an object is already stored."""
+        return os.path.exists(self._object_path(oid)) or self._find_packed(oid) is not None
+
+    def write(self, obj_type, data):
+        """Store a payload once, keyed by its digest, and return the object id."""
+        oid = self.hash_object(obj_type, data)
+        self._write_loose(oid, obj_type, data)
+        return oid
+
+    def _write_loose(self, oid, obj_type, data):
+        if self.exists(oid):
+            return
+        path = self._object_path(oid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = f"{obj_type} {len(data)}\0".encode()
+        tmp_path = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+        compressed = zlib.compress(header + data)
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, path)
+        trace.count("io.files_opened")
+        trace.count("io.bytes_written", len(compressed))
+
+    def write_raw(self, oid, obj_type, data):
+        """Store an object received from another repository after checking its id.
+
+        A chunked blob's id is the hash of the whole file, so its manifest can only
+        be checked once every chunk it lists is stored.
+        """
+        if obj_type == "chunks":
+            manifest = trace.json_loads(data)
+            digest = hashlib.sha1(f"blob {manifest['size']}\0".encode())
+            for chunk_id in manifest["chunks"]:
+                digest.update(self.read_blob(chunk_id))
+            actual = digest.hexdigest()
+        else:
+            actual = self.hash_object(obj_type, data)
+        if actual != oid:
+            raise Exception(f"Object '{oid}' is corrupt: its content hashes to '{actual}'.")
+        self._write_loose(oid, obj_type, data)
+
+    def write_file(self, path, chunk_size=1 << 20):
+        """Stream a file into the store as a blob, holding at most one chunk in memory.
+
+        Returns the blob id and the stat result of the file that was read.
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_path = os.path.join(self.objects_dir, f"tmp-{os.getpid()}-{threading.get_ident()}")
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            st = os.fstat(src.fileno())
+            header = f"blob {st.st_size}\0".encode()
+            digest = hashlib.sha1(header)
+            compressor = zlib.compressobj()
+            dst.write(compressor.compress(header))
+            remaining = st.st_size
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                remaining -= len(chunk)
+                digest.update(chunk)
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+            trace.count("io.files_opened", 2)
+            trace.count("io.bytes_read", st.st_size)
+            trace.count("io.bytes_written", dst.tell())
+
+        if remaining != 0:
+            os.remove(tmp_path)
+            raise Exception(f"File '{path}' changed while it was being stored.")
+        oid = digest.hexdigest()
+        object_path = self._object_path(oid)
+        if self.exists(oid):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+        return oid, st
+
+    def write_chunked_file(self, path, avg_chunk_size):
+        """Store a large file as content-defined chunks through a memory map.
+
+        Every chunk is an ordinary blob, so chunks shared between versions of a file
+        are stored once. The file itself is recorded under its usual blob id as a
+        "chunks" manifest, which read() reassembles transparently.
+        """
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            trace.count("io.files_opened")
+            trace.count("io.bytes_read", st.st_size)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                size = len(mm)
+                digest = hashlib.sha1(f"blob {size}\0".encode())
+                digest.update(mm)
+                chunks = [
+                    self.write_blob(mm[start:end])
+                    for start, end in chunk_boundaries(mm, avg_chunk_size)
+                ]
+
+        oid = digest.hexdigest()
+        manifest = trace.json_dumps({"size": size, "chunks": chunks}, separators=(",", ":")).encode()
+        self._write_loose(oid, "chunks", manifest)
+        return oid, st
+
+    def chunk_ids(self, oid):
+        """Return the chunk blob ids listed in a chunked blob's manifest."""
+        return trace.json_loads(self.read_raw(oid)[1])["chunks"]
+
+    def read_raw(self, oid):
+        """Return the stored (type, payload) pair, leaving chunked blobs as their manifest."""
+        try:
+            with open(self._object_path(oid), 'rb') as f:
+                compressed = f.read()
+        except FileNotFoundError:
+            # Not loose, or packed and removed by a gc since the check.
+            pack = self._find_packed(oid, expected=True)
+            if pack is None:
+                raise Exception(f"Object '{oid}' not found.")
+            obj_type, base, payload = pack.read_entry(oid)
+            trace.count("io.bytes_read", len(payload))
+            if base is None:
+                return obj_type, payload
+            return obj_type, apply_delta(self.read_raw(base)[1], payload)
+        trace.count("io.files_opened")
+        trace.count("io.bytes_read", len(compressed))
+        header, _, data = zlib.decompress(compressed).partition(b"\0")
+        obj_type, _, size = header.decode().partition(" ")
+        if int(size) != len(data):
+            raise Exception(f"Object '{oid}' is corrupt.")
+        return obj_type, data
+
+    def read(self, oid):
+        """Return the (type, payload) pair stored under an object id."""
+        obj_type, data = self.read_raw(oid)
+        if obj_type == "chunks":
+            return "blob", b"".join(self.stream_blob(oid))
+        return obj_type, data
+
+    def stream_blob(self, oid, chunk_size=1 << 20):
+        """Yield the content of a blob piece by piece without holding all of it in memory."""
+        path = self._object_path(oid)
+        if not os.path.exists(path):
+            # Packed objects are read whole; only chunks of large files end up here one at a time.
+            obj_type, data = self.read_raw(oid)
+            if obj_type == "chunks":
+                for chunk in trace.json_loads(data)["chunks"]:
+                    yield from self.stream_blob(chunk, chunk_size)
+            elif obj_type == "blob":
+                yield data
+            else:
+                raise Exception(f"Object '{oid}' is a {obj_type}, not a blob.")
+            return
+        with open(path, 'rb') as f:
+            trace.count("io.files_opened")
+            decompressor = zlib.decompressobj()
+            head = decompressor.decompress(f.read(64))
+            while b"\0" not in head:
+                more = f.read(chunk_size)
+                if not more:
+                    raise Exception(f"Object '{oid}' is corrupt.")
+                head += decompressor.decompress(more)
+            header, _, data = head.partition(b"\0")
+            obj_type = header.decode().partition(" ")[0]
+            if obj_type == "chunks":
+                manifest = data + decompressor.decompress(f.read()) + decompressor.flush()
+                trace.count("io.bytes_read", f.tell())
+                for chunk in trace.json_loads(manifest)["chunks"]:
+                    yield from self.stream_blob(chunk, chunk_size)
+                return
+            if obj_type != "blob":
+                raise Exception(f"Object '{oid}' is a {obj_type}, not a blob.")
+            if data:
+                yield data
+            trace.count("io.bytes_read", f.tell())
+            for compressed in iter(lambda: f.read(chunk_size), b""):
+                trace.count("io.bytes_read", len(compressed))
+                data = decompressor.decompress(compressed)
+                if data:
+                    yield data
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+
+    def read_text_blob(self, oid, max_size):
+        """Return a blob's content, or None if it is chunked, over `max_size` bytes or binary.
+
+        For indexes that only make sense for text. A loose blob's header and
+        first 8000 bytes are decompressed before anything else, so a large or
+        binary file is turned down without being read.
+        """
+        path = self._object_path(oid)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            obj_type, data = self.read_raw(oid)
+            if obj_type != "blob" or len(data) > max_size or is_binary(data):
+                return None
+            return data
+        with f:
+            trace.count("io.files_opened")
+            decompressor = zlib.decompressobj()
+            head = b""
+            while b"\0" not in head:
+                more = f.read(64)
+                if not more:
+                    raise Exception(f"Object '{oid}' is corrupt.")
+                head += decompressor.decompress(more)
+            header, _, data = head.partition(b"\0")
+            obj_type, _, size = header.decode().partition(" ")
+            if obj_type != "blob" or int(size) > max_size:
+                trace.count("io.bytes_read", f.tell())
+                return None
+            pieces = [data]
+            length = len(data)
+            while length < 8000 and not decompressor.eof:
+                more = f.read(8192)
+                if not more:
+                    break
+                pieces.append(decompressor.decompress(more))
+                length += len(pieces[-1])
+            if is_binary(b"".join(pieces)):
+                trace.count("io.bytes_read", f.tell())
+                return None
+            pieces.append(decompressor.decompress(f.read()))
+            pieces.append(decompressor.flush())
+            trace.count("io.bytes_read", f.tell())
+        return b"".join(pieces)
+
+    def _read_typed(self, oid, expected_type):
+        obj_type, data = self.read(oid)
+        if obj_type != expected_type:
+            raise Exception(f"Object '{oid}' is a {obj_type}, not a {expected_type}.")
+        return data
+
+    def write_blob(self, content):
+        """Store raw file content."""
+        return self.write("blob", content)
+
+    def read_blob(self, oid):
+        """Return raw file content."""
+        return self._read_typed(oid, "blob")
+
+    def write_tree(self, entries):
+        """Store a mapping of file name to blob id."""
+        data = trace.json_dumps(entries, sort_keys=True, separators=(",", ":")).encode()
+        return self.write("tree", data)
+
+    def read_tree(self, oid):
+        """Return the mapping of file name to blob id stored in a tree."""
+        return trace.json_loads(self._read_typed(oid, "tree"))
+
+    def write_commit(self, tree, parents, message, date):
+        """Store a commit pointing at a tree and its parent commits."""
+        commit = {"tree": tree, "parents": parents, "message": message, "date": date}
+        data = trace.json_dumps(commit, sort_keys=True, separators=(",", ":")).encode()
+        return self.write("commit", data)
+
+    def read_commit(self, oid):
+        """Return the commit dict stored under an object id."""
+        return trace.json_loads(self._read_typed(oid, "commit"))
@@ -0,0 +1,444 @@
+import re
+import mmap
+import zlib
+import heapq
+import struct
+import hashlib
+from src.merge import Newest
+
+PACK_SIGNATURE = b"VPAK"
+PACK_VERSION = 1
+INDEX_SIGNATURE = b"VIDX"
+INDEX_VERSION = 1
+TYPE_CODES = {"commit": 1, "tree": 2, "blob": 3, "chunks": 4}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+# Set on the type byte of an entry stored as a delta against another object.
+DELTA_FLAG = 0x80
+# Objects larger than this are always sent whole; delta search is done in Python.
+MAX_DELTA_SIZE = 4 * 1024 * 1024
+
+# Text is split after newlines and commas so both source files and flat JSON trees
+# break into units that repeat between versions.
+_UNIT = re.compile(rb"[^\n,]*[\n,]|[^\n,]+")
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def make_delta(base, target):
+    """Encode `target` as copy and insert instructions against `base`.
+
+    Both are split into lines (and JSON fields); runs of units found in the base
+    become copies of a byte range, everything else is inserted literally.
+    """
+    base_units = _UNIT.findall(base)
+    offsets = []
+    position = 0
+    first_seen = {}
+    for i, unit in enumerate(base_units):
+        offsets.append(position)
+        position += len(unit)
+        first_seen.setdefault(unit, i)
+    offsets.append(position)
+
+    out = [_varint(len(base)), _varint(len(target))]
+    pending = []
+
+    def flush_insert():
+        if pending:
+            data = b"".join(pending)
+            out.append(b"\x00" + _varint(len(data)) + data)
+            pending.clear()
+
+    target_units = _UNIT.findall(target)
+    i = 0
+    next_base = None
+    while i < len(target_units):
+        unit = target_units[i]
+        # Continuing where the last copy ended keeps repeated lines in order.
+        if next_base is not None and next_base < len(base_units) and base_units[next_base] == unit:
+            start = next_base
+        else:
+            start = first_seen.get(unit)
+        if start is None:
+            pending.append(unit)
+            i += 1
+            continue
+        length = 1
+        while i + length < len(target_units) and start + length < len(base_units) \
+                and target_units[i + length] == base_units[start + length]:
+            length += 1
+        size = offsets[start + length] - offsets[start]
+        if size < 8:
+            # A copy instruction would be larger than the bytes it saves.
+            pending.extend(target_units[i:i + length])
+        else:
+            flush_insert()
+            out.append(b"\x01" + _varint(offsets[start]) + _varint(size))
+        next_base = start + length
+        i += length
+    flush_insert()
+    return b"".join(out)
+
+
+def apply_delta(base, delta):
+    """Rebuild the target of make_delta() from its base."""
+    base_size, pos = _read_varint(delta, 0)
+    target_size, pos = _read_varint(delta, pos)
+    if base_size != len(base):
+        raise Exception("Delta does not apply: base object has the wrong size.")
+    out = []
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == 0:
+            size, pos = _read_varint(delta, pos)
+            out.append(delta[pos:pos + size])
+            pos += size
+        elif op == 1:
+            offset, pos = _read_varint(delta, pos)
+            size, pos = _read_varint(delta, pos)
+            out.append(base[offset:offset + size])
+        else:
+            raise Exception("Delta is corrupt.")
+    target = b"".join(out)
+    if len(target) != target_size:
+        raise Exception("Delta is corrupt.")
+    return target
+
+
+def missing_objects(objects, wants, haves, shallow=()):
+    """List the objects reachable from `wants` that a peer holding `haves` lacks.
+
+    Commits are walked newest first from both sets, like merge_base does, and the
+    walk stops once only commits known to the peer remain. The trees of those
+    boundary commits tell which files the peer already has. `shallow` lists
+    the commits of a shallow peer whose parents it does not have, so what the
+    peer holds stops there. Returns
+    (oid, delta base or None) pairs, parents before children, where each base is
+    the previous version of the same path, so it is either known to the peer or
+    sent earlier in the same pack.
+    """
+    WANT, HAVE = 1, 2
+    flags = {}
+    dates = {}
+    queue = []
+
+    def push(oid, flag):
+        if flags.get(oid, 0) & flag or not objects.exists(oid):
+            return
+        flags[oid] = flags.get(oid, 0) | flag
+        if oid not in dates:
+            dates[oid] = objects.read_commit(oid)["date"]
+        heapq.heappush(queue, (Newest(dates[oid]), oid))
+
+    for oid in haves:
+        push(oid, HAVE)
+    for oid in wants:
+        push(oid, WANT)
+
+    commits = []
+    sending = set()
+    while queue and any(not flags[oid] & HAVE for _, oid in queue):
+        _, oid = heapq.heappop(queue)
+        flag = flags[oid]
+        if not flag & HAVE and oid not in sending:
+            commits.append(oid)
+            sending.add(oid)
+        if flag & HAVE and oid in shallow:
+            continue
+        for parent in objects.read_commit(oid)["parents"]:
+            push(parent, HAVE if flag & HAVE else WANT)
+
+    # Files in the trees of commits the peer has need not be sent again.
+    known = set()
+    edges = {
+        parent for oid in commits for parent in objects.read_commit(oid)["parents"]
+        if parent not in sending and objects.exists(parent)
+    }
+    for oid in edges:
+        tree_id = objects.read_commit(oid)["tree"]
+        known.add(tree_id)
+        known.update(objects.read_tree(tree_id).values())
+
+    result = []
+    seen = set(known)
+
+    def emit(oid, base):
+        if oid not in seen:
+            seen.add(oid)
+            result.append((oid, base))
+
+    for oid in _parents_first(objects, commits):
+        commit = objects.read_commit(oid)
+        parent = next((p for p in commit["parents"] if objects.exists(p)), None)
+        parent_tree_id = objects.read_commit(parent)["tree"] if parent else None
+        parent_tree = objects.read_tree(parent_tree_id) if parent_tree_id else {}
+        tree = objects.read_tree(commit["tree"])
+        for path, blob_id in sorted(tree.items()):
+            if blob_id in seen:
+                continue
+            base = parent_tree.get(path)
+            if objects.object_type(blob_id) == "chunks":
+                if base and objects.object_type(base) == "chunks":
+                    # Chunks shared with the previous version are already on the other side.
+                    seen.update(objects.chunk_ids(base))
+                # Chunks go first so the receiver can check the file before storing its manifest.
+                for chunk_id in objects.chunk_ids(blob_id):
+                    emit(chunk_id, None)
+                emit(blob_id, None)
+            else:
+                emit(blob_id, base if base in seen else None)
+        emit(commit["tree"], parent_tree_id if parent_tree_id in seen else None)
+        emit(oid, None)
+    return result
+
+
+def _parents_first(objects, commits):
+    """Order commits so that every parent comes before its children."""
+    pending = set(commits)
+    ordered = []
+    for start in reversed(commits):
+        stack = [(start, False)]
+        while stack:
+            oid, expanded = stack.pop()
+            if expanded:
+                ordered.append(oid)
+                continue
+            if oid not in pending:
+                continue
+            pending.discard(oid)
+            stack.append((oid, True))
+            for parent in objects.read_commit(oid)["parents"]:
+                if parent in pending:
+                    stack.append((parent, False))
+    return ordered
+
+
+class _HashingWriter:
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, out):
+        self.out = out
+        self.digest = hashlib.sha1()
+        self.position = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.out.write(data)
+        self.position += len(data)
+
+
+def write_pack(out, objects, entries, max_depth=None):
+    """Write a pack of `entries`, (oid, base) pairs, to a binary file object.
+
+    Each object is zlib-compressed on its own, whole or as a delta against its
+    base when that is clearly smaller. With `max_depth`, no chain of deltas
+    grows beyond that length; an older version further up the chain is used as
+    the base instead. A SHA-1 of
+    the whole stream ends the pack. Returns (oid, offset, base or None) for
+    every object written, offsets counted from the start of the pack.
+    """
+    writer = _HashingWriter(out)
+    writer.write(PACK_SIGNATURE + struct.pack(">II", PACK_VERSION, len(entries)))
+    written = []
+    depths = {}
+    bases = {}
+    for oid, base in entries:
+        obj_type, data = objects.read_raw(oid)
+        code = TYPE_CODES[obj_type]
+        payload = data
+        header = struct.pack(">B20s", code, bytes.fromhex(oid))
+        if max_depth is not None:
+            # A base at the depth limit is swapped for an older, shallower
+            # version of the same file, which is usually almost as similar.
+            while base is not None and depths.get(base, 0) >= max_depth:
+                base = bases.get(base)
+        if base is not None and obj_type != "chunks" and len(data) <= MAX_DELTA_SIZE:
+            base_type, base_data = objects.read_raw(base)
+            if base_type == obj_type and len(base_data) <= MAX_DELTA_SIZE:
+                delta = make_delta(base_data, data)
+                if len(delta) < len(data) // 2:
+                    payload = delta
+                    header = struct.pack(">B20s20s", code | DELTA_FLAG, bytes.fromhex(oid), bytes.fromhex(base))
+        if payload is data:
+            base = None
+        else:
+            depths[oid] = depths.get(base, 0) + 1
+            bases[oid] = base
+        written.append((oid, writer.position, base))
+        compressed = zlib.compress(payload)
+        writer.write(header + struct.pack(">I", len(compressed)) + compressed)
+    out.write(writer.digest.digest())
+    return written
+
+
+def write_index(path, written, pack_checksum):
+    """Write the index of a pack from write_pack()'s result.
+
+    The index holds a 256-entry fan-out table of cumulative counts by first
+    byte, the sorted object ids, their offsets in the pack, and the pack's
+    checksum, so a lookup is a binary search over a small slice of ids.
+    """
+    entries = sorted((bytes.fromhex(oid), offset) for oid, offset, _ in written)
+    fan_out = [0] * 256
+    for raw_oid, _ in entries:
+        fan_out[raw_oid[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fan_out[i]
+        fan_out[i] = total
+    with open(path, 'wb') as f:
+        f.write(INDEX_SIGNATURE + struct.pack(">II", INDEX_VERSION, len(entries)))
+        f.write(struct.pack(">256I", *fan_out))
+        f.write(b"".join(raw_oid for raw_oid, _ in entries))
+        f.write(b"".join(struct.pack(">Q", offset) for _, offset in entries))
+        f.write(pack_checksum)
+
+
+class PackFile:
+    """A pack on disk and its index, both memory-mapped for random access."""
+
+    def __init__(self, pack_path, index_path):
+        self.pack_path = pack_path
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(pack_path, 'rb') as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.count = struct.unpack(">4sII", self._index[:12])
+        if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+            raise Exception(f"'{index_path}' is not a pack index, or an unsupported version.")
+        self._fan_out = struct.unpack(">256I", self._index[12:12 + 1024])
+        self._ids_start = 12 + 1024
+        self._offsets_start = self._ids_start + 20 * self.count
+        if self._index[-20:] != self._pack[-20:]:
+            raise Exception(f"Pack index '{index_path}' does not match its pack.")
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yield the ids of all objects in the pack, in sorted order."""
+        for i in range(self.count):
+            start = self._ids_start + 20 * i
+            yield self._index[start:start + 20].hex()
+
+    def _find(self, oid):
+        """Return the pack offset of an object, or None, by binary search."""
+        raw_oid = bytes.fromhex(oid)
+        lo = self._fan_out[raw_oid[0] - 1] if raw_oid[0] else 0
+        hi = self._fan_out[raw_oid[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._ids_start + 20 * mid
+            current = self._index[start:start + 20]
+            if current < raw_oid:
+                lo = mid + 1
+            elif current > raw_oid:
+                hi = mid
+            else:
+                start = self._offsets_start + 8 * mid
+                return struct.unpack(">Q", self._index[start:start + 8])[0]
+        return None
+
+    def __contains__(self, oid):
+        return self._find(oid) is not None
+
+    def entry_type(self, oid):
+        """Return an object's type from its entry header, or None if it is not in the pack."""
+        offset = self._find(oid)
+        if offset is None:
+            return None
+        return TYPE_NAMES[self._pack[offset] & ~DELTA_FLAG]
+
+    def read_entry(self, oid):
+        """Return (type, delta base or None, payload) for an object, or None if absent.
+
+        For a delta the payload still has to be applied to the base object.
+        """
+        offset = self._find(oid)
+        if offset is None:
+            return None
+        code = self._pack[offset]
+        position = offset + 21
+        base = None
+        if code & DELTA_FLAG:
+            base = self._pack[position:position + 20].hex()
+            position += 20
+        (size,) = struct.unpack(">I", self._pack[position:position + 4])
+        position += 4
+        payload = zlib.decompress(self._pack[position:position + size])
+        return TYPE_NAMES[code & ~DELTA_FLAG], base, payload
+
+    def close(self):
+        """Release the memory maps."""
+        self._index.close()
+        self._pack.close()
+
+
+class _HashingReader:
+    """Reads exact byte counts from a stream while hashing them."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha1()
+
+    def read(self, size, hashed=True):
+        chunks = []
+        while size:
+            chunk = self.stream.read(size)
+            if not chunk:
+                raise Exception("Pack stream ended unexpectedly.")
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b"".join(chunks)
+        if hashed:
+            self.digest.update(data)
+        return data
+
+
+def read_pack(stream, resolve_base):
+    """Yield the (oid, type, payload) objects of a pack read from a binary stream.
+
+    Delta bases are looked up with resolve_base(oid) -> (type, payload), which
+    must also find objects yielded earlier; readers store each object before
+    asking for the next. The trailing checksum is verified after the last object.
+    """
+    reader = _HashingReader(stream)
+    signature, version, count = struct.unpack(">4sII", reader.read(12))
+    if signature != PACK_SIGNATURE or version != PACK_VERSION:
+        raise Exception("Not a pack stream, or an unsupported pack version.")
+    for _ in range(count):
+        code, raw_oid = struct.unpack(">B20s", reader.read(21))
+        base = reader.read(20).hex() if code & DELTA_FLAG else None
+        (size,) = struct.unpack(">I", reader.read(4))
+        obj_type = TYPE_NAMES.get(code & ~DELTA_FLAG)
+        if obj_type is None:
+            raise Exception("Pack stream is corrupt.")
+        data = zlib.decompress(reader.read(size))
+        if base is not None:
+            data = apply_delta(resolve_base(base)[1], data)
+        yield raw_oid.hex(), obj_type, data
+    if reader.read(20, hashed=False) != reader.digest.digest():
+        raise Exception("Pack stream checksum mismatch.")
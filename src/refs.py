@@ -0,0 +1,99 @@
+import os
+import time
+
+ANY = object()
+MISSING = object()
+
+
+class Refs:
+    """Branch pointers stored as one small file per branch under .vcs/refs/heads.
+
+    Each file holds the id of the commit the branch points at, or nothing for a
+    branch that has no commits yet. Creating or moving a branch touches only its
+    own file. Updates are compare-and-swap: a writer holds <branch>.lock, created
+    exclusively, while it checks the old value and renames the new one into place.
+    Remote-tracking branches use the same layout under refs/remotes/<remote>.
+    """
+
+    def __init__(self, repo_dir, namespace="heads"):
+        self.heads_dir = os.path.join(repo_dir, "refs", *namespace.split("/"))
+
+    @staticmethod
+    def check_name(name):
+        """Reject branch names that would escape the refs directory or be ambiguous."""
+        parts = name.split("/")
+        if not name or name.endswith((".tmp", ".lock")) or any(part in ("", ".", "..") for part in parts) \
+                or any(c in name for c in " \\\t\n:*?[~^"):
+            raise Exception(f"'{name}' is not a valid branch name.")
+
+    def _path(self, name):
+        return os.path.join(self.heads_dir, *name.split("/"))
+
+    def exists(self, name):
+        """Check whether a branch exists."""
+        return os.path.isfile(self._path(name))
+
+    def read(self, name):
+        """Return the commit id a branch points at, or None for a branch without commits."""
+        try:
+            with open(self._path(name), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            raise Exception(f"Branch '{name}' does not exist.")
+
+    def _current(self, path):
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return MISSING
+
+    def update(self, name, commit_id, expected=ANY, timeout=2.0):
+        """Point a branch at a commit if it still points at `expected`.
+
+        `expected` is a commit id, None for a branch without commits, MISSING for
+        a branch that must not exist yet, or ANY to skip the check.
+        """
+        self.check_name(name)
+        path = self._path(name)
+        lock_path = f"{path}.lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if time.monotonic() >= deadline:
+                    raise Exception(
+                        f"Branch '{name}' is locked by another update. "
+                        f"If no other vcs process is running, remove '{lock_path}'."
+                    )
+                time.sleep(0.01)
+        try:
+            try:
+                current = self._current(path)
+                if expected is not ANY and current != expected:
+                    raise Exception(f"Branch '{name}' was changed by another process; retry the operation.")
+                os.write(fd, (commit_id or "").encode())
+            finally:
+                os.close(fd)
+        except BaseException:
+            os.remove(lock_path)
+            raise
+        # Renaming the lock file over the ref publishes the new value and releases the lock.
+        os.replace(lock_path, path)
+
+    def write(self, name, commit_id):
+        """Point a branch at a commit, creating the branch if needed."""
+        self.update(name, commit_id)
+
+    def names(self):
+        """Return all branch names, sorted."""
+        names = []
+        for dir_path, _, files in os.walk(self.heads_dir):
+            rel_dir = os.path.relpath(dir_path, self.heads_dir).replace(os.sep, "/")
+            for file_name in files:
+                if not file_name.endswith((".tmp", ".lock")):
+                    names.append(file_name if rel_dir == "." else f"{rel_dir}/{file_name}")
+        return sorted(names)
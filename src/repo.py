@@ -1,8 +1,77 @@
 import os
+import re
+import heapq
+import glob
 import json
+import tempfile
+import functools
+import inspect
+from contextlib import contextmanager
 from datetime import datetime
-from shutil import copytree, rmtree
-from difflib import unified_diff
+from shutil import copyfile, copytree, rmtree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.objects import ObjectStore, check_tree_path
+from src.journal import CommitLog
+from src.index import Index
+from src.refs import Refs, MISSING
+from src.lock import RepositoryLock
+from src.state import StateCache
+from src.ignore import IgnoreMatcher
+from src.commitgraph import CommitGraph
+from src.blame import BlameCache
+from src.search import TrigramIndex
+from src.merge import merge_base, merge_lines, is_binary, is_ancestor, Newest
+from src.diff import unified_diff, count_changes, detect_renames
+from src.pack import missing_objects, write_pack, write_index, read_pack
+from src.transport import open_transport, make_server
+from src import trace
+
+DEFAULT_CONFIG = {
+    # Files at least this many bytes are stored as content-defined chunks via mmap.
+    "large_file_threshold": 16 * 1024 * 1024,
+    # Target average chunk size for large files.
+    "chunk_size": 1024 * 1024,
+    # Seconds a writer waits for another process to release the repository lock.
+    "lock_timeout": 10,
+    # Longest chain of deltas gc builds; reading an object applies at most this many.
+    "max_delta_depth": 10,
+}
+
+# Date of the commits that carry the files of branches from before commits existed.
+IMPORT_DATE = "1970-01-01 00:00:00"
+# Commits offered to a remote per negotiation round, and in total before giving up.
+NEGOTIATION_ROUND = 32
+MAX_HAVES = 256
+
+def _traced(method):
+    """Time a Repository method as a trace span named after it.
+
+    A generator's span covers its whole iteration, including the time the
+    caller spends between items.
+    """
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            with trace.span(method.__name__):
+                yield from method(self, *args, **kwargs)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with trace.span(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _batched(method):
+    """Run a Repository method inside batch() so its metadata is written once at the end.
+
+    The method is also timed as a trace span, lock wait included.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with trace.span(method.__name__), self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class Repository:
     def __init__(self, name):
@@ -13,188 +82,1517 @@ class Repository:
         self.branch_file = os.path.join(self.repo_dir, "branches.json")
         self.active_branch_file = os.path.join(self.repo_dir, "active_branch.txt")
         self.ignore_file = os.path.join(self.repo_dir, ".vcsignore")
+        self.config_file = os.path.join(self.repo_dir, "config.json")
+        self.index_file = os.path.join(self.repo_dir, "index")
+        self.merge_head_file = os.path.join(self.repo_dir, "MERGE_HEAD")
+        self.shallow_file = os.path.join(self.repo_dir, "shallow")
+        self.remotes_file = os.path.join(self.repo_dir, "remotes.json")
+        self.objects = ObjectStore(self.repo_dir)
+        self.log = CommitLog(self.repo_dir)
+        self.refs = Refs(self.repo_dir)
+        self.commit_graph = CommitGraph(self.repo_dir, self.objects)
+        self.blame_cache = BlameCache(self.repo_dir, self.objects, self.commit_graph)
+        self.search_index = TrigramIndex(self.repo_dir, self.objects)
+        self.state = StateCache()
+        self._batch_depth = 0
         self._load_ignore_list()
+        if os.path.exists(self.branch_file):
+            self._migrate_branch_file()
 
     def _load_ignore_list(self):
-        """Load files that should be ignored from .vcsignore."""
+        """Load the repository-wide ignore patterns from .vcs/.vcsignore, in order."""
         if os.path.exists(self.ignore_file):
             with open(self.ignore_file, 'r') as f:
-                self.ignore_list = set(f.read().splitlines())
+                self.ignore_list = [line for line in f.read().splitlines() if line]
         else:
-            self.ignore_list = set()
+            self.ignore_list = []
+
+    @contextmanager
+    def batch(self):
+        """Group operations so cached metadata is written once, when the outermost batch ends.
+
+        Every public operation that modifies the repository runs in its own batch.
+        The outermost batch holds the repository lock, so concurrent writers take
+        turns while readers such as diff and log never wait. A caller running
+        many operations back to back can wrap them in one batch to parse and
+        write the index and settings only once. If an operation fails, unsaved
+        changes are dropped and the cache is reloaded from disk.
+        """
+        lock = None
+        if self._batch_depth == 0:
+            lock = RepositoryLock(self.repo_dir, self._load_config()["lock_timeout"])
+            with trace.span("lock"):
+                lock.acquire()
+        self._batch_depth += 1
+        try:
+            yield self
+            if self._batch_depth == 1:
+                self.flush()
+        except BaseException:
+            if self._batch_depth == 1:
+                self.state.clear()
+            raise
+        finally:
+            self._batch_depth -= 1
+            if lock is not None:
+                lock.release()
+
+    def flush(self):
+        """Write all modified metadata, each file replaced atomically."""
+        with trace.span("flush"):
+            self.state.flush()
 
     def _get_active_branch(self):
         """Retrieve the currently active branch."""
-        if os.path.exists(self.active_branch_file):
-            with open(self.active_branch_file, 'r') as f:
-                return f.read().strip()
-        return "main"
+        def load(path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return f.read().strip()
+            return "main"
+        return self.state.get(self.active_branch_file, load)
 
     def _set_active_branch(self, branch_name):
         """Set the active branch."""
-        with open(self.active_branch_file, 'w') as f:
-            f.write(branch_name)
+        self.state.put(self.active_branch_file, branch_name, str)
+
+    def _load_stored_config(self):
+        """Return the settings saved in config.json, without defaults."""
+        def load(path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return json.load(f)
+            return {}
+        return self.state.get(self.config_file, load)
+
+    def _load_config(self):
+        """Return the repository settings, falling back to defaults for unset keys."""
+        config = dict(DEFAULT_CONFIG)
+        config.update(self._load_stored_config())
+        return config
+
+    @_batched
+    def set_config(self, key, value):
+        """Change a repository setting."""
+        if key not in DEFAULT_CONFIG:
+            raise Exception(f"Unknown setting '{key}'. Known settings: {', '.join(DEFAULT_CONFIG)}.")
+        try:
+            value = int(value)
+        except ValueError:
+            raise Exception(f"Setting '{key}' must be an integer.")
+        if value <= 0:
+            raise Exception(f"Setting '{key}' must be positive.")
+        config = dict(self._load_stored_config())
+        config[key] = value
+        self.state.put(self.config_file, config, lambda c: json.dumps(c, indent=4))
+
+    def _migrate_branch_file(self):
+        """Move branches.json into one ref file per branch, once.
+
+        The oldest layout embedded every committed file's content in the branch
+        list; such branches are first converted into a single import commit.
+        """
+        with open(self.branch_file, 'r') as f:
+            branches = json.load(f)
+        imported = {}
+        trees = {}
+        for branch_name, head in branches.items():
+            if isinstance(head, list) and head:
+                tree = {}
+                for entry in head:
+                    tree[entry["file"]] = self.objects.write_blob(entry["content"].encode())
+                tree_id = self.objects.write_tree(tree)
+                # Branches copied from one another share an identical import commit.
+                if tree_id not in imported:
+                    imported[tree_id] = self.objects.write_commit(
+                        tree_id, [], "Import legacy branch contents", IMPORT_DATE
+                    )
+                    trees[tree_id] = tree
+                head = imported[tree_id]
+            self.refs.write(branch_name, head or None)
+        if imported:
+            self._migrate_legacy_history()
+            # Marked as received: like fetched commits, they are older than the entries before them.
+            self.log.extend(
+                {"commit": oid, "message": "Import legacy branch contents", "date": IMPORT_DATE,
+                 "files": sorted(trees[tree_id]), "received": True}
+                for tree_id, oid in imported.items()
+            )
+        os.remove(self.branch_file)
+
+    def _migrate_legacy_history(self):
+        """Move a history.json array into the append-only commit log, once."""
+        if os.path.exists(self.history_file):
+            self.log.migrate_from(self.history_file)
+        elif not self.log.exists():
+            self.log.create()
+
+    def _head_commit(self):
+        """Return the commit the active branch points at, or None before its first commit."""
+        branch = self._get_active_branch()
+        return self.refs.read(branch) if self.refs.exists(branch) else None
+
+    def _read_commit_tree(self, commit_id):
+        """Return the file -> blob id mapping of a commit, or an empty tree for None."""
+        if commit_id is None:
+            return {}
+        return self.objects.read_tree(self.objects.read_commit(commit_id)["tree"])
 
+    def _load_index(self):
+        """Return the cached working-tree index, building it from HEAD and staged.json if missing."""
+        if not os.path.exists(self.index_file):
+            index = Index(self.repo_dir)
+            index.seed(self._read_commit_tree(self._head_commit()))
+            if os.path.exists(self.stage_file):
+                with open(self.stage_file, 'r') as f:
+                    for file_name in json.load(f):
+                        index.stage(file_name)
+            index.save()
+            if os.path.exists(self.stage_file):
+                os.remove(self.stage_file)
+        return self.state.get(self.index_file, lambda path: Index(self.repo_dir).load())
+
+    def _save_index(self, index):
+        """Mark the index as modified; it is written when the current batch ends."""
+        self.state.put(self.index_file, index, Index.serialize)
+
+    @staticmethod
+    def _normalize_path(file_name):
+        """Paths are stored relative to the repository root with forward slashes."""
+        return os.path.normpath(file_name).replace(os.sep, "/")
+
+    def _repo_path(self, file_name):
+        """Normalise a path given by the user to one relative to the repository root.
+
+        Raises if it leads outside the working tree or into .vcs.
+        """
+        if os.path.isabs(file_name):
+            file_name = os.path.relpath(file_name, self.name)
+        path = self._normalize_path(file_name)
+        if path == ".." or path.startswith("../"):
+            raise Exception(f"Path '{file_name}' is outside the repository.")
+        if path == ".vcs" or path.startswith(".vcs/"):
+            raise Exception(f"Path '{file_name}' is inside the repository's .vcs directory.")
+        return path
+
+    def _ignore_matcher(self):
+        """Return a matcher for .vcsignore rules; keep it for one operation so lookups are memoised."""
+        self._load_ignore_list()
+        return IgnoreMatcher(self.name, self.ignore_list)
+
+    def _walk_files(self, start="", matcher=None):
+        """Yield (path, stat) for every file below `start` in the working tree outside .vcs.
+
+        Ignored directories are pruned without being listed.
+        """
+        matcher = matcher or self._ignore_matcher()
+        if start and matcher.is_dir_ignored(start):
+            return
+        stack = [start]
+        while stack:
+            rel_dir = stack.pop()
+            with os.scandir(os.path.join(self.name, rel_dir)) as it:
+                for entry in it:
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    if rel_path == ".vcs":
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if not matcher.is_dir_ignored(rel_path):
+                            stack.append(rel_path)
+                    elif entry.is_file(follow_symlinks=False) and not matcher.is_ignored(rel_path):
+                        yield rel_path, entry.stat(follow_symlinks=False)
+
+    @_traced
     def create_repo(self):
         """Initialize the repository in a directory."""
         if not os.path.exists(self.repo_dir):
             os.makedirs(self.repo_dir)
-            with open(self.history_file, 'w') as f:
-                json.dump([], f)
-            with open(self.stage_file, 'w') as f:
-                json.dump([], f)
-            with open(self.branch_file, 'w') as f:
-                json.dump({"main": []}, f)
+            self.log.create()
+            Index(self.repo_dir).save()
+            self.refs.write("main", None)
+            os.makedirs(self.objects.objects_dir)
             open(self.active_branch_file, 'w').write("main")
             open(self.ignore_file, 'w').close()  # Create an empty .vcsignore
         else:
             raise Exception("Repository already exists!")
 
-    def add(self, file_name):
-        """Stage a file for commit."""
-        file_path = os.path.join(self.name, file_name)
-        if not os.path.exists(file_path):
-            raise Exception(f"File '{file_name}' not found in repository directory.")
-        
-        with open(self.stage_file, 'r+') as f:
-            staged = json.load(f)
-            if file_name not in staged:
-                staged.append(file_name)
-            f.seek(0)
-            json.dump(staged, f, indent=4)
+    @_batched
+    def add(self, *file_names, stage_all=False):
+        """Stage files, directories or glob patterns for commit in a single index update.
+
+        Files named explicitly are always staged. Files reached through a directory,
+        a pattern or `stage_all` are staged only when new or changed, and tracked
+        files that have disappeared below them are staged for removal. Paths
+        that conflict in the merge in progress count as tracked, so a conflict
+        where one side deleted the file can be resolved by staging its removal.
+        Returns the list of staged paths.
+        """
+        index = self._load_index()
+        merge_head = self._read_merge_head()
+        conflicts = set(merge_head.get("conflicts", [])) if merge_head else set()
+        matcher = self._ignore_matcher()
+        explicit = {}
+        walked = {}
+        scopes = []
+        removed = []
+
+        for file_name in file_names:
+            path = self._repo_path(file_name)
+            file_path = os.path.join(self.name, path)
+            if os.path.isfile(file_path):
+                explicit[path] = os.stat(file_path)
+            elif os.path.isdir(file_path):
+                start = "" if path == "." else path
+                walked.update(self._walk_files(start, matcher))
+                scopes.append(f"{start}/" if start else "")
+            elif glob.has_magic(file_name):
+                matches = glob.glob(os.path.join(glob.escape(self.name), path), recursive=True)
+                for match in matches:
+                    rel_path = self._normalize_path(os.path.relpath(match, self.name))
+                    if rel_path == ".vcs" or rel_path.startswith(".vcs/") \
+                            or matcher.is_ignored(rel_path, os.path.isdir(match)):
+                        continue
+                    if os.path.isdir(match):
+                        walked.update(self._walk_files(rel_path, matcher))
+                    elif os.path.isfile(match):
+                        walked[rel_path] = os.stat(match)
+                if not matches:
+                    raise Exception(f"Pattern '{file_name}' did not match any files.")
+            elif path in index.entries or path in conflicts:
+                removed.append(path)
+            else:
+                raise Exception(f"File '{file_name}' not found in repository directory.")
+
+        if stage_all:
+            walked.update(self._walk_files(matcher=matcher))
+            scopes.append("")
+
+        for scope in scopes:
+            for path in list(index.entries) + sorted(conflicts):
+                if path.startswith(scope) and path not in walked and path not in explicit:
+                    if not os.path.exists(os.path.join(self.name, path)):
+                        removed.append(path)
+
+        candidates = dict(walked)
+        candidates.update(explicit)
+        stale = [path for path, st in candidates.items() if not index.is_fresh(path, st)]
+        with ThreadPoolExecutor() as pool:
+            hashes = dict(zip(stale, pool.map(
+                self.objects.hash_file, [os.path.join(self.name, path) for path in stale]
+            )))
+
+        staged = []
+        for path, st in candidates.items():
+            if path not in hashes:
+                if path in explicit:
+                    staged.append(path)
+                continue
+            entry = index.entries.get(path)
+            index.update(path, st, hashes[path])
+            if path in explicit or entry is None or entry[3] != hashes[path]:
+                staged.append(path)
+        staged.extend(dict.fromkeys(removed))
+
+        for path in staged:
+            index.stage(path)
+        self._save_index(index)
+        self._resolve_conflicts(staged)
+        return staged
+
+    def _read_merge_head(self):
+        """Return the merge in progress ({"commit", "message", "conflicts", "paths"}), or None."""
+        if not os.path.exists(self.merge_head_file):
+            return None
+        with open(self.merge_head_file, 'r') as f:
+            return json.load(f)
 
+    def _resolve_conflicts(self, paths):
+        """Mark conflicted paths of the merge in progress as resolved once they are staged again."""
+        merge_head = self._read_merge_head()
+        if merge_head is None:
+            return
+        conflicts = merge_head.get("conflicts", [])
+        remaining = [path for path in conflicts if path not in paths]
+        if remaining != conflicts:
+            merge_head["conflicts"] = remaining
+            with open(self.merge_head_file, 'w') as f:
+                json.dump(merge_head, f)
+
+    @_batched
     def commit(self, message):
         """Commit the staged files with a message."""
-        with open(self.stage_file, 'r') as f:
-            staged = json.load(f)
+        index = self._load_index()
+        staged = list(index.staged)
 
         if not staged:
             raise Exception("No files staged for commit.")
+        merge_head = self._read_merge_head()
+        if merge_head and merge_head.get("conflicts"):
+            raise Exception(
+                f"Unresolved merge conflicts in: {', '.join(merge_head['conflicts'])}. "
+                "Fix them and add the files before committing."
+            )
+
+        current_branch = self._get_active_branch()
+        parent = self._head_commit()
+        tree = self._read_commit_tree(parent)
+
+        present = []
+        for file_name in staged:
+            if os.path.exists(os.path.join(self.name, file_name)):
+                present.append(file_name)
+            else:
+                # A staged path that no longer exists is a staged removal.
+                tree.pop(file_name, None)
+                index.entries.pop(file_name, None)
+        with trace.span("store_files", files=len(present)):
+            for file_name, (oid, st) in self._store_files(present):
+                tree[file_name] = oid
+                index.update(file_name, st, oid)
+
+        parents = [parent] if parent else []
+        if merge_head:
+            parents.append(merge_head["commit"])
 
-        with open(self.history_file, 'r+') as f:
-            history = json.load(f)
-            commit = {
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        commit_id = self.objects.write_commit(self.objects.write_tree(tree), parents, message, date)
+        self.refs.update(current_branch, commit_id, expected=parent)
+        if os.path.exists(self.merge_head_file):
+            os.remove(self.merge_head_file)
+
+        self._migrate_legacy_history()
+        with trace.span("log_append"):
+            self.log.append({
+                "commit": commit_id,
                 "message": message,
-                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "date": date,
                 "files": staged,
-            }
-            history.append(commit)
-            f.seek(0)
-            json.dump(history, f, indent=4)
+            })
+        index.clear_staged()
+        self._save_index(index)
+        # The commit is complete once it is logged; indexing it comes after.
+        self.flush()
+        self._index_new_commits()
 
-        current_branch = self._get_active_branch()
-        with open(self.branch_file, 'r+') as f:
-            branches = json.load(f)
-            if current_branch not in branches:
-                branches[current_branch] = []
+    @_traced
+    def status(self):
+        """Report staged, modified, deleted and new files using the stat cache.
+
+        Only files whose stat data no longer matches the index are read and rehashed.
+        Status never waits for the repository lock; see _save_refreshed_index.
+        """
+        index = self._load_index()
+        modified, new, deleted = [], [], []
 
-            for file_name in staged:
-                file_path = os.path.join(self.name, file_name)
-                with open(file_path, 'r') as file:
-                    content = file.read()
-                branches[current_branch].append({"file": file_name, "content": content})
+        def check(path, st):
+            if not index.is_fresh(path, st):
+                oid = self.objects.hash_file(os.path.join(self.name, path))
+                if oid == index.entries[path][3]:
+                    index.update(path, st, oid)
+                else:
+                    modified.append(path)
 
-            f.seek(0)
-            json.dump(branches, f, indent=4)
+        seen = set()
+        for path, st in self._walk_files():
+            seen.add(path)
+            if path in index.entries:
+                check(path, st)
+            else:
+                new.append(path)
+        # Tracked files stay tracked even when they match an ignore rule, so
+        # anything the walk skipped is looked up directly.
+        for path in index.entries:
+            if path in seen:
+                continue
+            try:
+                check(path, os.stat(os.path.join(self.name, path)))
+            except FileNotFoundError:
+                deleted.append(path)
+        if index.dirty:
+            self._save_refreshed_index(index)
+        merge_head = self._read_merge_head()
+        return {
+            "conflicts": sorted(merge_head.get("conflicts", [])) if merge_head else [],
+            "staged": sorted(index.staged),
+            "modified": sorted(modified),
+            "deleted": sorted(deleted),
+            "new": sorted(new),
+        }
 
-        with open(self.stage_file, 'w') as f:
-            json.dump([], f)
+    def _save_refreshed_index(self, index):
+        """Save stat data refreshed by a reader, if that can be done without waiting.
 
+        The index is written only when the lock is free at once and no writer
+        replaced the index file since it was read; otherwise the refreshed
+        entries stay in memory and the next reader rehashes the same files.
+        """
+        if self._batch_depth:
+            self._save_index(index)
+            return
+        lock = RepositoryLock(self.repo_dir)
+        if not lock.try_acquire():
+            return
+        try:
+            if self.state.is_current(self.index_file):
+                self._save_index(index)
+                self.flush()
+        finally:
+            lock.release()
+
+    def _store_files(self, paths):
+        """Stream files into the object store on a thread pool, yielding results as they finish.
+
+        Each worker hashes and compresses one file chunk by chunk, so peak memory
+        depends on the number of workers rather than on the size of the commit.
+        Files above the large_file_threshold setting are split into
+        content-defined chunks instead.
+        """
+        config = self._load_config()
+
+        def store(path):
+            file_path = os.path.join(self.name, path)
+            if os.path.getsize(file_path) >= config["large_file_threshold"]:
+                return self.objects.write_chunked_file(file_path, config["chunk_size"])
+            return self.objects.write_file(file_path)
+
+        with ThreadPoolExecutor() as pool:
+            futures = {pool.submit(store, path): path for path in paths}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    @_batched
     def create_branch(self, branch_name):
-        """Create a new branch."""
-        with open(self.branch_file, 'r+') as f:
-            branches = json.load(f)
-            if branch_name in branches:
-                raise Exception(f"Branch '{branch_name}' already exists.")
-            
-            current_branch = self._get_active_branch()
-            if current_branch not in branches:
-                raise Exception(f"Current branch '{current_branch}' not found.")
+        """Create a new branch pointing at the current branch's commit."""
+        if self.refs.exists(branch_name):
+            raise Exception(f"Branch '{branch_name}' already exists.")
+
+        current_branch = self._get_active_branch()
+        if not self.refs.exists(current_branch):
+            raise Exception(f"Current branch '{current_branch}' not found.")
 
-            branches[branch_name] = branches[current_branch].copy()
-            f.seek(0)
-            json.dump(branches, f, indent=4)
+        self.refs.update(branch_name, self.refs.read(current_branch), expected=MISSING)
 
+    @_batched
     def switch_branch(self, branch_name):
-        """Switch to a different branch."""
-        with open(self.branch_file, 'r') as f:
-            branches = json.load(f)
-            if branch_name not in branches:
-                raise Exception(f"Branch '{branch_name}' does not exist.")
-        
+        """Switch to a different branch and check out its files.
+
+        Only files whose blob ids differ between the two branches are rewritten.
+        Files that were modified locally, or untracked files in the way, stop the
+        switch before anything is changed.
+        """
+        if not self.refs.exists(branch_name):
+            raise Exception(f"Branch '{branch_name}' does not exist.")
+
+        index = self._load_index()
+        self._checkout(
+            self._read_commit_tree(self._head_commit()),
+            self._read_commit_tree(self.refs.read(branch_name)),
+            index,
+            "checkout",
+        )
         self._set_active_branch(branch_name)
+        self._save_index(index)
 
-    def diff(self, branch_name):
-        """Show a diff between the current branch and another branch."""
-        with open(self.branch_file, 'r') as f:
-            branches = json.load(f)
+    def _checkout(self, old_tree, new_tree, index, operation):
+        """Update the working tree and index from one tree to another.
+
+        Paths with the same blob id in both trees are skipped without touching
+        the disk. Paths that do change must match the old tree, or already match
+        the new one, and must not be staged, or the whole operation is refused.
+        """
+        changes = {
+            path: new_tree.get(path)
+            for path in set(old_tree) | set(new_tree)
+            if old_tree.get(path) != new_tree.get(path)
+        }
+        for path in changes:
+            check_tree_path(path)
+        blocked = [
+            path for path, oid in changes.items()
+            if path in index.staged or not (
+                self._worktree_matches(path, old_tree.get(path), index)
+                or self._worktree_matches(path, oid, index)
+            )
+        ]
+        if blocked:
+            raise Exception(
+                f"Your local changes to {', '.join(sorted(blocked))} would be overwritten by {operation}. "
+                "Commit them first."
+            )
+        with trace.span("checkout", files=len(changes)):
+            for path, oid in changes.items():
+                if self._worktree_matches(path, oid, index):
+                    if oid is not None:
+                        index.update(path, os.stat(os.path.join(self.name, path)), oid)
+                    continue
+                self._write_worktree_file(path, oid, index)
+                if oid is None:
+                    self._remove_empty_dirs(path)
+
+    def _remove_empty_dirs(self, path):
+        """Remove directories left empty after deleting `path`."""
+        parent = os.path.dirname(path)
+        while parent:
+            try:
+                os.rmdir(os.path.join(self.name, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
 
-        if branch_name not in branches:
+    @_traced
+    def diff(self, branch_name, mode="patch"):
+        """Show a diff between the current branch and another branch.
+
+        `mode` is "patch" for line diffs, "stat" for per-file line counts or
+        "name-only" for just the changed paths. Files are compared by blob id
+        first, so unchanged files are never read, and "name-only" reads no
+        content at all. Removed and added files with identical or similar
+        content are reported as renames.
+        """
+        if mode not in ("patch", "stat", "name-only"):
+            raise Exception(f"Unknown diff mode '{mode}'.")
+        if not self.refs.exists(branch_name):
             raise Exception(f"Branch '{branch_name}' does not exist.")
         
         current_branch = self._get_active_branch()
-        current_files = {file["file"]: file["content"] for file in branches[current_branch]}
-        branch_files = {file["file"]: file["content"] for file in branches[branch_name]}
+        current_files = self._read_commit_tree(self._head_commit())
+        branch_files = self._read_commit_tree(self.refs.read(branch_name))
+
+        added = {f: branch_files[f] for f in branch_files if f not in current_files}
+        removed = {f: current_files[f] for f in current_files if f not in branch_files}
+        changed = sorted(f for f in current_files if f in branch_files and current_files[f] != branch_files[f])
 
-        added_files = set(branch_files) - set(current_files)
-        removed_files = set(current_files) - set(branch_files)
-        common_files = set(current_files) & set(branch_files)
+        with trace.span("detect_renames", added=len(added), removed=len(removed)):
+            if mode == "name-only":
+                renames = detect_renames(removed, added, None, max_candidates=0)
+            else:
+                renames = detect_renames(removed, added, self._read_lines)
+        for old, new, _ in renames:
+            del removed[old]
+            del added[new]
+        # (old path, new path) pairs whose content needs comparing, renames included.
+        pairs = [(f, f) for f in changed] + [(old, new) for old, new, score in renames if score < 1.0]
+
+        if mode == "name-only":
+            names = set(added) | set(removed) | set(changed) | {new for _, new, _ in renames}
+            return "\n".join(sorted(names)) if names else "No differences."
 
         diff_output = []
-        if added_files:
-            diff_output.append(f"Files added in {branch_name}: {', '.join(added_files)}")
-        if removed_files:
-            diff_output.append(f"Files removed in {branch_name}: {', '.join(removed_files)}")
-        for file in common_files:
-            if current_files[file] != branch_files[file]:
+        if added:
+            diff_output.append(f"Files added in {branch_name}: {', '.join(sorted(added))}")
+        if removed:
+            diff_output.append(f"Files removed in {branch_name}: {', '.join(sorted(removed))}")
+        for old, new, score in renames:
+            diff_output.append(f"File renamed in {branch_name}: {old} -> {new} ({round(score * 100)}% similar)")
+
+        total_inserted = total_deleted = 0
+        with trace.span("compare_files", files=len(pairs)):
+            for old, new in pairs:
+                current_data = self.objects.read_blob(current_files[old])
+                branch_data = self.objects.read_blob(branch_files[new])
+                label = old if old == new else f"{old} -> {new}"
+                if is_binary(current_data) or is_binary(branch_data):
+                    diff_output.append(f"Binary file {label} differs" if mode == "patch" else f" {label} | Bin")
+                    continue
+                current_lines = current_data.decode(errors="replace").splitlines()
+                branch_lines = branch_data.decode(errors="replace").splitlines()
+                if mode == "stat":
+                    inserted, deleted = count_changes(current_lines, branch_lines)
+                    total_inserted += inserted
+                    total_deleted += deleted
+                    diff_output.append(f" {label} | {inserted + deleted} {'+' * inserted}{'-' * deleted}")
+                    continue
                 diff = "\n".join(unified_diff(
-                    current_files[file].splitlines(),
-                    branch_files[file].splitlines(),
-                    fromfile=f"{file} ({current_branch})",
-                    tofile=f"{file} ({branch_name})",
-                    lineterm=''
+                    current_lines,
+                    branch_lines,
+                    fromfile=f"{old} ({current_branch})",
+                    tofile=f"{new} ({branch_name})",
                 ))
-                diff_output.append(f"Changes in {file}:\n{diff}")
-        
+                diff_output.append(f"Changes in {label}:\n{diff}")
+
+        if mode == "stat" and pairs:
+            diff_output.append(
+                f" {len(pairs)} file(s) changed, {total_inserted} insertion(s)(+), {total_deleted} deletion(s)(-)"
+            )
         return "\n".join(diff_output) if diff_output else "No differences."
 
-    def ignore(self, file_name):
-        """Add a file to the ignore list."""
-        if file_name not in self.ignore_list:
-            self.ignore_list.add(file_name)
+    def _read_lines(self, oid):
+        """Return the lines of a stored blob, decoded leniently."""
+        return self.objects.read_blob(oid).decode(errors="replace").splitlines()
+
+    def ignore(self, pattern):
+        """Add a file name or .gitignore-style pattern to the repository-wide ignore list."""
+        self._load_ignore_list()
+        if pattern not in self.ignore_list:
+            self.ignore_list.append(pattern)
             with open(self.ignore_file, 'a') as f:
-                f.write(f"{file_name}\n")
+                f.write(f"{pattern}\n")
 
     def view_ignore_list(self):
-        """Return the list of ignored files."""
+        """Return the repository-wide ignore patterns, in order."""
+        self._load_ignore_list()
         return self.ignore_list
 
-    def view_commit_history(self):
-        """View commit history."""
-        with open(self.history_file, 'r') as f:
-            return json.load(f)
+    def view_commit_history(self, limit=None):
+        """View commit history, oldest first, optionally only the last `limit` commits."""
+        self._migrate_legacy_history()
+        if limit is not None:
+            return self.log.tail(limit)
+        return list(self.log)
+
+    @_traced
+    def iter_history(self, limit=None, since=None, until=None, grep=None, path=None, revision=None):
+        """Yield commits newest first, filtered lazily so callers can stream them.
 
-    def clone(self, new_name):
-        """Clone the repository."""
+        Without `revision` every logged commit is listed. A revision such as
+        "main", "origin/main", a commit id or a range "A..B" (commits reachable
+        from B but not from A, either side defaulting to HEAD) walks parent
+        links instead, children before parents, and each commit also carries
+        its "parents". `since` and `until` accept "YYYY-MM-DD" or
+        "YYYY-MM-DD HH:MM:SS" and are inclusive. `grep` is a regular expression
+        matched against the message and `path` keeps commits that touched that
+        file or anything below that directory.
+        """
+        since = self._parse_date_bound(since, "00:00:00")
+        until = self._parse_date_bound(until, "23:59:59")
+        pattern = re.compile(grep) if grep else None
+        prefix = path.rstrip("/\\") + "/" if path else None
+
+        self._migrate_legacy_history()
+        if limit is not None and limit <= 0:
+            return
+        if path and revision is None:
+            self._update_log_indexes()
+        # A file's own list of changes is much shorter than the whole log;
+        # directories are matched against every logged commit instead.
+        indexed = bool(path) and revision is None and self.blame_cache.has_path(self._normalize_path(path))
+        if revision is not None:
+            commits = self._walk_revision(revision)
+        elif indexed:
+            commits = self._path_history(self._normalize_path(path))
+        else:
+            commits = self.log.iter_reverse()
+        shown = 0
+        for commit in commits:
+            if since and commit["date"] < since:
+                # Local commits are logged as they are made, so once one is past
+                # `since` nothing logged before it can match. Commits received
+                # from other repositories may be older than their neighbours.
+                if revision is not None or indexed or commit.get("received"):
+                    continue
+                break
+            if until and commit["date"] > until:
+                continue
+            if pattern and not pattern.search(commit["message"]):
+                continue
+            if path and not indexed:
+                files = commit["files"] if "files" in commit else self._changed_files(commit)
+                if not any(f == path or f.startswith(prefix) for f in files):
+                    continue
+            yield commit
+            shown += 1
+            if limit is not None and shown >= limit:
+                break
+
+    def _path_history(self, path):
+        """Yield log entries for the commits that changed one file, newest first."""
+        seen = set()
+        for oid, _ in self.blame_cache.changes(path):
+            if oid in seen:
+                continue
+            seen.add(oid)
+            if not self.objects.exists(oid):
+                # Pruned by gc after a forced push or a deleted branch.
+                continue
+            commit = self.objects.read_commit(oid)
+            yield {"commit": oid, "message": commit["message"], "date": commit["date"], "files": [path]}
+
+    def _update_log_indexes(self):
+        """Extend the blame cache and search index with commits logged since their last update.
+
+        Commits are indexed as they are made or received, so this only has
+        work to do the first time an older repository is used.
+        """
+        self._migrate_legacy_history()
+        total = len(self.log)
+        indexes = (self.blame_cache, self.search_index)
+        if all(index.position() == total for index in indexes):
+            return
+        max_blob_size = self._load_config()["large_file_threshold"]
+        with self.batch():
+            for index in indexes:
+                position = index.position()
+                if position > total:
+                    # The log was rebuilt, so the index describes other entries.
+                    rmtree(index.root)
+                    position = 0
+                if position < total:
+                    with trace.span("update_index", index=os.path.basename(index.root), commits=total - position):
+                        index.update(self.log.tail(total - position), position, max_blob_size)
+
+    def _index_new_commits(self):
+        """Add commits just logged to the blame cache and search index, if that succeeds.
+
+        The commits already count as made, so a failure here must not fail the
+        operation that logged them. The indexes stay behind the log and are
+        caught up by the next blame, grep or path log, which report the error,
+        much as the commit-graph file catches up on the next gc.
+        """
+        try:
+            self._update_log_indexes()
+        except Exception:
+            trace.count("index.update_failed")
+
+    @_traced
+    def blame(self, file_name, revision=None):
+        """Return (commit id, line) for each line of a file, naming the commit that last changed it.
+
+        `revision` is anything log accepts except a range, and defaults to HEAD.
+        Attributions are kept up to date as commits are made, so this costs one
+        cache lookup rather than a walk over the file's history.
+        """
+        path = self._normalize_path(file_name)
+        commit_id = self._resolve_revision(revision or "HEAD")
+        blob = self._read_commit_tree(commit_id).get(path)
+        if blob is None:
+            raise Exception(f"File '{path}' does not exist in {revision or 'HEAD'}.")
+        data = self.objects.read_text_blob(blob, self._load_config()["large_file_threshold"])
+        if data is None:
+            raise Exception(f"Cannot blame '{path}': it is binary or larger than the large_file_threshold setting.")
+        lines = data.decode(errors="replace").splitlines()
+        self._update_log_indexes()
+        owners = self.blame_cache.attribution(path, blob, commit_id, len(lines))
+        if owners is None or len(owners) != len(lines):
+            origin = self._introducing_commit(path, blob, commit_id)
+            with self.batch():
+                if any(entry.get("commit") == origin for entry in self.log.iter_reverse()):
+                    # The cache is damaged or was deleted in part: rebuild it from the log.
+                    rmtree(self.blame_cache.root, ignore_errors=True)
+                    self._update_log_indexes()
+                else:
+                    # Made here but never logged, like the import commit of a
+                    # repository upgraded before migrations logged it.
+                    self._record_commits([origin])
+            owners = self.blame_cache.attribution(path, blob, commit_id, len(lines))
+            if owners is None or len(owners) != len(lines):
+                raise Exception(f"No line attribution for '{path}' in commit {commit_id[:7]}.")
+        return list(zip(owners, lines))
+
+    def _introducing_commit(self, path, blob, commit_id):
+        """Return the commit that gave `path` the content `blob`, going back from `commit_id`."""
+        oid = commit_id
+        while True:
+            for parent in self.commit_graph.parents(oid):
+                if self._read_commit_tree(parent).get(path) == blob:
+                    oid = parent
+                    break
+            else:
+                return oid
+
+    @_traced
+    def grep(self, pattern, all_history=False, branch=None, ignore_case=False):
+        """Yield (commit id, path, line number, line) for lines matching a regular expression.
+
+        By default the files committed on the active branch, or on `branch`,
+        are searched. With `all_history` every version of every file that a
+        commit on that branch (or on any branch, without `branch`) introduced
+        is searched, newest first, with the commit that introduced it; versions
+        larger than the large_file_threshold setting are left out. The
+        trigram index narrows the search to file versions containing the
+        pattern's literal text, and only those are read and matched. Files in
+        the searched tree that the index left out, such as large ones, are
+        always read.
+        """
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        self._update_log_indexes()
+        candidates = self.search_index.candidates(pattern)
+
+        if not all_history:
+            tip = self._resolve_revision(branch or "HEAD")
+            tree = self._read_commit_tree(tip)
+            if candidates is not None:
+                wanted = {blob for _, blob, _ in self.search_index.rows(candidates)}
+                ruled_out = self.search_index.indexed_blobs() - wanted
+                tree = {path: blob for path, blob in tree.items() if blob not in ruled_out}
+            for path, blob in sorted(tree.items()):
+                for number, line in self._grep_blob(regex, blob):
+                    yield tip, path, number, line
+            return
+
+        rows = range(len(self.search_index)) if candidates is None else candidates
+        reachable = set(self.commit_graph.walk([self._resolve_revision(branch)])) if branch else None
+        matches = {}
+        seen = set()
+        for _, blob, commit_id in sorted(self.search_index.rows(rows), reverse=True):
+            if (reachable is not None and commit_id not in reachable) or (commit_id, blob) in seen:
+                continue
+            if not self.objects.exists(commit_id):
+                # Pruned by gc after a forced push or a deleted branch.
+                continue
+            seen.add((commit_id, blob))
+            if blob not in matches:
+                matches[blob] = list(self._grep_blob(regex, blob))
+            if not matches[blob]:
+                continue
+            paths = [path for path, oid in sorted(self._read_commit_tree(commit_id).items()) if oid == blob]
+            for path in paths:
+                for number, line in matches[blob]:
+                    yield commit_id, path, number, line
+
+    def _grep_blob(self, regex, blob):
+        """Yield (line number, line) for the matching lines of a text blob."""
+        data = self.objects.read_blob(blob)
+        if is_binary(data):
+            return
+        for number, line in enumerate(data.decode(errors="replace").splitlines(), 1):
+            if regex.search(line):
+                yield number, line
+
+    def _walk_revision(self, revision):
+        """Yield the commits a revision or "A..B" range selects, as log entries with parents."""
+        if ".." in revision:
+            exclude, _, include = revision.partition("..")
+            excluded = [self._resolve_revision(exclude or "HEAD")]
+        else:
+            include, excluded = revision, []
+        for oid in self.commit_graph.walk([self._resolve_revision(include or "HEAD")], excluded):
+            commit = self.objects.read_commit(oid)
+            yield {
+                "commit": oid,
+                "message": commit["message"],
+                "date": commit["date"],
+                "parents": self.commit_graph.parents(oid),
+            }
+
+    def _resolve_revision(self, name):
+        """Return the commit a branch, remote-tracking branch, HEAD or full commit id refers to."""
+        remote, _, remote_branch = name.partition("/")
+        tracking = Refs(self.repo_dir, f"remotes/{remote}")
+        if name == "HEAD":
+            head = self._head_commit()
+        elif self.refs.exists(name):
+            head = self.refs.read(name)
+        elif remote in self._load_remotes() and remote_branch and tracking.exists(remote_branch):
+            head = tracking.read(remote_branch)
+        elif re.fullmatch(r"[0-9a-f]{40}", name) and self.objects.exists(name):
+            head = name
+        else:
+            raise Exception(f"Unknown revision '{name}'.")
+        if head is None:
+            raise Exception(f"Revision '{name}' has no commits yet.")
+        return head
+
+    def _changed_files(self, commit):
+        """Return the paths a commit changed relative to its first parent."""
+        parents = commit.get("parents")
+        if parents is None:
+            parents = self.commit_graph.parents(commit["commit"])
+        tree = self._read_commit_tree(commit["commit"])
+        parent_tree = self._read_commit_tree(parents[0] if parents else None)
+        return sorted(path for path in set(tree) | set(parent_tree) if tree.get(path) != parent_tree.get(path))
+
+    @staticmethod
+    def _parse_date_bound(value, default_time):
+        """Normalize a date bound to the "YYYY-MM-DD HH:MM:SS" format commits are stored in."""
+        if not value:
+            return None
+        for fmt, suffix in (("%Y-%m-%d %H:%M:%S", ""), ("%Y-%m-%d", f" {default_time}")):
+            try:
+                datetime.strptime(value, fmt)
+                return value + suffix
+            except ValueError:
+                pass
+        raise Exception(f"Invalid date '{value}', expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.")
+
+    @_traced
+    def clone(self, new_name, depth=None, branch=None):
+        """Clone the repository into a new directory.
+
+        Objects never change once written, so they are hard-linked into the clone
+        (or reflinked/copied where links are impossible); only refs and small
+        metadata files are copied. `branch` clones just that branch and `depth`
+        keeps only that many commits of history per branch, transferring only
+        the objects they reach. The clone's working tree is checked out from the
+        active branch; uncommitted changes are not cloned.
+        """
         if os.path.exists(new_name):
             raise Exception(f"Directory '{new_name}' already exists.")
-        copytree(self.name, new_name)
+        if depth is not None and depth < 1:
+            raise Exception("Clone depth must be at least 1.")
+        if branch is not None and not self.refs.exists(branch):
+            raise Exception(f"Branch '{branch}' does not exist.")
+
+        heads = {name: self.refs.read(name) for name in ([branch] if branch else self.refs.names())}
+        active_branch = branch or self._get_active_branch()
+
+        clone = Repository(new_name)
+        os.makedirs(clone.objects.objects_dir)
+        if depth is None and branch is None:
+            self.objects.copy_packs_to(clone.objects)
+            object_ids, boundary = set(self.objects.loose_ids()), set(self._load_shallow())
+        else:
+            object_ids, boundary = self.objects.reachable_objects(heads.values(), depth)
+            # A clone of a shallow repository is cut off where this one is.
+            boundary.update(oid for oid in self._load_shallow() if oid in object_ids)
+        for oid in object_ids:
+            self.objects.copy_object_to(clone.objects, oid)
+        origin = Refs(clone.repo_dir, "remotes/origin")
+        for name, head in heads.items():
+            clone.refs.write(name, head)
+            origin.write(name, head)
+        with open(clone.remotes_file, 'w') as f:
+            json.dump({"origin": os.path.abspath(self.name)}, f, indent=4)
+        if boundary:
+            with open(clone.shallow_file, 'w') as f:
+                f.write("".join(f"{oid}\n" for oid in sorted(boundary)))
+        copied = [self.ignore_file, self.config_file]
+        if depth is None and branch is None:
+            copied.append(self.commit_graph.path)
+        for path in copied:
+            if os.path.exists(path):
+                copyfile(path, os.path.join(clone.repo_dir, os.path.basename(path)))
+        with open(clone.active_branch_file, 'w') as f:
+            f.write(active_branch)
+
+        clone.log.create()
+        if depth is None and branch is None:
+            clone.log.extend(self.log)
+            for index_dir in (self.blame_cache.root, self.search_index.root):
+                if os.path.exists(index_dir):
+                    copytree(index_dir, os.path.join(clone.repo_dir, os.path.basename(index_dir)))
+        else:
+            clone.log.extend(entry for entry in self.log if entry.get("commit") in object_ids)
+
+        clone._load_ignore_list()
+        with clone.batch():
+            index = clone._load_index()
+            clone._checkout({}, clone._read_commit_tree(heads.get(active_branch)), index, "clone")
+            clone._save_index(index)
+        return clone
+
+    def _load_shallow(self):
+        """Return the commits whose parents a shallow clone left out, as a frozenset."""
+        def load(path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return frozenset(f.read().split())
+            return frozenset()
+        return self.state.get(self.shallow_file, load)
+
+    def _load_remotes(self):
+        """Return the configured remotes as a name -> path or URL mapping."""
+        def load(path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return json.load(f)
+            return {}
+        return self.state.get(self.remotes_file, load)
+
+    @_batched
+    def add_remote(self, name, location):
+        """Register another repository, by path or URL, under a short name."""
+        Refs.check_name(name)
+        if "/" in name:
+            raise Exception(f"'{name}' is not a valid remote name.")
+        remotes = dict(self._load_remotes())
+        if name in remotes:
+            raise Exception(f"Remote '{name}' already exists.")
+        if not location.startswith(("http://", "https://")):
+            location = os.path.abspath(location)
+        remotes[name] = location
+        self.state.put(self.remotes_file, remotes, lambda r: json.dumps(r, indent=4))
+
+    def _connect(self, remote):
+        """Return a transport for a remote name, path or URL, and its tracking refs if named."""
+        remotes = self._load_remotes()
+        location = remotes.get(remote, remote)
+        if not location.startswith(("http://", "https://")) and not os.path.isdir(os.path.join(location, ".vcs")):
+            raise Exception(f"'{remote}' is neither a configured remote nor a repository.")
+        tracking = Refs(self.repo_dir, f"remotes/{remote}") if remote in remotes else None
+        return open_transport(location, Repository), tracking
+
+    @_traced
+    def advertise_refs(self):
+        """Return every branch and the commit it points at, for other repositories."""
+        return {name: self.refs.read(name) for name in self.refs.names()}
+
+    @_traced
+    def negotiate(self, haves):
+        """Return the commits from `haves` that this repository has."""
+        return [oid for oid in haves if self.objects.exists(oid) and self.objects.object_type(oid) == "commit"]
+
+    @_traced
+    def upload_pack(self, out, wants, haves, shallow=()):
+        """Write a pack of the objects `wants` needs beyond what a peer holding `haves` has.
+
+        `shallow` lists the peer's commits whose parents it does not have.
+        """
+        for oid in wants:
+            if not self.objects.exists(oid):
+                raise Exception(f"Commit '{oid}' does not exist in this repository.")
+        missing = missing_objects(self.objects, wants, self.negotiate(haves), set(shallow))
+        return len(write_pack(out, self.objects, missing))
+
+    @_batched
+    def receive_pack(self, pack, updates):
+        """Store a pushed pack and move branches as requested.
 
+        `updates` is a list of {"branch", "old", "new"} dicts, where "old" is the
+        commit the pusher last saw (absent for a new branch) and is not checked
+        when "force" is set. Pushing to the checked-out branch also updates the
+        working tree, unless local changes are in the way.
+        """
+        self._unpack(pack)
+        active_branch = self._get_active_branch()
+        for update in updates:
+            name, new = update["branch"], update["new"]
+            if not self.objects.exists(new):
+                raise Exception(f"Push did not include commit '{new}'.")
+            current = self.refs.read(name) if self.refs.exists(name) else MISSING
+            expected = current if update.get("force") else update.get("old", MISSING)
+            if current != expected:
+                raise Exception(f"Branch '{name}' has changed since it was fetched; fetch and try again.")
+            if name == active_branch:
+                index = self._load_index()
+                old_tree = self._read_commit_tree(None if current is MISSING else current)
+                self._checkout(old_tree, self._read_commit_tree(new), index, "push")
+                self._save_index(index)
+            self.refs.update(name, new, expected=expected)
+
+    def _unpack(self, pack):
+        """Store every new object of a pack stream and log the commits among them."""
+        new_commits = []
+        try:
+            for oid, obj_type, data in read_pack(pack, self.objects.read_raw):
+                if self.objects.exists(oid):
+                    continue
+                if obj_type == "tree":
+                    for path in trace.json_loads(data):
+                        check_tree_path(path)
+                self.objects.write_raw(oid, obj_type, data)
+                if obj_type == "commit":
+                    new_commits.append(oid)
+        finally:
+            # Commits follow their trees and parents in a pack, so whatever was
+            # stored before a failure is complete and belongs in the log.
+            self._record_commits(new_commits)
+
+    def _record_commits(self, commit_ids):
+        """Add commits received from another repository to the commit log."""
+        if not commit_ids:
+            return
+        self._migrate_legacy_history()
+        entries = []
+        for oid in commit_ids:
+            commit = self.objects.read_commit(oid)
+            entries.append({
+                "commit": oid,
+                "message": commit["message"],
+                "date": commit["date"],
+                "files": self._changed_files({"commit": oid}),
+                "received": True,
+            })
+        self.log.extend(entries)
+        self._index_new_commits()
+
+    def _negotiate(self, transport, remote_refs):
+        """Find commits both sides have, so the remote sends only what is missing.
+
+        Remote branch tips that exist here are common already. Local history is
+        then offered newest first, a round at a time; once the remote knows a
+        commit, its ancestors are not offered any more.
+        """
+        COMMON = 1
+        common = {oid for oid in remote_refs.values() if oid and self.objects.exists(oid)}
+        flags = {}
+        queue = []
+
+        def push(oid, flag):
+            if (oid in flags and flags[oid] | flag == flags[oid]) or not self.objects.exists(oid):
+                return
+            flags[oid] = flags.get(oid, 0) | flag
+            heapq.heappush(queue, (Newest(self.objects.read_commit(oid)["date"]), oid))
+
+        for oid in common:
+            push(oid, COMMON)
+        for name in self.refs.names():
+            tip = self.refs.read(name)
+            if tip:
+                push(tip, 0)
+
+        offered = 0
+        while queue and offered < MAX_HAVES and any(not flags[oid] & COMMON for _, oid in queue):
+            haves = []
+            while queue and len(haves) < NEGOTIATION_ROUND:
+                _, oid = heapq.heappop(queue)
+                flag = flags[oid]
+                if not flag & COMMON and oid not in common:
+                    haves.append(oid)
+                for parent in self.objects.read_commit(oid)["parents"]:
+                    push(parent, flag)
+            offered += len(haves)
+            for oid in transport.negotiate(haves) if haves else []:
+                common.add(oid)
+                # The remote has every ancestor of a commit it has.
+                for parent in self.objects.read_commit(oid)["parents"]:
+                    push(parent, COMMON)
+        return sorted(common)
+
+    @_batched
+    def fetch(self, remote="origin"):
+        """Download the commits another repository has and this one lacks.
+
+        `remote` is a configured remote name, a path or a URL served by
+        `vcs serve`. The two sides first agree on the commits they share; the
+        remote then sends only the missing objects, in one delta-compressed
+        pack. Branches of a named remote are recorded under
+        refs/remotes/<remote>. Returns the remote's branches as a
+        name -> commit id mapping.
+        """
+        transport, tracking = self._connect(remote)
+        remote_refs = transport.list_refs()
+        wants = sorted({oid for oid in remote_refs.values() if oid and not self.objects.exists(oid)})
+        if wants:
+            common = self._negotiate(transport, remote_refs)
+            shallow = self._load_shallow()
+            with transport.fetch_pack(wants, common, shallow) as pack:
+                self._unpack(pack)
+            self._update_shallow(shallow)
+        if tracking is not None:
+            for name, oid in remote_refs.items():
+                tracking.write(name, oid)
+        return remote_refs
+
+    def _update_shallow(self, shallow):
+        """Drop commits from the shallow boundary once every parent they have has been fetched."""
+        remaining = {
+            oid for oid in shallow
+            if not all(self.objects.exists(parent) for parent in self.objects.read_commit(oid)["parents"])
+        }
+        if remaining == shallow:
+            return
+        if remaining:
+            with open(self.shallow_file, 'w') as f:
+                f.write("".join(f"{oid}\n" for oid in sorted(remaining)))
+        else:
+            os.remove(self.shallow_file)
+        # Both were built without the parents that just arrived.
+        self.commit_graph.remove()
+        rmtree(self.blame_cache.root, ignore_errors=True)
+
+    @_batched
+    def pull(self, remote="origin", branch=None):
+        """Fetch from a remote and merge its copy of `branch` (the current branch by default)."""
+        branch = branch or self._get_active_branch()
+        remote_refs = self.fetch(remote)
+        if branch not in remote_refs:
+            raise Exception(f"Remote '{remote}' has no branch '{branch}'.")
+        return self._merge_commit(remote_refs[branch], f"{remote}/{branch}")
+
+    @_batched
+    def push(self, remote="origin", branch=None, force=False):
+        """Send a branch (the current branch by default) to another repository.
+
+        Only objects the remote lacks are sent. The remote branch must be an
+        ancestor of the local one unless `force` is set. Returns a short
+        description of the outcome.
+        """
+        branch = branch or self._get_active_branch()
+        if not self.refs.exists(branch):
+            raise Exception(f"Branch '{branch}' does not exist.")
+        local = self.refs.read(branch)
+        if local is None:
+            raise Exception(f"Branch '{branch}' has no commits to push.")
+
+        transport, tracking = self._connect(remote)
+        remote_refs = transport.list_refs()
+        update = {"branch": branch, "new": local}
+        if branch in remote_refs:
+            old = remote_refs[branch]
+            if old == local:
+                return "Everything up to date."
+            update["old"] = old
+            if force:
+                update["force"] = True
+            elif old is not None and not (self.objects.exists(old) and is_ancestor(self.commit_graph, old, local)):
+                raise Exception(
+                    f"Push rejected: the remote '{branch}' has commits that are not here. "
+                    "Pull first, or push with force."
+                )
+
+        haves = [oid for oid in remote_refs.values() if oid and self.objects.exists(oid)]
+        with tempfile.TemporaryFile() as pack:
+            write_pack(pack, self.objects, missing_objects(self.objects, [local], haves))
+            pack.seek(0)
+            transport.receive_pack(pack, [update])
+        if tracking is not None:
+            tracking.write(branch, local)
+        return f"Branch '{branch}' pushed."
+
+    def _all_tips(self):
+        """Return the commits of every branch, remote-tracking branch and merge in progress."""
+        tips = [self.refs.read(name) for name in self.refs.names()]
+        for remote in self._load_remotes():
+            tracking = Refs(self.repo_dir, f"remotes/{remote}")
+            tips.extend(tracking.read(name) for name in tracking.names())
+        if os.path.exists(self.merge_head_file):
+            with open(self.merge_head_file, 'r') as f:
+                tips.append(json.load(f)["commit"])
+        return sorted({oid for oid in tips if oid and self.objects.exists(oid)})
+
+    @_batched
+    def write_commit_graph(self):
+        """Record generation numbers of all commits for fast ancestry queries; returns the count."""
+        return self.commit_graph.write(self._all_tips())
+
+    @_batched
+    def gc(self, prune=True):
+        """Repack the object store into one pack of delta chains and drop unused objects.
+
+        Each version of a file is stored as a delta against the previous version
+        of the same path whenever that is much smaller, with chains no longer
+        than the max_delta_depth setting. Objects not reachable from a branch, a
+        remote-tracking branch, a merge in progress or the index are removed
+        unless `prune` is False. The commit-graph file is rewritten as well.
+        Returns a dict of counts and sizes in bytes.
+        """
+        tips = self._all_tips()
+        size_before = self.objects.disk_usage()
+        stored = set(self.objects.object_ids())
+        loose = list(self.objects.loose_ids())
+        old_packs = self.objects.packs()
+        with trace.span("find_reachable"):
+            entries = missing_objects(self.objects, tips, [])
+        reachable = {oid for oid, _ in entries}
+        # Blobs written for staged or conflicted files are not in any commit yet.
+        reachable.update(entry[3] for entry in self._load_index().entries.values())
+        kept = stored & reachable if prune else stored
+        entries.extend((oid, None) for oid in sorted(kept - {oid for oid, _ in entries}))
+
+        written = []
+        new_pack = None
+        if entries:
+            os.makedirs(self.objects.pack_dir, exist_ok=True)
+            tmp_path = os.path.join(self.objects.pack_dir, f"tmp-{os.getpid()}")
+            with open(f"{tmp_path}.pack", 'w+b') as f, trace.span("write_pack", objects=len(entries)):
+                written = write_pack(f, self.objects, entries, self._load_config()["max_delta_depth"])
+                f.seek(-20, os.SEEK_END)
+                checksum = f.read(20)
+            write_index(f"{tmp_path}.idx", written, checksum)
+            new_pack = os.path.join(self.objects.pack_dir, f"pack-{checksum.hex()}")
+            os.replace(f"{tmp_path}.pack", f"{new_pack}.pack")
+            os.replace(f"{tmp_path}.idx", f"{new_pack}.idx")
+
+        # Every old object is now in the new pack or unreachable.
+        self.objects.close()
+        self.objects.remove_loose(loose)
+        for pack in old_packs:
+            if os.path.splitext(pack.pack_path)[0] != new_pack:
+                os.remove(pack.index_path)
+                os.remove(pack.pack_path)
+        return {
+            "commits": self.commit_graph.write(tips),
+            "objects": len(written),
+            "deltas": sum(1 for _, _, base in written if base is not None),
+            "pruned": len(stored - kept),
+            "size_before": size_before,
+            "size_after": self.objects.disk_usage(),
+        }
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Return an HTTP server other repositories can fetch from and push to."""
+        return make_server(lambda: Repository(self.name), host, port)
+
+    def _worktree_matches(self, path, oid, index):
+        """Check whether the working copy of `path` holds blob `oid` (None meaning absent)."""
+        file_path = os.path.join(self.name, path)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return oid is None
+        if oid is None:
+            return False
+        if index.is_fresh(path, st):
+            return index.entries[path][3] == oid
+        current = self.objects.hash_file(file_path)
+        if path in index.entries and index.entries[path][3] == current:
+            index.update(path, st, current)
+        return current == oid
+
+    def _write_worktree_file(self, path, oid, index):
+        """Replace the working copy of `path` with blob `oid`, or delete it for None."""
+        check_tree_path(path)
+        file_path = os.path.join(self.name, path)
+        if oid is None:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            index.entries.pop(path, None)
+            index.dirty = True
+            return
+        self._write_worktree_bytes(path, self.objects.stream_blob(oid))
+        index.update(path, os.stat(file_path), oid)
+
+    def _write_worktree_bytes(self, path, pieces):
+        """Atomically write an iterable of byte strings to a working-tree file."""
+        check_tree_path(path)
+        file_path = os.path.join(self.name, path)
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        tmp_path = f"{file_path}.vcs-tmp"
+        with open(tmp_path, 'wb') as f:
+            for piece in pieces:
+                f.write(piece)
+            trace.count("io.files_opened")
+            trace.count("io.bytes_written", f.tell())
+        os.replace(tmp_path, file_path)
+
+    @_batched
     def merge(self, branch_name):
-        """Merge a branch into the current branch."""
-        with open(self.branch_file, 'r+') as f:
-            branches = json.load(f)
+        """Merge a branch into the current branch.
+
+        Returns a short description of the outcome. When the current branch is an
+        ancestor of the other one the merge is a fast-forward: the branch pointer
+        moves and only the files that differ are checked out, without merging any
+        content. Otherwise only files that differ between the two branches are
+        examined and files changed on both sides are merged line by line.
+        Conflicts are written to the working tree with markers and the merge is
+        completed by adding the resolved files and committing.
+        """
+        if not self.refs.exists(branch_name):
+            raise Exception(f"Branch '{branch_name}' does not exist.")
+        return self._merge_commit(self.refs.read(branch_name), branch_name)
+
+    @_batched
+    def abort_merge(self):
+        """Abandon the merge in progress, restoring the current branch's version of the files it touched."""
+        merge_head = self._read_merge_head()
+        if merge_head is None:
+            raise Exception("No merge in progress.")
+        index = self._load_index()
+        # MERGE_HEAD files written before "paths" was recorded only name the conflicts.
+        paths = set(merge_head.get("paths", index.staged)) | set(merge_head.get("conflicts", []))
+        tree = self._read_commit_tree(self._head_commit())
+        for path in sorted(paths):
+            self._write_worktree_file(path, tree.get(path), index)
+            if path not in tree:
+                self._remove_empty_dirs(path)
+            index.unstage(path)
+        self._save_index(index)
+        os.remove(self.merge_head_file)
+
+    def _merge_commit(self, theirs, branch_name):
+        """Merge commit `theirs` into the current branch, naming it `branch_name` in messages."""
+        current_branch = self._get_active_branch()
+        if not self.refs.exists(current_branch):
+            raise Exception(f"Current branch '{current_branch}' not found.")
+        if os.path.exists(self.merge_head_file):
+            raise Exception(
+                "A merge is already in progress. Resolve the conflicts and commit, or abort it with merge --abort."
+            )
+
+        ours = self.refs.read(current_branch)
+        if theirs is None or theirs == ours:
+            return "Already up to date."
+        with trace.span("merge_base"):
+            base = merge_base(self.commit_graph, ours, theirs) if ours else None
+        if base == theirs:
+            return "Already up to date."
+        if ours and base is None and self._load_shallow():
+            # The common ancestor may be among the commits the clone left out.
+            raise Exception(
+                f"No common ancestor of the current branch and '{branch_name}' within this shallow "
+                "clone's history; clone without --depth to merge them."
+            )
+        if ours is None or base == ours:
+            index = self._load_index()
+            self._checkout(self._read_commit_tree(ours), self._read_commit_tree(theirs), index, "merge")
+            self.refs.update(current_branch, theirs, expected=ours)
+            self._save_index(index)
+            return "Fast-forward."
+
+        base_tree = self._read_commit_tree(base)
+        ours_tree = self._read_commit_tree(ours)
+        theirs_tree = self._read_commit_tree(theirs)
+
+        merged_tree = dict(ours_tree)
+        changes = {}
+        conflicts = {}
+        with trace.span("merge_files"):
+            for path in set(ours_tree) | set(theirs_tree):
+                ours_oid = ours_tree.get(path)
+                theirs_oid = theirs_tree.get(path)
+                base_oid = base_tree.get(path)
+                if ours_oid == theirs_oid or theirs_oid == base_oid:
+                    continue
+                if ours_oid == base_oid:
+                    changes[path] = theirs_oid
+                    continue
+                if ours_oid is None or theirs_oid is None:
+                    # Modified on one side and deleted on the other: keep the working copy as is.
+                    conflicts[path] = None
+                    continue
+                ours_data = self.objects.read_blob(ours_oid)
+                theirs_data = self.objects.read_blob(theirs_oid)
+                base_data = self.objects.read_blob(base_oid) if base_oid else b""
+                if is_binary(ours_data) or is_binary(theirs_data):
+                    conflicts[path] = None
+                    continue
+                data, conflicted = merge_lines(base_data, ours_data, theirs_data, current_branch, branch_name)
+                if conflicted:
+                    conflicts[path] = data
+                else:
+                    changes[path] = self.objects.write_blob(data)
+
+        index = self._load_index()
+        blocked = [
+            path for path in list(changes) + list(conflicts)
+            if not self._worktree_matches(path, ours_tree.get(path), index)
+            and not (path in changes and self._worktree_matches(path, changes[path], index))
+        ]
+        if blocked:
+            raise Exception(
+                f"Your local changes to {', '.join(sorted(blocked))} would be overwritten by merge. "
+                "Commit them first."
+            )
+
+        for path, oid in changes.items():
+            self._write_worktree_file(path, oid, index)
+            if oid is None:
+                merged_tree.pop(path, None)
+            else:
+                merged_tree[path] = oid
+
+        message = f"Merge branch '{branch_name}' into {current_branch}"
+        if conflicts:
+            for path, data in conflicts.items():
+                if data is not None:
+                    self._write_worktree_bytes(path, [data])
+            for path in changes:
+                index.stage(path)
+            self._save_index(index)
+            with open(self.merge_head_file, 'w') as f:
+                json.dump({
+                    "commit": theirs,
+                    "message": message,
+                    "conflicts": sorted(conflicts),
+                    "paths": sorted(set(changes) | set(conflicts)),
+                }, f)
+            # The conflict is reported as an error, but the staged results must be kept.
+            self.flush()
+            raise Exception(
+                f"Merge conflict in: {', '.join(sorted(conflicts))}. "
+                "Fix them, add the files and commit the result."
+            )
 
-            if branch_name not in branches:
-                raise Exception(f"Branch '{branch_name}' does not exist.")
-            
-            current_branch = self._get_active_branch()
-            if current_branch not in branches:
-                raise Exception(f"Current branch '{current_branch}' not found.")
-            
-            branches[current_branch].extend(branches[branch_name])
-            f.seek(0)
-            json.dump(branches, f, indent=4)
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        commit_id = self.objects.write_commit(
+            self.objects.write_tree(merged_tree), [ours, theirs], message, date
+        )
+        self.refs.update(current_branch, commit_id, expected=ours)
+        self._save_index(index)
+        self._migrate_legacy_history()
+        self.log.append({"commit": commit_id, "message": message, "date": date, "files": sorted(changes)})
+        self.flush()
+        self._index_new_commits()
+        return "Merge made by the three-way strategy."
 
     def create_file(repo_name, file_name, content):
         """Creates a file in the repository with the given content."""
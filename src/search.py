@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import mmap
+import struct
+
+SEGMENT_SIGNATURE = b"VTRI"
+# One blob-table record: a blob id, then the commit that introduced it.
+_BLOB_RECORD_SIZE = 81
+# Trigram, start of its postings (in entries), number of postings.
+_ENTRY = struct.Struct(">3sII")
+
+
+def trigrams(data):
+    """Return the set of 3-byte sequences in `data`, folded to lower case."""
+    data = data.lower()
+    # Zipping the shifted byte strings runs in C; only distinct trigrams become bytes objects.
+    return {bytes(trigram) for trigram in set(zip(data, data[1:], data[2:]))}
+
+
+def required_literals(pattern):
+    """Return strings every match of a regular expression must contain.
+
+    This is deliberately conservative: any construct it does not understand
+    ends the current literal, and a pattern with alternation, numeric escapes
+    or verbose mode yields nothing, which makes the caller check every file.
+    Only ASCII literals are returned, as only ASCII is case-folded in the index.
+    """
+    if re.compile(pattern).flags & re.VERBOSE:
+        return []
+    literals = []
+    current = []
+    i, n = 0, len(pattern)
+    in_class = depth = 0
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 < n and (pattern[i + 1] in "xuUN" or pattern[i + 1].isdigit()):
+                return []
+            if i + 1 < n and not pattern[i + 1].isalnum():
+                if not in_class and not depth:
+                    current.append(pattern[i + 1])
+            elif not in_class and not depth:
+                literals.append("".join(current))
+                current = []
+            i += 2
+            continue
+        if in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+            # A "]" right after "[" or "[^" is part of the class.
+            if pattern.startswith("^", i + 1):
+                i += 1
+            if pattern.startswith("]", i + 1):
+                i += 1
+        elif c == "|":
+            return []
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth:
+            pass
+        elif c in "*?{":
+            # The preceding character is optional.
+            if current:
+                current.pop()
+            if c == "{":
+                while i < n and pattern[i] != "}":
+                    i += 1
+        elif c == "+":
+            pass
+        elif c in ".^$":
+            pass
+        else:
+            current.append(c)
+            i += 1
+            continue
+        literals.append("".join(current))
+        current = []
+        i += 1
+    literals.append("".join(current))
+    return [literal for literal in literals if len(literal) >= 3 and literal.isascii()]
+
+
+class Segment:
+    """One immutable file of the index: trigrams sorted, each with a list of blob rows."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = struct.unpack_from(">4sI", self._map)
+        if magic != SEGMENT_SIGNATURE:
+            raise Exception(f"Search index segment '{path}' is corrupt; delete .vcs/search to rebuild it.")
+        self._postings_start = 8 + _ENTRY.size * self.count
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self._map, 8 + _ENTRY.size * i)
+
+    def __iter__(self):
+        """Yield (trigram, rows) for every trigram in the segment."""
+        for i in range(self.count):
+            trigram, start, length = self._entry(i)
+            yield trigram, self._rows(start, length)
+
+    def _rows(self, start, length):
+        return struct.unpack_from(f">{length}I", self._map, self._postings_start + 4 * start)
+
+    def lookup(self, trigram):
+        """Return the blob rows whose content contains `trigram`."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current, start, length = self._entry(mid)
+            if current < trigram:
+                lo = mid + 1
+            elif current > trigram:
+                hi = mid
+            else:
+                return self._rows(start, length)
+        return ()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def write_segment(path, postings):
+    """Write a trigram -> sorted rows mapping as a segment file."""
+    entries = []
+    rows = []
+    for trigram in sorted(postings):
+        entries.append(_ENTRY.pack(trigram, len(rows), len(postings[trigram])))
+        rows.extend(postings[trigram])
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SEGMENT_SIGNATURE + struct.pack(">I", len(entries)))
+        f.write(b"".join(entries))
+        f.write(struct.pack(f">{len(rows)}I", *rows))
+    os.replace(tmp_path, path)
+
+
+class TrigramIndex:
+    """Trigram index over every text file version in the commit log, under .vcs/search.
+
+    blobs lists each (blob, commit) pair in the order commits changed files,
+    so a row number names one file version. Each call to update() adds the
+    versions from newly logged commits as a new segment mapping trigrams to
+    rows. Segments are merged like a binary counter, whenever one is no
+    bigger than the segment after it, so there are only logarithmically many
+    to search and each row is rewritten only a logarithmic number of times.
+    state.json names the segments and the log position they cover, and is
+    replaced only once every file it names is complete.
+    """
+
+    def __init__(self, repo_dir, objects):
+        self.root = os.path.join(repo_dir, "search")
+        self.blobs_file = os.path.join(self.root, "blobs")
+        self.state_file = os.path.join(self.root, "state.json")
+        self.objects = objects
+
+    def _state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"position": 0, "segments": []}
+
+    def position(self):
+        """Return how many commit log entries have been indexed."""
+        return self._state()["position"]
+
+    def __len__(self):
+        """Return the number of indexed file versions."""
+        segments = self._state()["segments"]
+        return segments[-1][1] if segments else 0
+
+    @staticmethod
+    def _segment_name(start, end):
+        return f"segment-{start}-{end}"
+
+    def rows(self, row_numbers):
+        """Yield (row, blob, commit) for the given rows of the blob table, in order."""
+        with open(self.blobs_file, 'rb') as f:
+            for row in sorted(row_numbers):
+                f.seek(row * _BLOB_RECORD_SIZE)
+                record = f.read(_BLOB_RECORD_SIZE).decode()
+                yield row, record[:40], record[40:80]
+
+    def indexed_blobs(self):
+        """Return the ids of every blob that has a row, to tell unindexed versions apart."""
+        try:
+            with open(self.blobs_file, 'rb') as f:
+                data = f.read(len(self) * _BLOB_RECORD_SIZE)
+        except FileNotFoundError:
+            return set()
+        return {data[i:i + 40].decode() for i in range(0, len(data), _BLOB_RECORD_SIZE)}
+
+    def candidates(self, pattern):
+        """Return the rows that may match a regular expression, or None if every row may."""
+        needed = set()
+        for literal in required_literals(pattern):
+            needed |= trigrams(literal.encode())
+        if not needed:
+            return None
+        segments = [Segment(os.path.join(self.root, self._segment_name(*rows))) for rows in self._state()["segments"]]
+        try:
+            result = None
+            # Rare trigrams first, so the intersection shrinks quickly.
+            for trigram in sorted(needed, key=lambda t: sum(len(s.lookup(t)) for s in segments)):
+                found = set()
+                for segment in segments:
+                    found.update(segment.lookup(trigram))
+                result = found if result is None else result & found
+                if not result:
+                    break
+            return result
+        finally:
+            for segment in segments:
+                segment.close()
+
+    def update(self, entries, position, max_blob_size):
+        """Index the file versions of the commit log `entries` that follow `position`.
+
+        Versions that are chunked, binary or over `max_blob_size` bytes are not
+        indexed, and are only read as far as needed to tell.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        segments = self._state()["segments"]
+        start = row = segments[-1][1] if segments else 0
+        # Drop rows an interrupted update wrote without finishing its segment.
+        with open(self.blobs_file, 'a') as f:
+            f.truncate(start * _BLOB_RECORD_SIZE)
+        postings = {}
+        records = []
+        for entry in entries:
+            position += 1
+            oid = entry.get("commit")
+            if not oid or not self.objects.exists(oid):
+                continue
+            commit = self.objects.read_commit(oid)
+            tree = self.objects.read_tree(commit["tree"])
+            parent = commit["parents"][0] if commit["parents"] else None
+            parent_tree = {}
+            if parent and self.objects.exists(parent):
+                parent_tree = self.objects.read_tree(self.objects.read_commit(parent)["tree"])
+            for path, blob in sorted(tree.items()):
+                if parent_tree.get(path) == blob:
+                    continue
+                data = self.objects.read_text_blob(blob, max_blob_size)
+                if data is None:
+                    continue
+                for trigram in trigrams(data):
+                    postings.setdefault(trigram, []).append(row)
+                records.append(f"{blob}{oid}\n")
+                row += 1
+        if records:
+            with open(self.blobs_file, 'a') as f:
+                f.write("".join(records))
+            write_segment(os.path.join(self.root, self._segment_name(start, row)), postings)
+            segments = self._merge(segments + [[start, row]])
+
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"position": position, "segments": segments}, f)
+        os.replace(tmp_path, self.state_file)
+        names = {self._segment_name(*rows) for rows in segments}
+        for name in os.listdir(self.root):
+            if name.startswith("segment-") and name not in names:
+                os.remove(os.path.join(self.root, name))
+
+    def _merge(self, segments):
+        """Merge trailing segments while the newest is at least as big as the one before it."""
+        while len(segments) > 1 and segments[-1][1] - segments[-1][0] >= segments[-2][1] - segments[-2][0]:
+            postings = {}
+            for rows in segments[-2:]:
+                segment = Segment(os.path.join(self.root, self._segment_name(*rows)))
+                try:
+                    for trigram, found in segment:
+                        postings.setdefault(trigram, []).extend(found)
+                finally:
+                    segment.close()
+            merged = [segments[-2][0], segments[-1][1]]
+            write_segment(os.path.join(self.root, self._segment_name(*merged)), postings)
+            segments[-2:] = [merged]
+        return segments
@@ -0,0 +1,69 @@
+import os
+from src import trace
+
+
+class StateCache:
+    """In-memory copies of repository metadata files, loaded once and written in batches.
+
+    A cached value is reused for as long as its file's (mtime_ns, size, inode)
+    signature is unchanged, so edits made by other processes are picked up on the
+    next read. Values changed through put() stay dirty until flush() writes them
+    all, each via a temporary file and os.replace.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._dirty = {}
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def get(self, path, load):
+        """Return the cached value for `path`, calling load(path) if it is missing or stale."""
+        if path in self._dirty:
+            return self._cache[path][1]
+        signature = self._signature(path)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        value = load(path)
+        self._cache[path] = (signature, value)
+        return value
+
+    def put(self, path, value, serialize):
+        """Replace the value for `path`; serialize(value) -> str is used when flushing."""
+        self._cache[path] = (None, value)
+        self._dirty[path] = serialize
+
+    def is_current(self, path):
+        """Check whether the cached value for `path` still matches the file on disk."""
+        cached = self._cache.get(path)
+        return cached is not None and path not in self._dirty and cached[0] == self._signature(path)
+
+    def is_dirty(self):
+        """Check whether any value is waiting to be written."""
+        return bool(self._dirty)
+
+    def flush(self):
+        """Atomically write every dirty value."""
+        for path, serialize in list(self._dirty.items()):
+            value = self._cache[path][1]
+            tmp_path = f"{path}.tmp"
+            data = serialize(value)
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            trace.count("io.files_opened")
+            trace.count("io.bytes_written", len(data))
+            self._cache[path] = (self._signature(path), value)
+            del self._dirty[path]
+
+    def clear(self):
+        """Drop every cached and dirty value so the next read goes back to disk."""
+        self._cache.clear()
+        self._dirty.clear()
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import threading
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._finish(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Tracer:
+    """Timing spans and I/O counters for repository operations.
+
+    Nothing is collected until start() is called or a hook is added; until
+    then span() returns a shared object that does nothing and count() returns
+    at once, so instrumented code costs a single check. Spans are recorded for
+    a Chrome trace (chrome://tracing or Perfetto), and each hook is called as
+    hook(name, start, seconds, args) when a span ends, start being a
+    time.perf_counter() value.
+    """
+
+    def __init__(self):
+        self.recording = False
+        self.events = []
+        self.counters = {}
+        self._hooks = []
+        self._active = False
+        self._lock = threading.Lock()
+
+    def _update_active(self):
+        self._active = self.recording or bool(self._hooks)
+
+    def start(self):
+        """Discard anything recorded so far and start recording spans and counters."""
+        with self._lock:
+            self.events = []
+            self.counters = {}
+            self.recording = True
+            self._update_active()
+
+    def stop(self):
+        """Stop recording; what was recorded stays available."""
+        self.recording = False
+        self._update_active()
+
+    def add_hook(self, hook):
+        """Call hook(name, start, seconds, args) whenever a span ends, and collect counters."""
+        self._hooks.append(hook)
+        self._update_active()
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+        self._update_active()
+
+    def span(self, name, **args):
+        """Return a context manager that times the code it wraps as one span."""
+        if not self._active:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def count(self, name, amount=1):
+        """Add `amount` to a counter such as "io.bytes_read"."""
+        if self._active:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _finish(self, name, start, seconds, args):
+        if self.recording:
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": seconds * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+            if args:
+                event["args"] = args
+            with self._lock:
+                self.events.append(event)
+        for hook in list(self._hooks):
+            hook(name, start, seconds, args)
+
+    def chrome_trace(self):
+        """Return the recorded spans and final counter values in Chrome's trace event format."""
+        with self._lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        end = max((event["ts"] + event["dur"] for event in events), default=time.perf_counter() * 1e6)
+        if counters:
+            events.append({"name": "counters", "ph": "C", "ts": end, "pid": os.getpid(), "tid": 0, "args": counters})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"counters": counters}}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+TRACER = Tracer()
+
+
+def span(name, **args):
+    """Time a block as a span of the process-wide tracer."""
+    return TRACER.span(name, **args)
+
+
+def count(name, amount=1):
+    """Add to a counter of the process-wide tracer."""
+    TRACER.count(name, amount)
+
+
+def add_hook(hook):
+    """Call hook(name, start, seconds, args) whenever a span of the process-wide tracer ends."""
+    TRACER.add_hook(hook)
+
+
+def remove_hook(hook):
+    TRACER.remove_hook(hook)
+
+
+def json_loads(data):
+    """json.loads, counting the time spent when tracing."""
+    if not TRACER._active:
+        return json.loads(data)
+    start = time.perf_counter()
+    value = json.loads(data)
+    TRACER.count("json.load_seconds", time.perf_counter() - start)
+    return value
+
+
+def json_dumps(value, **kwargs):
+    """json.dumps, counting the time spent when tracing."""
+    if not TRACER._active:
+        return json.dumps(value, **kwargs)
+    start = time.perf_counter()
+    data = json.dumps(value, **kwargs)
+    TRACER.count("json.dump_seconds", time.perf_counter() - start)
+    return data
@@ -0,0 +1,171 @@
+import json
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalTransport:
+    """Talks to a repository on the same machine by calling it directly."""
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def list_refs(self):
+        """Return the remote's branches as a name -> commit id mapping."""
+        return self.repo.advertise_refs()
+
+    def negotiate(self, haves):
+        """Return the commits from `haves` the remote also has."""
+        return self.repo.negotiate(haves)
+
+    def fetch_pack(self, wants, haves, shallow=()):
+        """Return a readable binary file holding a pack of what `wants` needs beyond `haves`.
+
+        `shallow` lists the commits at the boundary of a shallow fetcher.
+        """
+        pack = tempfile.TemporaryFile()
+        try:
+            self.repo.upload_pack(pack, wants, haves, shallow)
+        except BaseException:
+            pack.close()
+            raise
+        pack.seek(0)
+        return pack
+
+    def receive_pack(self, pack, updates):
+        """Send a pack and the branch updates that depend on it."""
+        self.repo.receive_pack(pack, updates)
+
+
+class HttpTransport:
+    """Talks to a repository served by `vcs serve` over HTTP."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def _open(self, path, body=None, headers=None):
+        request = urllib.request.Request(self.url + path, data=body, headers=headers or {})
+        try:
+            return urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            raise Exception(f"Remote error: {e.read().decode(errors='replace') or e.reason}")
+        except urllib.error.URLError as e:
+            raise Exception(f"Could not reach '{self.url}': {e.reason}")
+
+    def _post_json(self, path, payload):
+        return self._open(path, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+
+    def list_refs(self):
+        """Return the remote's branches as a name -> commit id mapping."""
+        with self._open("/refs") as response:
+            return json.load(response)
+
+    def negotiate(self, haves):
+        """Return the commits from `haves` the remote also has."""
+        with self._post_json("/negotiate", {"haves": haves}) as response:
+            return json.load(response)["common"]
+
+    def fetch_pack(self, wants, haves, shallow=()):
+        """Return the response stream carrying a pack of what `wants` needs beyond `haves`."""
+        return self._post_json("/fetch", {"wants": wants, "haves": haves, "shallow": sorted(shallow)})
+
+    def receive_pack(self, pack, updates):
+        """Send a pack and the branch updates that depend on it."""
+        pack.seek(0, 2)
+        size = pack.tell()
+        pack.seek(0)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(size),
+            "X-Vcs-Updates": json.dumps(updates),
+        }
+        self._open("/push", pack, headers).close()
+
+
+def open_transport(location, open_repo):
+    """Return the transport for a URL, or for a path opened with open_repo(path)."""
+    if location.startswith(("http://", "https://")):
+        return HttpTransport(location)
+    return LocalTransport(open_repo(location))
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Serves refs, negotiation, fetch and push requests for one repository."""
+
+    open_repo = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        body = message.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def do_GET(self):
+        if self.path != "/refs":
+            return self._send_error(404, f"Unknown path '{self.path}'.")
+        try:
+            self._send_json(self.open_repo().advertise_refs())
+        except Exception as e:
+            self._send_error(500, str(e))
+
+    def do_POST(self):
+        # Every request gets its own Repository, so concurrent requests never share state.
+        try:
+            repo = self.open_repo()
+            if self.path == "/negotiate":
+                self._send_json({"common": repo.negotiate(self._read_json()["haves"])})
+            elif self.path == "/fetch":
+                request = self._read_json()
+                with tempfile.TemporaryFile() as pack:
+                    repo.upload_pack(pack, request["wants"], request["haves"], request.get("shallow", ()))
+                    size = pack.tell()
+                    pack.seek(0)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(size))
+                    self.end_headers()
+                    shutil.copyfileobj(pack, self.wfile)
+            elif self.path == "/push":
+                updates = json.loads(self.headers["X-Vcs-Updates"])
+                with tempfile.TemporaryFile() as pack:
+                    remaining = int(self.headers["Content-Length"])
+                    while remaining:
+                        chunk = self.rfile.read(min(remaining, 1 << 20))
+                        if not chunk:
+                            raise Exception("Pack upload ended unexpectedly.")
+                        pack.write(chunk)
+                        remaining -= len(chunk)
+                    pack.seek(0)
+                    repo.receive_pack(pack, updates)
+                self._send_json({"ok": True})
+            else:
+                self._send_error(404, f"Unknown path '{self.path}'.")
+        except Exception as e:
+            self._send_error(400, str(e))
+
+
+def make_server(open_repo, host="127.0.0.1", port=0):
+    """Create an HTTP server for a repository; open_repo() returns a fresh Repository.
+
+    Call serve_forever() on the result to start answering requests.
+    """
+    handler = type("RequestHandler", (_RequestHandler,), {"open_repo": staticmethod(open_repo)})
+    return ThreadingHTTPServer((host, port), handler)
@@ -9,7 +9,14 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import sys
 import os
 import argparse
+import cProfile
+import io
+import re
+import json
 from src.repo import Repository
+from src.daemon import parse_request, RepositoryPool, make_daemon, DaemonClient
+from src.trace import TRACER
+from src.commitgraph import draw_graph
 from src.utils import display_progress, display_message
 from colorama import Fore, Style, init
 
@@ -50,10 +57,37 @@ def execute_command_in_shell(command):
     else:
         print(Fore.RED + "Invalid shell command.")
 
-def main():
-    print(Fore.CYAN + "Welcome to the Python-based Distributed Version Control System\n")
-    
-    parser = argparse.ArgumentParser(description="Python-based Distributed Version Control System")
+def print_status(status, out=None):
+    """Print the sections of a status report that have entries."""
+    sections = [
+        ("conflicts", "Unresolved conflicts:", Fore.RED),
+        ("staged", "Staged for commit:", Fore.GREEN),
+        ("modified", "Modified:", Fore.YELLOW),
+        ("deleted", "Deleted:", Fore.RED),
+        ("new", "Untracked:", Fore.CYAN),
+    ]
+    if not any(status.values()):
+        print(Fore.GREEN + "Nothing to commit, working tree clean.", file=out)
+    for key, title, color in sections:
+        if status[key]:
+            print(color + title, file=out)
+            for path in status[key]:
+                print(color + f" - {path}", file=out)
+
+class BatchParser(argparse.ArgumentParser):
+    """Reports bad arguments as exceptions, so one bad line does not end a batch or the daemon."""
+
+    def error(self, message):
+        raise Exception(f"{self.prog}: error: {message}")
+
+def build_parser(parser_class=argparse.ArgumentParser):
+    """Build the command line parser; subcommand parsers are of the same class."""
+    parser = parser_class(description="Python-based Distributed Version Control System")
+    parser.add_argument("--trace", metavar="FILE", help="Write a Chrome trace of the command's phases and I/O counters to FILE")
+    parser.add_argument("--profile", metavar="FILE", help="Write cProfile statistics for the command to FILE")
+    parser.add_argument("--batch", metavar="FILE", nargs="?", const="-", help="Run the commands in FILE (or stdin), one per line, printing a JSON result for each")
+    parser.add_argument("--daemon", metavar="SOCKET", help="Serve commands on a Unix socket, keeping repositories open between them")
+    parser.add_argument("--connect", metavar="SOCKET", help="Send the command or batch to the daemon listening on SOCKET")
     subparsers = parser.add_subparsers(dest="command")
 
     # Initialize a repository
@@ -63,13 +97,18 @@ def main():
     # Add a file to staging
     parser_add = subparsers.add_parser("add")
     parser_add.add_argument("repo_name", help="Repository name")
-    parser_add.add_argument("file_name", help="File to add to staging")
+    parser_add.add_argument("file_names", nargs="*", help="Files, directories or glob patterns to add to staging")
+    parser_add.add_argument("-A", "--all", action="store_true", help="Stage every new, modified and deleted file")
 
     # Commit changes
     parser_commit = subparsers.add_parser("commit")
     parser_commit.add_argument("repo_name", help="Repository name")
     parser_commit.add_argument("message", help="Commit message")
 
+    # Show working tree status
+    parser_status = subparsers.add_parser("status")
+    parser_status.add_argument("repo_name", help="Repository name")
+
     # Create a branch
     parser_branch = subparsers.add_parser("branch")
     parser_branch.add_argument("repo_name", help="Repository name")
@@ -84,39 +123,125 @@ def main():
     parser_clone = subparsers.add_parser("clone")
     parser_clone.add_argument("repo_name", help="Repository name to clone")
     parser_clone.add_argument("new_name", help="Name of the cloned repository")
+    parser_clone.add_argument("--depth", type=int, help="Copy only the last N commits of history")
+    parser_clone.add_argument("--branch", help="Copy only this branch")
+
+    # Register a remote repository
+    parser_remote = subparsers.add_parser("remote")
+    parser_remote.add_argument("repo_name", help="Repository name")
+    parser_remote.add_argument("remote_name", help="Short name for the remote")
+    parser_remote.add_argument("location", help="Path or http:// URL of the remote repository")
+
+    # Exchange commits with another repository
+    parser_fetch = subparsers.add_parser("fetch")
+    parser_fetch.add_argument("repo_name", help="Repository name")
+    parser_fetch.add_argument("remote", nargs="?", default="origin", help="Remote name, path or URL")
+
+    parser_pull = subparsers.add_parser("pull")
+    parser_pull.add_argument("repo_name", help="Repository name")
+    parser_pull.add_argument("remote", nargs="?", default="origin", help="Remote name, path or URL")
+    parser_pull.add_argument("--branch", help="Remote branch to merge (defaults to the current branch)")
+
+    parser_push = subparsers.add_parser("push")
+    parser_push.add_argument("repo_name", help="Repository name")
+    parser_push.add_argument("remote", nargs="?", default="origin", help="Remote name, path or URL")
+    parser_push.add_argument("--branch", help="Branch to push (defaults to the current branch)")
+    parser_push.add_argument("-f", "--force", action="store_true", help="Overwrite the remote branch even if it diverged")
+
+    parser_serve = subparsers.add_parser("serve")
+    parser_serve.add_argument("repo_name", help="Repository name")
+    parser_serve.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser_serve.add_argument("--port", type=int, default=8417, help="Port to listen on")
+
+    # Repack and prune the object store
+    parser_gc = subparsers.add_parser("gc")
+    parser_gc.add_argument("repo_name", help="Repository name")
+    parser_gc.add_argument("--keep-unreachable", action="store_true", help="Pack unreachable objects instead of deleting them")
 
     # View commit history
     parser_log = subparsers.add_parser("log")
     parser_log.add_argument("repo_name", help="Repository name")
+    parser_log.add_argument("revision", nargs="?", help="Branch, commit or range A..B to walk instead of the whole log")
+    parser_log.add_argument("--graph", action="store_true", help="Draw branch and merge lines next to the commits")
+    parser_log.add_argument("-n", "--limit", type=int, help="Show at most this many commits")
+    parser_log.add_argument("--since", help="Only commits on or after this date (YYYY-MM-DD)")
+    parser_log.add_argument("--until", help="Only commits on or before this date (YYYY-MM-DD)")
+    parser_log.add_argument("--grep", help="Only commits whose message matches this pattern")
+    parser_log.add_argument("--path", help="Only commits that touched this file or directory")
+
+    # Show the commit that last changed each line of a file
+    parser_blame = subparsers.add_parser("blame")
+    parser_blame.add_argument("repo_name", help="Repository name")
+    parser_blame.add_argument("file_name", help="File to annotate")
+    parser_blame.add_argument("revision", nargs="?", help="Branch or commit to annotate instead of HEAD")
+
+    # Search committed files, or every version in history, for a pattern
+    parser_grep = subparsers.add_parser("grep")
+    parser_grep.add_argument("repo_name", help="Repository name")
+    parser_grep.add_argument("pattern", help="Regular expression to search for")
+    parser_grep.add_argument("--all-history", action="store_true", help="Search every version of every file, not just the latest commit")
+    parser_grep.add_argument("--branch", help="Search this branch instead of the active one")
+    parser_grep.add_argument("-i", "--ignore-case", action="store_true", help="Match regardless of case")
+
+    # Precompute generation numbers for ancestry queries
+    parser_graph = subparsers.add_parser("commit-graph")
+    parser_graph.add_argument("repo_name", help="Repository name")
 
     # Merge branches
     parser_merge = subparsers.add_parser("merge")
     parser_merge.add_argument("repo_name", help="Repository name")
-    parser_merge.add_argument("branch_name", help="Branch to merge into current branch")
+    parser_merge.add_argument("branch_name", nargs="?", help="Branch to merge into current branch")
+    parser_merge.add_argument("--abort", action="store_true", help="Abandon the merge in progress and restore the current branch's files")
 
     # View differences between branches
     parser_diff = subparsers.add_parser("diff")
     parser_diff.add_argument("repo_name", help="Repository name")
     parser_diff.add_argument("branch_name", help="Branch to compare against the current branch")
+    diff_mode = parser_diff.add_mutually_exclusive_group()
+    diff_mode.add_argument("--stat", action="store_const", const="stat", dest="mode", help="Show changed line counts per file")
+    diff_mode.add_argument("--name-only", action="store_const", const="name-only", dest="mode", help="Show only the names of changed files")
 
     # Ignore files
     parser_ignore = subparsers.add_parser("ignore")
     parser_ignore.add_argument("repo_name", help="Repository name")
-    parser_ignore.add_argument("file_name", help="File to add to the ignore list")
+    parser_ignore.add_argument("file_name", help="File name or .gitignore-style pattern to ignore")
+
+    # Read or change repository settings
+    parser_config = subparsers.add_parser("config")
+    parser_config.add_argument("repo_name", help="Repository name")
+    parser_config.add_argument("key", help="Setting to read or change", nargs='?')
+    parser_config.add_argument("value", help="New value for the setting", nargs='?')
 
     # View ignored files
     parser_view_ignore = subparsers.add_parser("view_ignore_list")
     parser_view_ignore.add_argument("repo_name", help="Repository name")
 
-    args = parser.parse_args()
+    return parser
+
+def split_log_paths(argv):
+    """Split "log <repo> -- <path>" at "--", as in git; argparse would treat the path as the revision."""
+    if "--" in argv and "log" in argv[:argv.index("--")]:
+        return argv[:argv.index("--")], argv[argv.index("--") + 1:]
+    return argv, []
+
+def main():
+    argv, log_paths = split_log_paths(sys.argv[1:])
+    args = build_parser().parse_args(argv)
+    if args.batch is None:
+        print(Fore.CYAN + "Welcome to the Python-based Distributed Version Control System\n")
+
+    if args.daemon or args.batch is not None or args.connect:
+        run, name = (lambda: run_service(args, sys.argv[1:])), "daemon" if args.daemon else "batch"
+    else:
+        run, name = (lambda: run_command(args, log_paths)), args.command
 
     # Default to interactive if no command was passed
-    if not args.command:
+    if not name:
         print(Fore.YELLOW + "No command passed. Switching to interactive mode.")
         while True:
             try:
                 print(Fore.MAGENTA + f"Current directory: {os.getcwd()}")
-                print(Fore.MAGENTA + "Choose an action: init, add, commit, branch, switch_branch, clone, log, merge, diff, ignore, view_ignore_list, shell (to enter shell mode), or exit")
+                print(Fore.MAGENTA + "Choose an action: init, add, commit, status, branch, switch_branch, clone, log, merge, diff, ignore, view_ignore_list, shell (to enter shell mode), or exit")
                 command = input(Fore.GREEN + "Command: ").strip().lower()
 
                 if command == "init":
@@ -126,10 +251,10 @@ def main():
                     print(Fore.GREEN + f"Repository '{repo_name}' initialized.")
                 elif command == "add":
                     repo_name = get_input("Enter repository name")
-                    file_name = get_input("Enter file name")
+                    file_name = get_input("Enter file name, directory or pattern", ".")
                     repo = Repository(repo_name)
-                    repo.add(file_name)
-                    print(Fore.GREEN + f"File '{file_name}' staged.")
+                    staged = repo.add(file_name)
+                    print(Fore.GREEN + f"{len(staged)} file(s) staged.")
                 elif command == "commit":
                     repo_name = get_input("Enter repository name")
                     message = get_input("Enter commit message")
@@ -137,6 +262,10 @@ def main():
                     repo.commit(message)
                     display_progress("Committing changes", steps=3)
                     print(Fore.GREEN + f"Commit added: {message}")
+                elif command == "status":
+                    repo_name = get_input("Enter repository name")
+                    repo = Repository(repo_name)
+                    print_status(repo.status())
                 elif command == "branch":
                     repo_name = get_input("Enter repository name")
                     branch_name = get_input("Enter branch name")
@@ -159,17 +288,16 @@ def main():
                 elif command == "log":
                     repo_name = get_input("Enter repository name")
                     repo = Repository(repo_name)
-                    history = repo.view_commit_history()
                     print(Fore.CYAN + "Commit History:")
-                    for commit in history:
+                    for commit in repo.iter_history():
                         print(Fore.YELLOW + f" - {commit['date']}: {commit['message']}")
                 elif command == "merge":
                     repo_name = get_input("Enter repository name")
                     branch_name = get_input("Enter branch to merge")
                     repo = Repository(repo_name)
                     try:
-                        repo.merge(branch_name)
-                        print(Fore.GREEN + f"Branch '{branch_name}' merged successfully.")
+                        result = repo.merge(branch_name)
+                        print(Fore.GREEN + f"Branch '{branch_name}' merged successfully. {result}")
                     except Exception as e:
                         print(Fore.RED + str(e))
                 elif command == "diff":
@@ -212,52 +340,260 @@ def main():
         return
 
     # Execute commands based on parsed arguments
-    repo = Repository(args.repo_name)
+    if args.trace:
+        TRACER.start()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
     try:
-        if args.command == "init":
-            repo.create_repo()
-            print(Fore.GREEN + f"Repository '{args.repo_name}' initialized.")
-        elif args.command == "add":
-            repo.add(args.file_name)
-            print(Fore.GREEN + f"File '{args.file_name}' staged.")
-        elif args.command == "commit":
-            repo.commit(args.message)
-            display_progress("Committing changes", steps=3)
-            print(Fore.GREEN + f"Commit added: {args.message}")
-        elif args.command == "branch":
-            repo.create_branch(args.branch_name)
-            print(Fore.GREEN + f"Branch '{args.branch_name}' created.")
-        elif args.command == "switch_branch":
-            repo.switch_branch(args.branch_name)
-            print(Fore.GREEN + f"Switched to branch '{args.branch_name}'.")
-        elif args.command == "clone":
-            repo.clone(args.new_name)
-            display_progress("Cloning repository", steps=5)
-            print(Fore.GREEN + f"Repository '{args.repo_name}' cloned as '{args.new_name}'.")
-        elif args.command == "log":
-            history = repo.view_commit_history()
-            print(Fore.CYAN + "Commit History:")
+        with TRACER.span(f"vcs {name}"):
+            status = run()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(Fore.CYAN + f"Profile written to '{args.profile}'.", file=sys.stderr)
+        if args.trace:
+            TRACER.stop()
+            TRACER.write_chrome_trace(args.trace)
+            print(Fore.CYAN + f"Trace written to '{args.trace}'.", file=sys.stderr)
+    if status:
+        sys.exit(status)
+
+def client_path(path, cwd):
+    """Return a path given by a daemon client as seen from its working directory `cwd`.
+
+    URLs, and paths given to a command running in its own process (`cwd` is None), are unchanged.
+    """
+    if cwd is None or path.startswith(("http://", "https://")):
+        return path
+    return os.path.join(cwd, path)
+
+def execute(args, log_paths, repo, out, cwd=None):
+    """Run one parsed non-interactive command on `repo`, printing to `out`; errors are raised.
+
+    Paths of other repositories are resolved against `cwd`; see client_path.
+    """
+    remote = getattr(args, "remote", None)
+    if remote is not None and remote not in repo._load_remotes():
+        remote = client_path(remote, cwd)
+    if args.command == "init":
+        repo.create_repo()
+        print(Fore.GREEN + f"Repository '{args.repo_name}' initialized.", file=out)
+    elif args.command == "add":
+        if not args.file_names and not args.all:
+            raise Exception("Nothing specified, nothing added.")
+        staged = repo.add(*args.file_names, stage_all=args.all)
+        print(Fore.GREEN + f"{len(staged)} file(s) staged.", file=out)
+    elif args.command == "commit":
+        repo.commit(args.message)
+        print(Fore.GREEN + f"Commit added: {args.message}", file=out)
+    elif args.command == "status":
+        print_status(repo.status(), out)
+    elif args.command == "branch":
+        repo.create_branch(args.branch_name)
+        print(Fore.GREEN + f"Branch '{args.branch_name}' created.", file=out)
+    elif args.command == "switch_branch":
+        repo.switch_branch(args.branch_name)
+        print(Fore.GREEN + f"Switched to branch '{args.branch_name}'.", file=out)
+    elif args.command == "clone":
+        repo.clone(client_path(args.new_name, cwd), depth=args.depth, branch=args.branch)
+        print(Fore.GREEN + f"Repository '{args.repo_name}' cloned as '{args.new_name}'.", file=out)
+    elif args.command == "remote":
+        repo.add_remote(args.remote_name, client_path(args.location, cwd))
+        print(Fore.GREEN + f"Remote '{args.remote_name}' added.", file=out)
+    elif args.command == "fetch":
+        remote_refs = repo.fetch(remote)
+        print(Fore.GREEN + f"Fetched {len(remote_refs)} branch(es) from '{args.remote}'.", file=out)
+    elif args.command == "pull":
+        print(Fore.GREEN + repo.pull(remote, branch=args.branch), file=out)
+    elif args.command == "push":
+        print(Fore.GREEN + repo.push(remote, branch=args.branch, force=args.force), file=out)
+    elif args.command == "serve":
+        server = repo.serve(args.host, args.port)
+        print(Fore.GREEN + f"Serving '{args.repo_name}' on http://{args.host}:{server.server_address[1]}", file=out, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    elif args.command == "gc":
+        stats = repo.gc(prune=not args.keep_unreachable)
+        print(Fore.GREEN + f"Packed {stats['objects']} object(s), {stats['deltas']} as deltas; "
+              f"pruned {stats['pruned']}. {stats['size_before']} -> {stats['size_after']} bytes.", file=out)
+    elif args.command == "log":
+        if len(log_paths) > 1:
+            raise Exception("Only one path can follow '--'.")
+        revision = args.revision or ("HEAD" if args.graph else None)
+        history = repo.iter_history(
+            limit=args.limit, since=args.since, until=args.until,
+            grep=args.grep, path=log_paths[0] if log_paths else args.path, revision=revision,
+        )
+        print(Fore.CYAN + "Commit History:", file=out)
+        if args.graph:
+            for lanes, commit in draw_graph(history):
+                if commit is None:
+                    print(Fore.MAGENTA + lanes, file=out, flush=True)
+                else:
+                    print(Fore.MAGENTA + lanes + Fore.YELLOW + f" {commit['commit'][:7]} {commit['date']}: {commit['message']}", file=out, flush=True)
+        else:
             for commit in history:
-                print(Fore.YELLOW + f" - {commit['date']}: {commit['message']}")
-        elif args.command == "merge":
-            repo.merge(args.branch_name)
-            print(Fore.GREEN + f"Branch '{args.branch_name}' merged successfully.")
-        elif args.command == "diff":
-            diff = repo.diff(args.branch_name)
-            print(Fore.CYAN + "Differences:")
-            print(Fore.YELLOW + diff)
-        elif args.command == "ignore":
-            repo.ignore(args.file_name)
-            print(Fore.GREEN + f"File '{args.file_name}' added to the ignore list.")
-        elif args.command == "view_ignore_list":
-            ignored_files = repo.view_ignore_list()
-            print(Fore.CYAN + "Ignored Files:")
-            for file in ignored_files:
-                print(Fore.YELLOW + f" - {file}")
+                print(Fore.YELLOW + f" - {commit['date']}: {commit['message']}", file=out, flush=True)
+    elif args.command == "grep":
+        matches = repo.grep(args.pattern, all_history=args.all_history, branch=args.branch, ignore_case=args.ignore_case)
+        for commit_id, path, number, line in matches:
+            prefix = f"{commit_id[:7]}:" if args.all_history else ""
+            print(Fore.MAGENTA + f"{prefix}{path}:{number}:" + Style.RESET_ALL + line, file=out, flush=True)
+    elif args.command == "blame":
+        dates = {}
+        for number, (commit_id, line) in enumerate(repo.blame(args.file_name, args.revision), 1):
+            if commit_id not in dates:
+                dates[commit_id] = repo.commit_graph.date(commit_id)
+            print(Fore.YELLOW + f"{commit_id[:7]} ({dates[commit_id]} {number:>4}) " + Style.RESET_ALL + line, file=out, flush=True)
+    elif args.command == "commit-graph":
+        count = repo.write_commit_graph()
+        print(Fore.GREEN + f"Commit graph written with {count} commit(s).", file=out)
+    elif args.command == "merge" and args.abort:
+        repo.abort_merge()
+        print(Fore.GREEN + "Merge aborted.", file=out)
+    elif args.command == "merge":
+        if not args.branch_name:
+            raise Exception("Name the branch to merge, or use --abort.")
+        result = repo.merge(args.branch_name)
+        print(Fore.GREEN + f"Branch '{args.branch_name}' merged successfully. {result}", file=out)
+    elif args.command == "diff":
+        diff = repo.diff(args.branch_name, mode=args.mode or "patch")
+        print(Fore.CYAN + "Differences:", file=out)
+        print(Fore.YELLOW + diff, file=out)
+    elif args.command == "ignore":
+        repo.ignore(args.file_name)
+        print(Fore.GREEN + f"File '{args.file_name}' added to the ignore list.", file=out)
+    elif args.command == "config":
+        if args.value is not None:
+            repo.set_config(args.key, args.value)
+            print(Fore.GREEN + f"Setting '{args.key}' set to {args.value}.", file=out)
         else:
-            parser.print_help()
+            for key, value in repo._load_config().items():
+                if args.key in (None, key):
+                    print(Fore.YELLOW + f"{key} = {value}", file=out)
+    elif args.command == "view_ignore_list":
+        ignored_files = repo.view_ignore_list()
+        print(Fore.CYAN + "Ignored Files:", file=out)
+        for file in ignored_files:
+            print(Fore.YELLOW + f" - {file}", file=out)
+
+def run_command(args, log_paths):
+    """Run one parsed non-interactive command, reporting errors in red."""
+    try:
+        if not args.repo_name:
+            raise Exception("A repository name is required.")
+        execute(args, log_paths, Repository(args.repo_name), sys.stdout)
     except Exception as e:
         print(Fore.RED + str(e))
 
+ANSI_CODES = re.compile(r"\x1b\[[0-9;]*m")
+
+def run_request(parser, pool, argv, cwd=None):
+    """Run one command of a batch or daemon client with a repository from `pool`.
+
+    `cwd` is the daemon client's working directory; see client_path. Returns {"ok", "output"} with the colours stripped from the output, plus
+    "error" when the command failed.
+    """
+    out = io.StringIO()
+    try:
+        argv, log_paths = split_log_paths(list(argv))
+        args = parser.parse_args(argv)
+        if args.trace or args.profile or args.batch is not None or args.daemon or args.connect:
+            raise Exception("--trace, --profile, --batch, --daemon and --connect apply to a whole run, not to one command.")
+        if args.command in (None, "serve"):
+            raise Exception(f"'{args.command or 'interactive mode'}' cannot run in a batch or the daemon.")
+        if not args.repo_name:
+            raise Exception("A repository name is required.")
+        with TRACER.span(f"vcs {args.command}"), pool.open(client_path(args.repo_name, cwd)) as repo:
+            execute(args, log_paths, repo, out, cwd)
+    except SystemExit:
+        return {"ok": False, "output": ANSI_CODES.sub("", out.getvalue()), "error": "Help is not available in a batch or the daemon."}
+    except Exception as e:
+        return {"ok": False, "output": ANSI_CODES.sub("", out.getvalue()), "error": str(e)}
+    return {"ok": True, "output": ANSI_CODES.sub("", out.getvalue())}
+
+def run_batch(lines, run, out):
+    """Run each request line of a batch with run(request), writing one JSON result line per command.
+
+    Returns the number of commands that failed. Results carry the "id" of
+    their request, if it had one.
+    """
+    failures = 0
+    for number, line in enumerate(lines, 1):
+        try:
+            request = parse_request(line)
+        except Exception as e:
+            request, result = {}, {"ok": False, "output": "", "error": f"Line {number}: {e}"}
+        else:
+            if request is None:
+                continue
+            result = run(request)
+        if "id" in request:
+            result["id"] = request["id"]
+        failures += not result["ok"]
+        print(json.dumps(result), file=out, flush=True)
+    return failures
+
+def _without_option(argv, option):
+    """Return argv without `option` and its value, in either "--opt value" or "--opt=value" form."""
+    remaining = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            remaining.append(arg)
+    return remaining
+
+def run_service(args, argv):
+    """Run as the daemon, run a batch, or forward a command to a daemon; returns the exit status."""
+    if args.daemon:
+        pool = RepositoryPool()
+        parser = build_parser(BatchParser)
+        server = make_daemon(args.daemon, lambda request_argv, cwd: run_request(parser, pool, request_argv, cwd))
+        print(Fore.GREEN + f"Daemon listening on '{args.daemon}'.", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.daemon)
+        return 0
+
+    if args.connect:
+        client = DaemonClient(args.connect)
+        run = client.run
+    else:
+        client = None
+        pool = RepositoryPool()
+        parser = build_parser(BatchParser)
+        run = lambda request: run_request(parser, pool, request["args"])
+    try:
+        if args.batch is None:
+            # A single command for the daemon; tracing and profiling stay with this process.
+            for option in ("--connect", "--trace", "--profile"):
+                argv = _without_option(argv, option)
+            result = run({"args": argv})
+            if result["output"]:
+                print(result["output"], end="")
+            if not result["ok"]:
+                print(Fore.RED + result["error"])
+                return 1
+            return 0
+        if args.batch == "-":
+            return 1 if run_batch(sys.stdin, run, sys.stdout) else 0
+        with open(args.batch, 'r') as f:
+            return 1 if run_batch(f, run, sys.stdout) else 0
+    finally:
+        if client is not None:
+            client.close()
+
 if __name__ == "__main__":
     main()
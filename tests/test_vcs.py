@@ -1,8 +1,28 @@
 import os
+import io
 import json
 import unittest
 import shutil
+import tempfile
+import threading
+from datetime import datetime
+from unittest import mock
 from src.repo import Repository
+from src.diff import matching_blocks
+from src.index import Index
+from src.lock import RepositoryLock
+from src.refs import Refs, MISSING
+from src.pack import make_delta, apply_delta
+from src.ignore import IgnoreMatcher
+from src.merge import merge_base, is_ancestor
+from src.commitgraph import GENERATION_INFINITY, draw_graph
+from src.search import required_literals
+from src.chunking import chunk_boundaries
+from src import trace
+from src.daemon import RepositoryPool, make_daemon, DaemonClient
+from src.vcs import build_parser, BatchParser, run_request, run_batch
+from benchmarks.generate import generate_repo
+from benchmarks.run import run_benchmarks, compare
 
 class TestRepository(unittest.TestCase):
     TEST_REPO = "test_repo"
@@ -53,5 +73,1062 @@ class TestRepository(unittest.TestCase):
         history = self.repo.view_commit_history()
         self.assertTrue(any("file_a.txt" in c["files"] for c in history))
 
+    def test_object_store_deduplicates_content(self):
+        for name in ("a.txt", "b.txt"):
+            with open(os.path.join(self.TEST_REPO, name), "w") as f:
+                f.write("same content")
+            self.repo.add(name)
+        self.repo.commit("Add duplicate files")
+        self.repo.create_branch("copy")
+        self.assertEqual(self.repo.refs.read("main"), self.repo.refs.read("copy"))
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(tree["a.txt"], tree["b.txt"])
+        self.assertEqual(self.repo.objects.read_blob(tree["a.txt"]), b"same content")
+
+    def test_legacy_branches_are_migrated(self):
+        with open(self.repo.branch_file, "w") as f:
+            json.dump({"main": [{"file": "old.txt", "content": "v1"},
+                                {"file": "old.txt", "content": "v2"}], "empty": []}, f)
+        self.repo._migrate_branch_file()
+        self.assertFalse(os.path.exists(self.repo.branch_file))
+        self.assertIsNone(self.repo.refs.read("empty"))
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(self.repo.objects.read_blob(tree["old.txt"]), b"v2")
+
+    def test_blame_after_legacy_migrations(self):
+        with open(self.repo.branch_file, "w") as f:
+            json.dump({"main": [{"file": "old.txt", "content": "v1\n"}]}, f)
+        self.repo._migrate_branch_file()
+        imported = self.repo.refs.read("main")
+        self.assertEqual(self.repo.blame("old.txt"), [(imported, "v1")])
+
+        # A repository upgraded before import commits were logged has them logged on first use.
+        tree = self.repo.objects.write_tree({"older.txt": self.repo.objects.write_blob(b"v0\n")})
+        unlogged = self.repo.objects.write_commit(tree, [], "Import legacy branch contents", "1970-01-01 00:00:00")
+        self.repo.refs.write("old", unlogged)
+        with mock.patch("src.repo.rmtree") as rmtree:
+            self.assertEqual(self.repo.blame("older.txt", "old"), [(unlogged, "v0")])
+            self.assertEqual(self.repo.blame("older.txt", "old"), [(unlogged, "v0")])
+        rmtree.assert_not_called()
+        self.assertEqual(sum(entry.get("commit") == unlogged for entry in self.repo.log), 1)
+
+    def test_commit_log_tail_and_migration(self):
+        os.remove(self.repo.log.log_file)
+        os.remove(self.repo.log.index_file)
+        with open(self.repo.history_file, "w") as f:
+            json.dump([{"message": f"m{i}", "date": "2024-01-01 00:00:00", "files": []}
+                       for i in range(5)], f)
+        self.assertEqual(len(self.repo.view_commit_history()), 5)
+        self.assertFalse(os.path.exists(self.repo.history_file))
+        with open(os.path.join(self.TEST_REPO, "x.txt"), "w") as f:
+            f.write("x")
+        self.repo.add("x.txt")
+        self.repo.commit("sixth")
+        tail = self.repo.view_commit_history(limit=2)
+        self.assertEqual([c["message"] for c in tail], ["m4", "sixth"])
+
+    def test_commit_log_recovers_torn_write(self):
+        self.repo.log.append({"message": "ok"})
+        with open(self.repo.log.log_file, "ab") as f:
+            f.write(b'{"message": "to')
+        self.repo.log.append({"message": "after"})
+        self.assertEqual([e["message"] for e in self.repo.log], ["ok", "after"])
+
+    def test_iter_history_filters(self):
+        entries = [
+            ("2024-01-01 10:00:00", "fix parser", ["src/a.py"]),
+            ("2024-02-01 10:00:00", "add docs", ["docs/readme.md"]),
+            ("2024-03-01 10:00:00", "fix docs", ["docs/guide.md"]),
+            ("2024-04-01 10:00:00", "release", ["setup.py"]),
+        ]
+        for date, message, files in entries:
+            self.repo.log.append({"message": message, "date": date, "files": files})
+        messages = lambda **kw: [c["message"] for c in self.repo.iter_history(**kw)]
+        self.assertEqual(messages(limit=2), ["release", "fix docs"])
+        self.assertEqual(messages(grep="^fix"), ["fix docs", "fix parser"])
+        self.assertEqual(messages(path="docs"), ["fix docs", "add docs"])
+        self.assertEqual(messages(since="2024-02-01", until="2024-03-01"), ["fix docs", "add docs"])
+        with self.assertRaises(Exception):
+            list(self.repo.iter_history(since="yesterday"))
+
+    def test_status_reports_changes(self):
+        for name in ("keep.txt", "edit.txt", "gone.txt"):
+            with open(os.path.join(self.TEST_REPO, name), "w") as f:
+                f.write(name)
+            self.repo.add(name)
+        self.repo.commit("Track files")
+        self.assertFalse(any(self.repo.status().values()))
+
+        with open(os.path.join(self.TEST_REPO, "edit.txt"), "w") as f:
+            f.write("changed")
+        os.remove(os.path.join(self.TEST_REPO, "gone.txt"))
+        with open(os.path.join(self.TEST_REPO, "fresh.txt"), "w") as f:
+            f.write("new")
+        status = self.repo.status()
+        self.assertEqual(status["modified"], ["edit.txt"])
+        self.assertEqual(status["deleted"], ["gone.txt"])
+        self.assertEqual(status["new"], ["fresh.txt"])
+        self.assertEqual(status["staged"], [])
+
+    def test_status_skips_hashing_unchanged_files(self):
+        with open(os.path.join(self.TEST_REPO, "a.txt"), "w") as f:
+            f.write("a")
+        with mock.patch("src.index.RACY_WINDOW_NS", 0):
+            self.repo.add("a.txt")
+            self.repo.commit("Add a.txt")
+            with mock.patch.object(self.repo.objects, "hash_file") as hash_file:
+                self.repo.status()
+            hash_file.assert_not_called()
+
+    def test_status_does_not_wait_for_writers(self):
+        self._commit_file("a.txt", "a", "Add a.txt")
+        path = os.path.join(self.TEST_REPO, "a.txt")
+        past = os.stat(path).st_mtime - 100
+        os.utime(path, (past, past))
+        index_signature = lambda: os.stat(self.repo.index_file).st_mtime_ns
+        before = index_signature()
+        self.repo.set_config("lock_timeout", 1)
+        with RepositoryLock(self.repo.repo_dir):
+            self.assertFalse(any(self.repo.status().values()))
+        self.assertEqual(index_signature(), before)
+        # With the lock free, the refreshed stat data is saved.
+        reader = Repository(self.TEST_REPO)
+        self.assertFalse(any(reader.status().values()))
+        self.assertNotEqual(index_signature(), before)
+        self.assertTrue(reader._load_index().is_fresh("a.txt", os.stat(path)))
+
+    def test_add_directories_globs_and_all(self):
+        os.makedirs(os.path.join(self.TEST_REPO, "pkg", "sub"))
+        for name in ("pkg/a.py", "pkg/sub/b.py", "pkg/notes.txt", "top.py", "build.log"):
+            with open(os.path.join(self.TEST_REPO, name), "w") as f:
+                f.write(name)
+        self.repo.ignore("build.log")
+        self.assertEqual(sorted(self.repo.add("pkg")), ["pkg/a.py", "pkg/notes.txt", "pkg/sub/b.py"])
+        self.repo.commit("Add pkg")
+        self.assertEqual(self.repo.add("**/*.py"), ["top.py"])
+        self.repo.commit("Add top.py")
+
+        os.remove(os.path.join(self.TEST_REPO, "pkg", "notes.txt"))
+        with open(os.path.join(self.TEST_REPO, "pkg", "a.py"), "w") as f:
+            f.write("changed")
+        self.assertEqual(sorted(self.repo.add(stage_all=True)), ["pkg/a.py", "pkg/notes.txt"])
+        self.repo.commit("Update pkg")
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(sorted(tree), ["pkg/a.py", "pkg/sub/b.py", "top.py"])
+
+    def test_add_rejects_paths_outside_the_working_tree(self):
+        outside = os.path.abspath("outside.txt")
+        with open(outside, "w") as f:
+            f.write("secret")
+        try:
+            for name in ("../outside.txt", "pkg/../../outside.txt", outside, ".vcs/HEAD", "./.vcs"):
+                with self.assertRaises(Exception):
+                    self.repo.add(name)
+        finally:
+            os.remove(outside)
+        with open(os.path.join(self.TEST_REPO, "a.txt"), "w") as f:
+            f.write("a")
+        self.assertEqual(self.repo.add(os.path.abspath(os.path.join(self.TEST_REPO, "a.txt"))), ["a.txt"])
+        self.assertEqual(list(self.repo._load_index().entries), ["a.txt"])
+
+    def test_streamed_blobs_match_in_memory_blobs(self):
+        content = os.urandom(300000)
+        with open(os.path.join(self.TEST_REPO, "data.bin"), "wb") as f:
+            f.write(content)
+        oid, st = self.repo.objects.write_file(os.path.join(self.TEST_REPO, "data.bin"), chunk_size=4096)
+        self.assertEqual(oid, self.repo.objects.hash_object("blob", content))
+        self.assertEqual(st.st_size, len(content))
+        self.assertEqual(self.repo.objects.read_blob(oid), content)
+
+    def test_chunk_boundaries_are_bounded_and_content_defined(self):
+        data = os.urandom(400000)
+        cuts = list(chunk_boundaries(data, 4096))
+        self.assertEqual(cuts[0][0], 0)
+        self.assertEqual(cuts[-1][1], len(data))
+        self.assertTrue(all(end == next_start for (_, end), (next_start, _) in zip(cuts, cuts[1:])))
+        self.assertTrue(all(1024 < end - start <= 16384 for start, end in cuts[:-1]))
+        # Bytes inserted at the front only move the cuts of the first chunks.
+        shifted = {end - 3 for _, end in chunk_boundaries(b"abc" + data, 4096)}
+        self.assertGreater(len(shifted & {end for _, end in cuts}), len(cuts) - 3)
+
+    def test_large_files_are_chunked_and_binary_safe(self):
+        self.repo.set_config("large_file_threshold", 1024)
+        self.repo.set_config("chunk_size", 4096)
+        path = os.path.join(self.TEST_REPO, "asset.bin")
+        content = os.urandom(200000)
+        with open(path, "wb") as f:
+            f.write(content)
+        self.repo.add("asset.bin")
+        self.repo.commit("Add asset")
+        chunk_dirs = lambda: sum(len(files) for _, _, files in os.walk(self.repo.objects.objects_dir))
+        before = chunk_dirs()
+
+        edited = content[:100000] + b"\0edit\0" + content[100000:]
+        with open(path, "wb") as f:
+            f.write(edited)
+        self.repo.add("asset.bin")
+        self.repo.commit("Edit asset")
+        # Only the chunks around the edit, the manifest, tree and commit are new.
+        self.assertLess(chunk_dirs() - before, 10)
+
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(tree["asset.bin"], self.repo.objects.hash_object("blob", edited))
+        self.assertEqual(self.repo.objects.read_blob(tree["asset.bin"]), edited)
+        self.assertEqual(b"".join(self.repo.objects.stream_blob(tree["asset.bin"], 1000)), edited)
+        self.assertFalse(any(self.repo.status().values()))
+
+    def _commit_file(self, name, content, message):
+        with open(os.path.join(self.TEST_REPO, name), "w") as f:
+            f.write(content)
+        self.repo.add(name)
+        self.repo.commit(message)
+
+    def test_three_way_merge(self):
+        self._commit_file("f.txt", "1\n2\n3\n", "base")
+        self.repo.create_branch("feat")
+        self.repo.switch_branch("feat")
+        self._commit_file("f.txt", "1\n2\n3 feat\n", "feat change")
+        self.repo.switch_branch("main")
+        self._commit_file("f.txt", "1 main\n2\n3\n", "main change")
+        self.assertIn("three-way", self.repo.merge("feat"))
+        with open(os.path.join(self.TEST_REPO, "f.txt")) as f:
+            self.assertEqual(f.read(), "1 main\n2\n3 feat\n")
+        head = self.repo.objects.read_commit(self.repo.refs.read("main"))
+        self.assertEqual(len(head["parents"]), 2)
+        self.assertEqual(self.repo.merge("feat"), "Already up to date.")
+
+    def test_merge_conflict_then_commit(self):
+        self._commit_file("f.txt", "a\n", "base")
+        self.repo.create_branch("feat")
+        self.repo.switch_branch("feat")
+        self._commit_file("f.txt", "theirs\n", "feat change")
+        self._commit_file("g.txt", "g\n", "feat clean change")
+        self.repo.switch_branch("main")
+        self._commit_file("f.txt", "ours\n", "main change")
+        with self.assertRaises(Exception) as ctx:
+            self.repo.merge("feat")
+        self.assertIn("f.txt", str(ctx.exception))
+        with open(os.path.join(self.TEST_REPO, "f.txt")) as f:
+            self.assertEqual(f.read(), "<<<<<<< main\nours\n=======\ntheirs\n>>>>>>> feat\n")
+        # g.txt is staged by the merge, but the conflict in f.txt is not resolved yet.
+        with self.assertRaises(Exception) as ctx:
+            self.repo.commit("merged")
+        self.assertIn("f.txt", str(ctx.exception))
+        self._commit_file("f.txt", "resolved\n", "Merge feat")
+        head = self.repo.objects.read_commit(self.repo.refs.read("main"))
+        self.assertEqual(len(head["parents"]), 2)
+        self.assertFalse(os.path.exists(self.repo.merge_head_file))
+
+    def test_merge_conflict_deleted_by_us(self):
+        self._commit_file("a.txt", "a\n", "base")
+        self.repo.create_branch("feat")
+        self.repo.switch_branch("feat")
+        self._commit_file("a.txt", "theirs\n", "feat change")
+        self._commit_file("g.txt", "g\n", "feat clean change")
+        self.repo.switch_branch("main")
+        os.remove(os.path.join(self.TEST_REPO, "a.txt"))
+        self.repo.add("a.txt")
+        self.repo.commit("delete a")
+
+        with self.assertRaises(Exception):
+            self.repo.merge("feat")
+        self.assertEqual(self.repo.status()["conflicts"], ["a.txt"])
+        self.repo.abort_merge()
+        self.assertFalse(os.path.exists(self.repo.merge_head_file))
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_REPO, "g.txt")))
+        self.assertEqual(self.repo.status(), {"conflicts": [], "staged": [], "modified": [], "deleted": [], "new": []})
+
+        with self.assertRaises(Exception):
+            self.repo.merge("feat")
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_REPO, "a.txt")))
+        # Keep the deletion by staging the missing file.
+        self.assertEqual(self.repo.add("a.txt"), ["a.txt"])
+        self.assertEqual(self.repo.status()["conflicts"], [])
+        self.repo.commit("Merge feat")
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(sorted(tree), ["g.txt"])
+        self.assertEqual(len(self.repo.objects.read_commit(self.repo.refs.read("main"))["parents"]), 2)
+
+    def test_fast_forward_merge(self):
+        self._commit_file("f.txt", "a\n", "base")
+        self.repo.create_branch("feat")
+        self.repo.switch_branch("feat")
+        self._commit_file("g.txt", "g\n", "feat change")
+        self.repo.switch_branch("main")
+        self.assertEqual(self.repo.merge("feat"), "Fast-forward.")
+        self.assertEqual(self.repo.refs.read("main"), self.repo.refs.read("feat"))
+        self.assertTrue(os.path.exists(os.path.join(self.TEST_REPO, "g.txt")))
+
+    def test_diff_modes_and_renames(self):
+        body = "".join(f"line {i}\n" for i in range(20))
+        self._commit_file("moved.txt", "unique content\n", "add moved")
+        self._commit_file("edited.txt", body, "add edited")
+        self._commit_file("same.txt", "same\n", "add same")
+        self.repo.create_branch("feat")
+        self.repo.switch_branch("feat")
+        os.rename(os.path.join(self.TEST_REPO, "moved.txt"), os.path.join(self.TEST_REPO, "renamed.txt"))
+        os.rename(os.path.join(self.TEST_REPO, "edited.txt"), os.path.join(self.TEST_REPO, "edited2.txt"))
+        with open(os.path.join(self.TEST_REPO, "edited2.txt"), "w") as f:
+            f.write(body.replace("line 5\n", "line five\n"))
+        self.repo.add(stage_all=True)
+        self.repo.commit("rename files")
+        self.repo.switch_branch("main")
+
+        patch = self.repo.diff("feat")
+        self.assertIn("moved.txt -> renamed.txt (100% similar)", patch)
+        self.assertIn("edited.txt -> edited2.txt (95% similar)", patch)
+        self.assertIn("-line 5\n+line five", patch)
+        self.assertNotIn("same.txt", patch)
+        # name-only reads no content, so only exact renames are recognised.
+        self.assertEqual(self.repo.diff("feat", mode="name-only"), "edited.txt\nedited2.txt\nrenamed.txt")
+        stat = self.repo.diff("feat", mode="stat")
+        self.assertIn(" edited.txt -> edited2.txt | 2 +-", stat)
+        self.assertIn("1 file(s) changed, 1 insertion(s)(+), 1 deletion(s)(-)", stat)
+
+    def test_myers_matching_blocks_are_minimal(self):
+        a = list("abcabba")
+        b = list("cbabac")
+        blocks = matching_blocks(a, b)
+        self.assertEqual(blocks[-1], (7, 6, 0))
+        self.assertEqual(sum(length for _, _, length in blocks), 4)
+        for i, j, length in blocks:
+            self.assertEqual(a[i:i + length], b[j:j + length])
+
+    def test_switch_branch_checks_out_only_changed_files(self):
+        self._commit_file("shared.txt", "shared\n", "add shared")
+        self.repo.create_branch("feat")
+        self.assertTrue(os.path.exists(os.path.join(self.repo.refs.heads_dir, "feat")))
+        self.repo.switch_branch("feat")
+        os.makedirs(os.path.join(self.TEST_REPO, "docs"))
+        self._commit_file("docs/feat.txt", "feature\n", "add feature")
+        self.repo.switch_branch("main")
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_REPO, "docs")))
+
+        with mock.patch.object(self.repo, "_write_worktree_file", wraps=self.repo._write_worktree_file) as write:
+            self.repo.switch_branch("feat")
+        self.assertEqual([c.args[0] for c in write.call_args_list], ["docs/feat.txt"])
+        with open(os.path.join(self.TEST_REPO, "docs", "feat.txt")) as f:
+            self.assertEqual(f.read(), "feature\n")
+
+        with open(os.path.join(self.TEST_REPO, "docs", "feat.txt"), "w") as f:
+            f.write("local edit\n")
+        with self.assertRaises(Exception):
+            self.repo.switch_branch("main")
+        self.assertEqual(self.repo._get_active_branch(), "feat")
+
+    def test_batch_parses_and_writes_metadata_once(self):
+        for i in range(5):
+            with open(os.path.join(self.TEST_REPO, f"f{i}.txt"), "w") as f:
+                f.write(str(i))
+        loads = []
+        original_load = Index.load
+
+        def counting_load(index):
+            loads.append(index)
+            return original_load(index)
+
+        with mock.patch.object(Index, "load", counting_load):
+            with self.repo.batch():
+                for i in range(5):
+                    self.repo.add(f"f{i}.txt")
+                mtime = os.stat(self.repo.index_file).st_mtime_ns
+                self.assertTrue(self.repo.state.is_dirty())
+                self.repo.commit("Add files")
+            self.assertEqual(len(loads), 1)
+        self.assertNotEqual(os.stat(self.repo.index_file).st_mtime_ns, mtime)
+        self.assertFalse(self.repo.state.is_dirty())
+        self.assertEqual(self.repo.status()["staged"], [])
+
+    def test_state_cache_reloads_after_external_write(self):
+        self.assertEqual(self.repo._get_active_branch(), "main")
+        other = Repository(self.TEST_REPO)
+        other.create_branch("dev")
+        other.switch_branch("dev")
+        self.assertEqual(self.repo._get_active_branch(), "dev")
+
+    def test_concurrent_writers_do_not_lose_updates(self):
+        def worker(n):
+            repo = Repository(self.TEST_REPO)
+            for i in range(5):
+                name = f"w{n}_{i}.txt"
+                with open(os.path.join(self.TEST_REPO, name), "w") as f:
+                    f.write(name)
+                # The staging area is shared, so add and commit must run under one lock.
+                with repo.batch():
+                    repo.add(name)
+                    repo.commit(f"commit {name}")
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.repo.view_commit_history()), 20)
+        tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+        self.assertEqual(len(tree), 20)
+        self.assertFalse(any(self.repo.status().values()))
+
+    def test_clone_links_objects(self):
+        self._commit_file("a.txt", "a", "first")
+        self._commit_file("b.txt", "b", "second")
+        clone_name = f"{self.TEST_REPO}_clone"
+        self.addCleanup(shutil.rmtree, clone_name, True)
+        clone = self.repo.clone(clone_name)
+        oid = self.repo.refs.read("main")
+        source_path = self.repo.objects._object_path(oid)
+        clone_path = clone.objects._object_path(oid)
+        self.assertEqual(os.stat(source_path).st_ino, os.stat(clone_path).st_ino)
+        self.assertEqual(len(clone.view_commit_history()), 2)
+        with open(os.path.join(clone_name, "b.txt")) as f:
+            self.assertEqual(f.read(), "b")
+        self.assertFalse(any(clone.status().values()))
+
+    def test_shallow_single_branch_clone(self):
+        self._commit_file("a.txt", "a", "first")
+        self._commit_file("a.txt", "aa", "second")
+        self.repo.create_branch("topic")
+        self._commit_file("a.txt", "aaa", "third")
+        clone_name = f"{self.TEST_REPO}_clone"
+        self.addCleanup(shutil.rmtree, clone_name, True)
+        clone = self.repo.clone(clone_name, depth=1, branch="main")
+        self.assertEqual(clone.refs.names(), ["main"])
+        self.assertEqual([c["message"] for c in clone.view_commit_history()], ["third"])
+        self.assertTrue(os.path.exists(clone.shallow_file))
+        self.assertLess(len(list(clone.objects.object_ids())), len(list(self.repo.objects.object_ids())))
+        with open(os.path.join(clone_name, "a.txt")) as f:
+            self.assertEqual(f.read(), "aaa")
+
+    def test_shallow_boundary_is_kept_by_clones_and_merges(self):
+        self._commit_file("a.txt", "a", "first")
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("t.txt", "t", "topic")
+        self.repo.switch_branch("main")
+        self._commit_file("a.txt", "aa", "second")
+        shallow_name, copy_name = f"{self.TEST_REPO}_shallow", f"{self.TEST_REPO}_copy"
+        self.addCleanup(shutil.rmtree, shallow_name, True)
+        self.addCleanup(shutil.rmtree, copy_name, True)
+        shallow = self.repo.clone(shallow_name, depth=1)
+        self.assertEqual(shallow._load_shallow(), {self.repo.refs.read("main"), self.repo.refs.read("topic")})
+        self.assertEqual(shallow.clone(copy_name)._load_shallow(), shallow._load_shallow())
+
+        # The merge base is cut off, so merging would treat every file as added on both sides.
+        with self.assertRaisesRegex(Exception, "shallow"):
+            shallow.merge("topic")
+        self.assertIn("three-way", self.repo.merge("topic"))
+
+    def test_fetch_into_shallow_clone(self):
+        # Distinct dates, so history walks reach commits in a fixed order.
+        clock = mock.patch("src.repo.datetime")
+        clock.start().now.side_effect = [datetime(2024, 1, 1, 0, 0, second) for second in range(10)]
+        self.addCleanup(clock.stop)
+        self._commit_file("a.txt", "a1\n", "C1")
+        c1 = self.repo.refs.read("main")
+        self._commit_file("a.txt", "a2\n", "C2")
+        self._commit_file("a.txt", "a3\n", "C3")
+        shallow_name = f"{self.TEST_REPO}_shallow"
+        self.addCleanup(shutil.rmtree, shallow_name, True)
+        shallow = self.repo.clone(shallow_name, depth=1)
+
+        # A branch forked before the clone's boundary: the clone has none of C1's files.
+        self.repo.refs.write("side", c1)
+        self.repo.switch_branch("side")
+        self._commit_file("x.txt", "x\n", "X1")
+        x1 = self.repo.refs.read("side")
+        self.repo.switch_branch("main")
+
+        self.assertEqual(shallow.fetch()["side"], x1)
+        tree = shallow._read_commit_tree(x1)
+        self.assertEqual(shallow.objects.read_blob(tree["a.txt"]), b"a1\n")
+        self.assertEqual(shallow.blame("a.txt", x1), [(c1, "a1")])
+        self.assertEqual(shallow._load_shallow(), {self.repo.refs.read("main")})
+
+        # Fetching the commits past the boundary makes the clone whole again.
+        self.repo.refs.write("old", self.repo.commit_graph.parents(self.repo.refs.read("main"))[0])
+        shallow.fetch()
+        self.assertEqual(shallow._load_shallow(), frozenset())
+        self.assertFalse(os.path.exists(shallow.shallow_file))
+        self.assertEqual([c["message"] for c in shallow.iter_history(revision="main")], ["C3", "C2", "C1"])
+
+    def _clone(self):
+        clone_name = f"{self.TEST_REPO}_clone"
+        self.addCleanup(shutil.rmtree, clone_name, True)
+        return self.repo.clone(clone_name)
+
+    def test_pull_and_push_send_only_missing_objects(self):
+        content = "".join(f"line {i}\n" for i in range(2000))
+        self._commit_file("a.txt", content, "first")
+        clone = self._clone()
+        old_head = self.repo.refs.read("main")
+        self._commit_file("a.txt", content + "more\n", "second")
+        new_head = self.repo.refs.read("main")
+        with tempfile.TemporaryFile() as pack:
+            # One blob, one tree and one commit; the blob goes as a delta.
+            self.assertEqual(self.repo.upload_pack(pack, [new_head], [old_head]), 3)
+            self.assertLess(pack.tell(), 600)
+
+        self.assertEqual(clone.pull(), "Fast-forward.")
+        self.assertEqual(clone.refs.read("main"), new_head)
+        self.assertEqual(Refs(clone.repo_dir, "remotes/origin").read("main"), new_head)
+        self.assertEqual(clone.view_commit_history()[-1]["message"], "second")
+
+        with open(os.path.join(clone.name, "b.txt"), "w") as f:
+            f.write("b")
+        clone.add("b.txt")
+        clone.commit("from clone")
+        clone.push()
+        self.assertEqual(self.repo.refs.read("main"), clone.refs.read("main"))
+        with open(os.path.join(self.TEST_REPO, "b.txt")) as f:
+            self.assertEqual(f.read(), "b")
+        self.assertFalse(any(self.repo.status().values()))
+
+    def test_unsafe_tree_paths_are_refused(self):
+        self._commit_file("a.txt", "a", "first")
+        clone = self._clone()
+        head = self.repo.refs.read("main")
+        blob = self.repo.objects.write_blob(b"owned")
+        for path in ("../outside.txt", "/tmp/outside.txt", "a//b.txt", ".vcs/HEAD", "./a.txt"):
+            tree = dict(self.repo._read_commit_tree(head), **{path: blob})
+            bad = self.repo.objects.write_commit(self.repo.objects.write_tree(tree), [head], "evil", "2024-01-01 00:00:00")
+            self.repo.refs.update("main", bad, expected=self.repo.refs.read("main"))
+            with self.assertRaises(Exception):
+                clone.pull()
+            self.assertFalse(clone.objects.exists(self.repo.objects.read_commit(bad)["tree"]))
+            with self.assertRaises(Exception):
+                self.repo._checkout({}, tree, self.repo._load_index(), "test")
+        self.assertFalse(os.path.exists("outside.txt"))
+        self.assertEqual(clone.refs.read("main"), head)
+
+    def test_push_rejects_diverged_branch(self):
+        self._commit_file("a.txt", "a", "first")
+        clone = self._clone()
+        self._commit_file("a.txt", "upstream", "upstream change")
+        with open(os.path.join(clone.name, "c.txt"), "w") as f:
+            f.write("c")
+        clone.add("c.txt")
+        clone.commit("local change")
+        with self.assertRaises(Exception):
+            clone.push()
+        self.assertEqual(clone.pull(), "Merge made by the three-way strategy.")
+        clone.push()
+        self.assertEqual(self.repo.refs.read("main"), clone.refs.read("main"))
+
+    def test_fetch_over_http(self):
+        self._commit_file("a.txt", "a", "first")
+        server = self.repo.serve()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        other_name = f"{self.TEST_REPO}_other"
+        self.addCleanup(shutil.rmtree, other_name, True)
+        other = Repository(other_name)
+        other.create_repo()
+        other.add_remote("origin", f"http://127.0.0.1:{server.server_address[1]}")
+        self.assertEqual(other.pull(), "Fast-forward.")
+        with open(os.path.join(other_name, "a.txt")) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_delta_round_trip(self):
+        base = b"".join(b"line %d\n" % i for i in range(200))
+        target = base.replace(b"line 100\n", b"changed\n") + b"tail"
+        delta = make_delta(base, target)
+        self.assertLess(len(delta), len(target) // 10)
+        self.assertEqual(apply_delta(base, delta), target)
+        self.assertEqual(apply_delta(b"", make_delta(b"", b"new")), b"new")
+
+    def test_gc_packs_versions_as_delta_chains(self):
+        self.repo.set_config("max_delta_depth", 3)
+        lines = [f"setting_{i} = {i}\n" for i in range(300)]
+        for version in range(10):
+            lines[version] = f"setting_{version} = changed\n"
+            self._commit_file("app.conf", "".join(lines), f"version {version}")
+        head_tree = self.repo._read_commit_tree(self.repo.refs.read("main"))
+
+        stats = self.repo.gc()
+        self.assertEqual(list(self.repo.objects.loose_ids()), [])
+        self.assertGreaterEqual(stats["deltas"], 9)
+        self.assertLess(stats["size_after"], stats["size_before"] // 2)
+        (pack,) = self.repo.objects.packs()
+        for oid in pack:
+            depth = 0
+            base = pack.read_entry(oid)[1]
+            while base is not None:
+                depth += 1
+                base = pack.read_entry(base)[1]
+            self.assertLessEqual(depth, 3)
+        self.assertEqual(self.repo.objects.read_blob(head_tree["app.conf"]).decode(), "".join(lines))
+        self.assertFalse(any(self.repo.status().values()))
+
+        # Packed and loose objects work side by side, and clones share the pack.
+        self._commit_file("other.txt", "x", "after gc")
+        clone_name = f"{self.TEST_REPO}_clone"
+        self.addCleanup(shutil.rmtree, clone_name, True)
+        clone = self.repo.clone(clone_name)
+        with open(os.path.join(clone_name, "app.conf")) as f:
+            self.assertEqual(f.read(), "".join(lines))
+        self.assertEqual(len(clone.objects.packs()), 1)
+
+    def test_gc_prunes_unreachable_objects(self):
+        self._commit_file("a.txt", "a", "first")
+        orphan = self.repo.objects.write_blob(b"nobody points here")
+        self.assertEqual(self.repo.gc(prune=False)["pruned"], 0)
+        self.assertTrue(self.repo.objects.exists(orphan))
+        self.assertEqual(self.repo.gc()["pruned"], 1)
+        self.assertFalse(self.repo.objects.exists(orphan))
+        self.assertEqual(self.repo.objects.read_blob(self.repo._read_commit_tree(self.repo.refs.read("main"))["a.txt"]), b"a")
+
+    def test_ignore_patterns(self):
+        os.makedirs(os.path.join(self.TEST_REPO, "pkg"))
+        with open(os.path.join(self.TEST_REPO, ".vcsignore"), "w") as f:
+            f.write("# build output\n*.log\n!keep.log\nbuild/\n/root_only.txt\ndocs/**/*.tmp\n")
+        with open(os.path.join(self.TEST_REPO, "pkg", ".vcsignore"), "w") as f:
+            f.write("secret.txt\n!debug.log\n")
+        self.repo.ignore("*.bak")
+        matcher = IgnoreMatcher(self.TEST_REPO, self.repo.view_ignore_list())
+        self.assertTrue(matcher.is_ignored("app.log"))
+        self.assertTrue(matcher.is_ignored("pkg/app.log"))
+        self.assertFalse(matcher.is_ignored("keep.log"))
+        self.assertFalse(matcher.is_ignored("pkg/debug.log"))
+        self.assertTrue(matcher.is_ignored("pkg/secret.txt"))
+        self.assertFalse(matcher.is_ignored("secret.txt"))
+        self.assertTrue(matcher.is_ignored("build", is_dir=True))
+        self.assertTrue(matcher.is_ignored("src/build/out.o"))
+        self.assertFalse(matcher.is_ignored("build"))
+        self.assertTrue(matcher.is_ignored("root_only.txt"))
+        self.assertFalse(matcher.is_ignored("pkg/root_only.txt"))
+        self.assertTrue(matcher.is_ignored("docs/a.tmp"))
+        self.assertTrue(matcher.is_ignored("docs/x/y/a.tmp"))
+        self.assertFalse(matcher.is_ignored("a.tmp"))
+        self.assertTrue(matcher.is_ignored("notes.bak"))
+
+    def test_ignored_directories_are_pruned(self):
+        os.makedirs(os.path.join(self.TEST_REPO, "node_modules", "lib", "deep"))
+        for name in ("node_modules/lib/index.js", "node_modules/lib/deep/x.js", "app.js"):
+            with open(os.path.join(self.TEST_REPO, name), "w") as f:
+                f.write(name)
+        with open(os.path.join(self.TEST_REPO, ".vcsignore"), "w") as f:
+            f.write("node_modules/\n")
+        scanned = []
+        real_scandir = os.scandir
+
+        def scandir(path):
+            scanned.append(path)
+            return real_scandir(path)
+
+        with mock.patch("src.repo.os.scandir", side_effect=scandir):
+            self.assertEqual(sorted(self.repo.add(".")), [".vcsignore", "app.js"])
+            self.assertEqual(self.repo.status()["new"], [])
+        self.assertFalse(any("node_modules" in path for path in scanned))
+        self.assertEqual(self.repo.add("**/*.js"), [])
+
+    def _branchy_history(self):
+        """c1 - c2 - c3 - merge on main, with t1 on topic branching from c2."""
+        self._commit_file("a.txt", "1", "c1")
+        self._commit_file("a.txt", "2", "c2")
+        c1, c2 = [commit["commit"] for commit in self.repo.view_commit_history()]
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("t.txt", "t", "t1")
+        t1 = self.repo.refs.read("topic")
+        self.repo.switch_branch("main")
+        self._commit_file("a.txt", "3", "c3")
+        c3 = self.repo.refs.read("main")
+        return c1, c2, c3, t1
+
+    def test_commit_graph_generations_and_ancestry(self):
+        c1, c2, c3, t1 = self._branchy_history()
+        self.repo.merge("topic")
+        merge = self.repo.refs.read("main")
+        self.assertEqual(self.repo.write_commit_graph(), 5)
+
+        graph = self.repo.commit_graph
+        self.assertEqual([graph.generation(oid) for oid in (c1, c2, c3, t1, merge)], [1, 2, 3, 3, 4])
+        self.assertEqual(sorted(graph.parents(merge)), sorted([c3, t1]))
+        with mock.patch.object(self.repo.objects, "read_commit") as read_commit:
+            self.assertTrue(is_ancestor(graph, c1, merge))
+            self.assertFalse(is_ancestor(graph, t1, c3))
+            self.assertEqual(merge_base(graph, c3, t1), c2)
+        read_commit.assert_not_called()
+
+        # Commits made after the file was written are read from the object store.
+        self._commit_file("a.txt", "4", "c4")
+        c4 = self.repo.refs.read("main")
+        self.assertEqual(graph.generation(c4), GENERATION_INFINITY)
+        self.assertTrue(is_ancestor(graph, t1, c4))
+        self.assertFalse(is_ancestor(graph, c4, merge))
+
+    def test_log_ranges_and_graph(self):
+        c1, c2, c3, t1 = self._branchy_history()
+        messages = lambda revision: [c["message"] for c in self.repo.iter_history(revision=revision)]
+        self.assertEqual(messages("main..topic"), ["t1"])
+        self.assertEqual(messages("topic..main"), ["c3"])
+        self.assertEqual(messages("topic"), ["t1", "c2", "c1"])
+        self.repo.merge("topic")
+        self.repo.write_commit_graph()
+        self.assertEqual(messages("topic..HEAD")[0], "Merge branch 'topic' into main")
+        self.assertEqual(len(messages("HEAD")), 5)
+
+        lines = [lanes for lanes, _ in draw_graph(self.repo.iter_history(revision="HEAD"))]
+        self.assertEqual(lines[:2], ["*", "|\\"])
+        self.assertEqual(sum(line.count("*") for line in lines), 5)
+        self.assertIn("|/", lines)
+
+    def test_graph_with_two_side_branches(self):
+        # Branches t and u both start at c1 and are merged into main one after the other.
+        history = [
+            ("merge-u", ["merge-t", "u1"]), ("merge-t", ["c2", "t2"]), ("t2", ["t1"]),
+            ("u1", ["c1"]), ("t1", ["c1"]), ("c2", ["c1"]), ("c1", []),
+        ]
+        lines = [
+            lanes + (f" {commit['commit']}" if commit else "")
+            for lanes, commit in draw_graph({"commit": oid, "parents": parents} for oid, parents in history)
+        ]
+        self.assertEqual(lines, [
+            "* merge-u",
+            "|\\",
+            "* | merge-t",
+            "|\\ \\",
+            "| * | t2",
+            "| | * u1",
+            "| * | t1",
+            "| |/",
+            "* | c2",
+            "|/",
+            "* c1",
+        ])
+
+    def test_blame_follows_edits_and_merges(self):
+        self._commit_file("f.txt", "a\nb\nc\n", "base")
+        base = self.repo.refs.read("main")
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("f.txt", "A\nb\nc\n", "topic edit")
+        topic = self.repo.refs.read("topic")
+        self.repo.switch_branch("main")
+        self._commit_file("f.txt", "a\nb\nc\nd\n", "append")
+        append = self.repo.refs.read("main")
+        self.repo.merge("topic")
+        self.assertEqual(self.repo.blame_cache.position(), len(self.repo.log))
+
+        self.assertEqual(self.repo.blame("f.txt"), [(topic, "A"), (base, "b"), (base, "c"), (append, "d")])
+        self.assertEqual(self.repo.blame("f.txt", "topic"), [(topic, "A"), (base, "b"), (base, "c")])
+        self.assertEqual(
+            [c["message"] for c in self.repo.iter_history(path="f.txt")][1:],
+            ["append", "topic edit", "base"],
+        )
+        with self.assertRaises(Exception):
+            self.repo.blame("missing.txt")
+
+    def test_blame_cache_is_extended_incrementally(self):
+        self._commit_file("f.txt", "a\nb\n", "first")
+        first = self.repo.refs.read("main")
+        self._commit_file("g.txt", "other\n", "unrelated")
+        self._commit_file("f.txt", "a\nB\n", "second")
+        second = self.repo.refs.read("main")
+        self.assertEqual(self.repo.blame_cache.position(), len(self.repo.log))
+
+        # Blame reads the cache without indexing or diffing anything.
+        with mock.patch("src.blame.get_opcodes") as get_opcodes:
+            self.assertEqual(self.repo.blame("f.txt"), [(first, "a"), (second, "B")])
+        get_opcodes.assert_not_called()
+        self.assertEqual([c["message"] for c in self.repo.iter_history(path="f.txt")], ["second", "first"])
+
+        # A repository without the cache, such as one made by an older version, indexes its log once.
+        shutil.rmtree(self.repo.blame_cache.root)
+        self.assertEqual(self.repo.blame("f.txt"), [(first, "a"), (second, "B")])
+        self.assertEqual(self.repo.blame_cache.position(), len(self.repo.log))
+
+    def test_commit_lands_when_indexing_fails(self):
+        self._commit_file("f.txt", "a\n", "first")
+        with mock.patch("src.blame.BlameCache.update", side_effect=Exception("Object 'x' not found.")):
+            self._commit_file("f.txt", "b\n", "second")
+            second = self.repo.refs.read("main")
+            with self.assertRaisesRegex(Exception, "not found"):
+                self.repo.blame("f.txt")
+        self.assertEqual([c["message"] for c in self.repo.iter_history()], ["second", "first"])
+        self.assertEqual(Repository(self.TEST_REPO).status()["staged"], [])
+        with self.assertRaisesRegex(Exception, "No files staged"):
+            self.repo.commit("again")
+
+        # The cache catches up once indexing works again.
+        self.assertEqual(self.repo.blame("f.txt"), [(second, "b")])
+        self.assertEqual(self.repo.blame_cache.position(), len(self.repo.log))
+
+    def test_blame_credits_reverted_lines_to_ancestors(self):
+        self._commit_file("f.txt", "a\nb\n", "first")
+        first = self.repo.refs.read("main")
+        self._commit_file("f.txt", "a\nB\n", "change")
+        self._commit_file("f.txt", "a\nb\n", "revert")
+        revert = self.repo.refs.read("main")
+
+        # The revert has the same content as the first commit, but is not its ancestor.
+        self.assertEqual(self.repo.blame("f.txt", first), [(first, "a"), (first, "b")])
+        self.assertEqual(self.repo.blame("f.txt"), [(first, "a"), (revert, "b")])
+
+        # A damaged cache is rebuilt rather than guessed around.
+        for name in os.listdir(os.path.join(self.repo.blame_cache.root, "lines")):
+            shutil.rmtree(os.path.join(self.repo.blame_cache.root, "lines", name))
+        self.assertEqual(self.repo.blame("f.txt"), [(first, "a"), (revert, "b")])
+
+    def test_history_skips_commits_pruned_by_gc(self):
+        self._commit_file("f.txt", "a\n", "first")
+        first = self.repo.refs.read("main")
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("f.txt", "b\n", "dropped")
+        self.repo.switch_branch("main")
+        self.repo.refs.write("topic", first)
+        self.assertEqual(self.repo.gc()["commits"], 1)
+
+        self.assertEqual([c["message"] for c in self.repo.iter_history(path="f.txt")], ["first"])
+        self.assertEqual(self.repo.blame("f.txt"), [(first, "a")])
+
+    def test_grep_history_skips_commits_pruned_by_gc(self):
+        self._commit_file("f.txt", "needle\n", "first")
+        first = self.repo.refs.read("main")
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("g.txt", "needle\n", "dropped, same content")
+        self._commit_file("h.txt", "needle in h\n", "dropped, own content")
+        self.repo.switch_branch("main")
+        self.repo.refs.write("topic", first)
+        self.repo.gc()
+
+        self.assertEqual(list(self.repo.grep("needle", all_history=True)), [(first, "f.txt", 1, "needle")])
+
+    def test_search_index_skips_binary_and_large_files(self):
+        self.repo.set_config("large_file_threshold", 64)
+        self._commit_file("big.txt", "needle\n" * 100, "big")
+        self._commit_file("bin.dat", "needle\0\n", "binary")
+        self._commit_file("small.txt", "needle\n", "small")
+        self.assertEqual(len(self.repo.search_index), 1)
+        self.assertEqual(
+            list(self.repo.grep("needle", all_history=True)),
+            [(self.repo.refs.read("main"), "small.txt", 1, "needle")],
+        )
+        # The current tree is still searched in full, unindexed files included.
+        self.assertEqual([m[1] for m in self.repo.grep("needle")], ["big.txt"] * 100 + ["small.txt"])
+
+    def test_blame_cache_skips_binary_and_large_files(self):
+        self.repo.set_config("large_file_threshold", 64)
+        # New files are credited to their commit without being read.
+        with mock.patch("src.blame.BlameCache._read_lines") as read_lines:
+            self._commit_file("big.txt", "line\n", "small")
+            small = self.repo.refs.read("main")
+            self._commit_file("bin.dat", "a\n", "text")
+        read_lines.assert_not_called()
+        self.assertEqual(self.repo.blame("big.txt"), [(small, "line")])
+
+        self._commit_file("big.txt", "line\n" * 100, "big")
+        self._commit_file("bin.dat", "a\0b\n", "binary")
+        head = self.repo.refs.read("main")
+        self.assertFalse(os.path.exists(self.repo.blame_cache._lines_path(head, "bin.dat")))
+        for name in ("big.txt", "bin.dat"):
+            with self.assertRaises(Exception):
+                self.repo.blame(name)
+
+    def test_grep_current_tree_history_and_branches(self):
+        self._commit_file("app.cfg", "name = api\ntimeout = 30\n", "initial config")
+        first = self.repo.refs.read("main")
+        self._commit_file("app.cfg", "name = api\ntimeout = 60\n", "raise timeout")
+        second = self.repo.refs.read("main")
+        self.repo.create_branch("topic")
+        self.repo.switch_branch("topic")
+        self._commit_file("extra.cfg", "Retries = 5\n", "add retries")
+        self.repo.switch_branch("main")
+
+        self.assertEqual(list(self.repo.grep("timeout = 30")), [])
+        self.assertEqual(list(self.repo.grep(r"timeout = \d+")), [(second, "app.cfg", 2, "timeout = 60")])
+        self.assertEqual(
+            list(self.repo.grep("timeout = [0-9]+", all_history=True, branch="main")),
+            [(second, "app.cfg", 2, "timeout = 60"), (first, "app.cfg", 2, "timeout = 30")],
+        )
+        self.assertEqual(list(self.repo.grep("retries")), [])
+        self.assertEqual(len(list(self.repo.grep("retries", branch="topic", ignore_case=True))), 1)
+        self.assertEqual(len(list(self.repo.grep("Retries", all_history=True))), 1)
+        self.assertEqual(list(self.repo.grep("Retries", all_history=True, branch="main")), [])
+
+    def test_grep_index_narrows_candidates(self):
+        for i in range(8):
+            self._commit_file(f"file{i}.txt", f"common text\nunique marker {i:03d}\n", f"commit {i}")
+        segments = self.repo.search_index._state()["segments"]
+        self.assertLessEqual(len(segments), 3)
+        self.assertEqual(segments[-1][1], 8)
+
+        self.assertEqual(required_literals(r"unique marker 0\d5"), ["unique marker 0"])
+        self.assertEqual(required_literals("a|bcd"), [])
+        with mock.patch.object(self.repo, "_grep_blob", wraps=self.repo._grep_blob) as grep_blob:
+            matches = list(self.repo.grep("marker 005", all_history=True))
+        self.assertEqual([m[1:] for m in matches], [("file5.txt", 2, "unique marker 005")])
+        self.assertEqual(grep_blob.call_count, 1)
+
+        # Patterns without usable literals still find everything, by checking every version.
+        self.assertEqual(len(list(self.repo.grep("m.rk.r", all_history=True))), 8)
+        shutil.rmtree(self.repo.search_index.root)
+        self.assertEqual(len(list(self.repo.grep("common text"))), 8)
+
+    def test_benchmark_generator_and_regression_check(self):
+        shutil.rmtree(self.TEST_REPO)
+        repo = generate_repo(self.TEST_REPO, files=12, file_size=200, commits=6, branches=2, seed=1)
+        self.assertEqual(sorted(repo.refs.names()), ["branch-0", "branch-1", "main"])
+        self.assertEqual(len(repo.view_commit_history()), 6 + 2 * 3)
+        self.assertEqual(len(repo._read_commit_tree(repo.refs.read("main"))), 12)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            params = {"files": 8, "file_size": 100, "commits": 4, "branches": 1}
+            run = run_benchmarks(params, ["commit", "merge", "log"], repeat=1, work_dir=work_dir)
+        self.assertEqual(sorted(run["results"]), ["commit", "log", "merge"])
+        self.assertGreater(run["results"]["commit"]["peak_bytes"], 0)
+
+        slower = {"params": params, "results": {"commit": {"seconds": 1.0}, "log": {"seconds": 0.001}}}
+        baseline = {"runs": [{"params": params, "results": {"commit": {"seconds": 0.5}, "log": {"seconds": 0.0001}}}]}
+        regressions = compare(baseline, {"runs": [slower]})
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("commit"))
+
+    def test_trace_hooks_see_spans_and_counters(self):
+        spans = []
+        hook = lambda name, start, seconds, args: spans.append((name, seconds))
+        trace.add_hook(hook)
+        try:
+            self._commit_file("a.txt", "hello\n", "first")
+        finally:
+            trace.remove_hook(hook)
+        names = [name for name, _ in spans]
+        for expected in ("lock", "store_files", "log_append", "flush", "add", "commit"):
+            self.assertIn(expected, names)
+        self.assertTrue(all(seconds >= 0 for _, seconds in spans))
+        self.assertGreater(trace.TRACER.counters["io.bytes_written"], 0)
+        # Without hooks or recording, spans cost nothing and record nothing.
+        self.assertIsNotNone(trace.span("idle"))
+        spans.clear()
+        self._commit_file("a.txt", "again\n", "second")
+        self.assertEqual(spans, [])
+
+    def test_chrome_trace_export(self):
+        self._commit_file("a.txt", "1\n", "first")
+        self.repo.create_branch("other")
+        trace.TRACER.start()
+        try:
+            self.repo.diff("other")
+            list(self.repo.iter_history())
+        finally:
+            trace.TRACER.stop()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            trace.TRACER.write_chrome_trace(path)
+            with open(path) as f:
+                exported = json.load(f)
+        spans = {event["name"]: event for event in exported["traceEvents"] if event["ph"] == "X"}
+        self.assertIn("diff", spans)
+        self.assertIn("iter_history", spans)
+        self.assertGreaterEqual(spans["diff"]["dur"], 0)
+        self.assertIn("io.bytes_read", exported["otherData"]["counters"])
+
+    def test_batch_runs_commands_with_one_repository(self):
+        pool = RepositoryPool()
+        parser = build_parser(BatchParser)
+        lines = ["# set up", ""]
+        for i in range(3):
+            with open(os.path.join(self.TEST_REPO, f"f{i}.txt"), "w") as f:
+                f.write(f"{i}\n")
+            lines.append(json.dumps({"id": i, "args": ["add", self.TEST_REPO, f"f{i}.txt"]}))
+            lines.append(f'commit {self.TEST_REPO} "batch commit {i}"')
+        lines += ["bogus", "[\"log\", \"%s\", \"-n\", \"1\"]" % self.TEST_REPO, "{not json"]
+        out = io.StringIO()
+        failures = run_batch(lines, lambda request: run_request(parser, pool, request["args"]), out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 9)
+        self.assertEqual(failures, 2)
+        self.assertEqual(results[0], {"ok": True, "output": "1 file(s) staged.\n", "id": 0})
+        self.assertIn("invalid choice", results[6]["error"])
+        self.assertIn("batch commit 2", results[7]["output"])
+        self.assertNotIn("\x1b", results[7]["output"])
+        self.assertIn("Line", results[8]["error"])
+        self.assertEqual([c["message"] for c in self.repo.iter_history()][:3], ["batch commit 2", "batch commit 1", "batch commit 0"])
+
+    def test_daemon_serves_concurrent_clients(self):
+        self._commit_file("a.txt", "a", "first")
+        pool = RepositoryPool()
+        parser = build_parser(BatchParser)
+        with tempfile.TemporaryDirectory() as tmp:
+            socket_path = os.path.join(tmp, "vcs.sock")
+            cwds = set()
+
+            def handle(argv, cwd):
+                cwds.add(cwd)
+                return run_request(parser, pool, argv, cwd)
+
+            server = make_daemon(socket_path, handle)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with self.assertRaises(Exception):
+                    make_daemon(socket_path, None)
+                results = []
+
+                def client(number):
+                    connection = DaemonClient(socket_path)
+                    try:
+                        results.append(connection.run({"id": number, "args": ["log", self.TEST_REPO]}))
+                        results.append(connection.run({"args": ["status", self.TEST_REPO]}))
+                    finally:
+                        connection.close()
+
+                clients = [threading.Thread(target=client, args=(n,)) for n in range(4)]
+                for t in clients:
+                    t.start()
+                for t in clients:
+                    t.join()
+                connection = DaemonClient(socket_path)
+                try:
+                    failed = connection.run({"args": ["serve", self.TEST_REPO]})
+                finally:
+                    connection.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result["ok"] for result in results))
+        self.assertEqual(sorted(result["id"] for result in results if "id" in result), [0, 1, 2, 3])
+        self.assertTrue(all("first" in result["output"] for result in results if "id" in result))
+        self.assertFalse(failed["ok"])
+        self.assertEqual(cwds, {os.getcwd()})
+
+    def test_daemon_resolves_paths_against_the_client_directory(self):
+        pool = RepositoryPool()
+        parser = build_parser(BatchParser)
+        with tempfile.TemporaryDirectory() as tmp:
+            def run(*argv):
+                result = run_request(parser, pool, argv, tmp)
+                self.assertTrue(result["ok"], result.get("error"))
+                return result["output"]
+
+            run("init", "r")
+            with open(os.path.join(tmp, "r", "a.txt"), "w") as f:
+                f.write("a\n")
+            run("add", "r", "a.txt")
+            run("commit", "r", "first")
+            self.assertIn("clean", run("status", "r"))
+            run("clone", "r", "copy")
+            run("remote", "copy", "upstream", "r")
+            self.assertIn("1 branch", run("fetch", "copy", "upstream"))
+            self.assertIn("1 branch", run("fetch", "copy", "r"))
+            self.assertTrue(os.path.isdir(os.path.join(tmp, "copy", ".vcs")))
+            self.assertFalse(os.path.exists("r") or os.path.exists("copy"))
+
+    def test_ref_compare_and_swap(self):
+        self._commit_file("a.txt", "a", "first")
+        head = self.repo.refs.read("main")
+        with self.assertRaises(Exception):
+            self.repo.refs.update("main", None, expected="0" * 40)
+        with self.assertRaises(Exception):
+            self.repo.refs.update("main", None, expected=MISSING)
+        self.repo.refs.update("topic", head, expected=MISSING)
+        self.assertEqual(self.repo.refs.read("topic"), head)
+        self.assertEqual(self.repo.refs.names(), ["main", "topic"])
+
 if __name__ == "__main__":
     unittest.main()